@@ -0,0 +1,50 @@
+"""
+Benchmarks of the service hot paths.
+Each benchmark runs against a throwaway test database created next to
+the configured one, run them with: python -m benchmarks.<name>
+"""
+import os
+import statistics
+import time
+from contextlib import contextmanager
+from typing import Callable, List
+
+import django
+
+
+def setup() -> None:
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "innotter.settings")
+    django.setup()
+
+
+@contextmanager
+def benchmark_database():
+    """Creates test database for the duration of the benchmark"""
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    setup_test_environment()
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+def measure(func: Callable[[], None], repeat: int) -> List[float]:
+    """Runs func repeat times and returns durations in milliseconds"""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - start) * 1000)
+    return durations
+
+
+def report(title: str, durations: List[float]) -> None:
+    print(
+        f"{title:<40} median {statistics.median(durations):8.3f} ms"
+        f"  p95 {sorted(durations)[int(len(durations) * 0.95)]:8.3f} ms"
+    )
@@ -0,0 +1,65 @@
+"""
+Throughput of new-post notification emails with the local memory backend.
+Compares sending every message separately with the chunked tasks, which
+stream follower emails and send them in batches over one connection.
+"""
+import time
+from unittest.mock import patch
+
+from benchmarks import benchmark_database, setup
+
+FOLLOWER_COUNTS = (1_000, 10_000, 50_000)
+
+
+def run() -> None:
+    from django.core import mail
+
+    from core.email_services import (
+        get_message,
+        send_new_post_notification_email,
+        send_notification_email_chunk,
+    )
+    from core.models import Page, Post
+    from users.models import User
+
+    owner = User.objects.create(username="owner", email="owner@user.com")
+    page = Page.objects.create(name="Page", description="Page", owner=owner)
+    post = Post.objects.create(page=page, subject="Subject", content="Content")
+    created = 0
+    for count in FOLLOWER_COUNTS:
+        followers = User.objects.bulk_create(
+            (
+                User(username=f"user{i}", email=f"user{i}@user.com")
+                for i in range(created, count)
+            ),
+            batch_size=5000,
+        )
+        page.followers.add(*followers)
+        created = count
+
+        mail.outbox = []
+        start = time.perf_counter()
+        for follower in Post.objects.get(pk=post.pk).page.followers.all():
+            get_message(Post.objects.get(pk=post.pk), follower.email).send()
+        separate = time.perf_counter() - start
+
+        mail.outbox = []
+        start = time.perf_counter()
+        with patch(
+            "core.email_services.send_notification_email_chunk.delay",
+            side_effect=send_notification_email_chunk,
+        ):
+            send_new_post_notification_email(post.pk)
+        chunked = time.perf_counter() - start
+        assert len(mail.outbox) == count
+
+        print(
+            f"{count:>6} followers  separate {count / separate:>8.0f} emails/s"
+            f"  chunked {count / chunked:>8.0f} emails/s"
+        )
+
+
+if __name__ == "__main__":
+    setup()
+    with benchmark_database():
+        run()
@@ -0,0 +1,49 @@
+"""
+Latency of follow and unfollow as the number of page followers grows.
+Membership is checked and changed by the unique index of the followers
+table, so the latency has to stay flat.
+"""
+from unittest.mock import patch
+
+from benchmarks import benchmark_database, measure, report, setup
+
+FOLLOWER_COUNTS = (100, 1_000, 10_000, 50_000)
+REPEAT = 200
+
+
+def run() -> None:
+    from core.counters import counter_buffer
+    from core.models import Page
+    from core.services import follow_page, unfollow_page
+    from users.models import User
+
+    owner = User.objects.create(username="owner", email="owner@user.com")
+    page = Page.objects.create(name="Page", description="Page", owner=owner)
+    reader = User.objects.create(username="reader", email="reader@user.com")
+    created = 0
+    for count in FOLLOWER_COUNTS:
+        followers = User.objects.bulk_create(
+            (
+                User(username=f"user{i}", email=f"user{i}@user.com")
+                for i in range(created, count)
+            ),
+            batch_size=5000,
+        )
+        page.followers.add(*followers)
+        created = count
+
+        def follow_and_unfollow():
+            follow_page(reader, page)
+            unfollow_page(reader, page)
+
+        report(
+            f"follow + unfollow, {count} followers",
+            measure(follow_and_unfollow, REPEAT),
+        )
+    counter_buffer.flush()
+
+
+if __name__ == "__main__":
+    setup()
+    with benchmark_database(), patch("core.services.event_emitter.emit"):
+        run()
@@ -0,0 +1,67 @@
+"""
+Throughput of the post list read path: model serializer with the stdlib
+JSON renderer against the values serializer with the orjson renderer.
+Every run reads, shapes and renders the given number of posts with likes.
+"""
+import statistics
+
+from benchmarks import benchmark_database, measure, setup
+
+POST_COUNTS = (50, 100, 1_000)
+LIKES_PER_POST = 5
+REPEAT = 20
+
+
+def run() -> None:
+    from rest_framework.renderers import JSONRenderer
+
+    from core.models import Page, Post
+    from core.serializers import PostSerializer, post_values
+    from innotter.renderers import FastJSONRenderer
+    from users.models import User
+
+    owner = User.objects.create(username="owner", email="owner@user.com")
+    page = Page.objects.create(name="Page", description="Page", owner=owner)
+    users = User.objects.bulk_create(
+        User(username=f"user{i}", email=f"user{i}@user.com")
+        for i in range(LIKES_PER_POST)
+    )
+    posts = Post.objects.bulk_create(
+        Post(page=page, subject=f"Subject {i}", content=f"Content {i}")
+        for i in range(max(POST_COUNTS))
+    )
+    Post.likes.through.objects.bulk_create(
+        Post.likes.through(post_id=post.pk, user_id=user.pk)
+        for post in posts
+        for user in users
+    )
+    queryset = Post.objects.order_by("-created_at", "-id")
+
+    for count in POST_COUNTS:
+
+        def serializer_path():
+            data = PostSerializer(list(queryset[:count]), many=True).data
+            JSONRenderer().render(data)
+
+        def values_path():
+            rows = queryset.values(*post_values.columns)[:count]
+            FastJSONRenderer().render(post_values.to_representation(rows))
+
+        assert JSONRenderer().render(
+            PostSerializer(list(queryset[:count]), many=True).data
+        ) == FastJSONRenderer().render(
+            post_values.to_representation(queryset.values(*post_values.columns)[:count])
+        )
+        serializer = statistics.median(measure(serializer_path, REPEAT))
+        values = statistics.median(measure(values_path, REPEAT))
+        print(
+            f"{count:>5} posts  serializer {count / serializer * 1000:>8.0f} rows/s"
+            f"  values {count / values * 1000:>8.0f} rows/s"
+            f"  x{serializer / values:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    setup()
+    with benchmark_database():
+        run()
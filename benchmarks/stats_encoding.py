@@ -0,0 +1,74 @@
+"""
+Messages and bytes produced for a burst of stats events.
+Compares the old path, one JSON message per event, with the emitter
+which coalesces events per (page_id, action) and packs them to binary
+batches. Nothing is sent to the broker, encoded messages are only counted.
+"""
+import json
+import random
+import time
+from unittest.mock import patch
+
+from benchmarks import setup
+
+EVENTS = 200_000
+PAGES = 1000
+ACTIONS = (("GET", "like"), ("GET", "unlike"), ("PUT", "follow"), ("PUT", "unfollow"))
+
+
+def generate_events():
+    """Likes and follows with a skewed page popularity, as in a viral burst"""
+    random.seed(0)
+    weights = [1 / rank for rank in range(1, PAGES + 1)]
+    pages = random.choices(range(1, PAGES + 1), weights=weights, k=EVENTS)
+    return [
+        (method, dict(page_id=page_id, action=action))
+        for page_id, (method, action) in zip(pages, random.choices(ACTIONS, k=EVENTS))
+    ]
+
+
+def print_result(title: str, seconds: float, messages: int, size: int) -> None:
+    print(
+        f"{title:<28} {messages:>8} messages  {size / EVENTS:7.2f} bytes/event"
+        f"  {EVENTS / seconds:>10.0f} events/s  {messages / seconds:>10.0f} messages/s"
+    )
+
+
+def run_json(events) -> None:
+    start = time.perf_counter()
+    payloads = [json.dumps(body) for _, body in events]
+    seconds = time.perf_counter() - start
+    print_result(
+        "json, message per event", seconds, len(payloads), sum(map(len, payloads))
+    )
+
+
+def run_emitter(events, encoding: str) -> None:
+    from core import codec
+    from core.emitter import EventEmitter
+
+    encoded = []
+
+    def publish_many(batch):
+        encoded.extend(codec.encode(batch, encoding))
+        return len(batch)
+
+    emitter = EventEmitter(
+        max_size=10_000, batch_size=1000, flush_interval=0.5, overflow="drop_oldest"
+    )
+    with patch("core.emitter.publisher.publish_many", side_effect=publish_many):
+        start = time.perf_counter()
+        for method, body in events:
+            emitter.emit(method, body)
+        emitter.drain(timeout=60)
+        seconds = time.perf_counter() - start
+    size = sum(len(payload) for payload, _, _ in encoded)
+    print_result(f"coalesced, {encoding}", seconds, len(encoded), size)
+
+
+if __name__ == "__main__":
+    setup()
+    events = generate_events()
+    run_json(events)
+    run_emitter(events, "json")
+    run_emitter(events, "binary")
@@ -0,0 +1,127 @@
+import json
+import struct
+from typing import List, Tuple
+
+STATS_CONTENT_TYPE = "application/x-innotter-stats"
+SCHEMA_VERSION = 1
+
+# Codes are positions in the tuples, new values may only be appended
+METHODS = ("GET", "POST", "PUT", "DELETE")
+ACTIONS = (
+    "like",
+    "unlike",
+    "follow",
+    "unfollow",
+    "page_created",
+    "page_deleted",
+    "post_created",
+    "post_deleted",
+)
+
+# Header: schema version and number of records
+HEADER = struct.Struct(">BH")
+# Record: method code, page id, action code and number of events
+RECORD = struct.Struct(">BIBI")
+MAX_RECORDS = 2**16 - 1
+# Page ids and counts are stored in 32-bit integer columns of the rollups
+MAX_VALUE = 2**31 - 1
+
+
+def encode_batch(messages: List[Tuple[str, dict]]) -> bytes:
+    """
+    Packs (method, body) stats events into one binary message.
+    Every event takes RECORD.size bytes, body count defaults to 1.
+    """
+    if len(messages) > MAX_RECORDS:
+        raise ValueError(f"At most {MAX_RECORDS} events fit into one message")
+    records = [
+        RECORD.pack(
+            METHODS.index(method),
+            body["page_id"],
+            ACTIONS.index(body["action"]),
+            body.get("count", 1),
+        )
+        for method, body in messages
+    ]
+    return HEADER.pack(SCHEMA_VERSION, len(records)) + b"".join(records)
+
+
+def decode_batch(payload: bytes) -> List[Tuple[str, dict]]:
+    """Unpacks binary message to the list of (method, body) stats events"""
+    version, count = HEADER.unpack_from(payload)
+    if version != SCHEMA_VERSION:
+        raise ValueError(f"Unsupported stats schema version: {version}")
+    if len(payload) != HEADER.size + count * RECORD.size:
+        raise ValueError("Stats message is truncated")
+    start = HEADER.size
+    records = RECORD.iter_unpack(payload[start:])
+    return [
+        (METHODS[method], dict(page_id=page_id, action=ACTIONS[action], count=events))
+        for method, page_id, action, events in records
+    ]
+
+
+def encode(
+    messages: List[Tuple[str, dict]], encoding: str
+) -> List[Tuple[bytes, str, int]]:
+    """
+    Encodes stats events to the list of (payload, content type, number of
+    events) messages. "json" sends every event as a separate JSON message
+    with HTTP method as content type, counted events are expanded back to
+    count messages, as the external stats service doesn't read counts.
+    Event is counted by its last message only, so it's confirmed once all
+    of its messages are sent. "binary" packs events with counts to batches.
+    """
+    if encoding == "json":
+        encoded = []
+        for method, body in messages:
+            count = body.get("count", 1)
+            body = {name: value for name, value in body.items() if name != "count"}
+            payload = json.dumps(body).encode()
+            encoded.extend((payload, method, 0) for _ in range(count - 1))
+            encoded.append((payload, method, 1))
+        return encoded
+    if encoding == "binary":
+        encoded = []
+        for start in range(0, len(messages), MAX_RECORDS):
+            end = start + MAX_RECORDS
+            chunk = messages[start:end]
+            encoded.append((encode_batch(chunk), STATS_CONTENT_TYPE, len(chunk)))
+        return encoded
+    raise ValueError(f"Unknown stats encoding: {encoding}")
+
+
+def is_valid_int(value) -> bool:
+    return (
+        isinstance(value, int)
+        and not isinstance(value, bool)
+        and (0 <= value <= MAX_VALUE)
+    )
+
+
+def validate_event(body: dict) -> None:
+    """Checks types and ranges of the event fields, raises ValueError"""
+    if not is_valid_int(body["page_id"]):
+        raise ValueError(f"Invalid page_id of stats event: {body['page_id']!r}")
+    if not isinstance(body["action"], str):
+        raise ValueError(f"Invalid action of stats event: {body['action']!r}")
+    if not is_valid_int(body["count"]) or body["count"] < 1:
+        raise ValueError(f"Invalid count of stats event: {body['count']!r}")
+
+
+def decode(payload: bytes, content_type: str) -> List[Tuple[str, dict]]:
+    """
+    Decodes message of either encoding to the list of (method, body) events.
+    Raises ValueError if the message or any of its events is malformed.
+    """
+    if content_type == STATS_CONTENT_TYPE:
+        events = decode_batch(payload)
+    else:
+        body = json.loads(payload)
+        if not isinstance(body, dict) or not {"page_id", "action"} <= body.keys():
+            raise ValueError("Stats event must have page_id and action")
+        body.setdefault("count", 1)
+        events = [(content_type, body)]
+    for _, body in events:
+        validate_event(body)
+    return events
@@ -0,0 +1,95 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Type
+
+from django.db import DatabaseError, models
+from django.db.models import F
+
+from innotter import settings
+from innotter.metrics import metrics
+from innotter.periodic import PeriodicThread
+
+
+class CounterBuffer:
+    """
+    In-process buffer of denormalized counter deltas.
+    Deltas are summed per (model, field, pk) and flushed when the buffer
+    is full or flush interval has passed. Background thread flushes deltas
+    of an idle process every flush interval. Rows with equal delta are
+    updated with a single UPDATE ... SET field = field + delta statement.
+    """
+
+    def __init__(
+        self, flush_interval: float, max_size: int, background_flush: bool = True
+    ):
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.background_flush = background_flush
+        self._flusher = PeriodicThread(
+            "counter-flusher",
+            self._flush_idle,
+            lambda: self.flush_interval if self.background_flush else 0,
+        )
+        self._after_fork()
+
+    def _after_fork(self) -> None:
+        """Deltas of the parent are flushed by the parent, child starts empty"""
+        self._lock = threading.Lock()
+        self._deltas = defaultdict(int)
+        self._last_flush = time.monotonic()
+
+    def _flush_idle(self) -> None:
+        with self._lock:
+            due = bool(self._deltas) and (
+                time.monotonic() - self._last_flush >= self.flush_interval
+            )
+        if due:
+            self.flush()
+
+    def add(self, model: Type[models.Model], pk: int, field: str, delta: int = 1):
+        """Adds delta to the counter field of model instance with pk"""
+        with self._lock:
+            self._flusher.start()
+            self._deltas[(model, field, pk)] += delta
+            due = (
+                len(self._deltas) >= self.max_size
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+        if due:
+            self.flush()
+
+    def clear(self) -> None:
+        """Drops all the buffered deltas"""
+        with self._lock:
+            self._deltas.clear()
+
+    def flush(self) -> None:
+        """Writes all the buffered deltas to the database"""
+        with self._lock:
+            deltas, self._deltas = self._deltas, defaultdict(int)
+            self._last_flush = time.monotonic()
+        groups = defaultdict(list)
+        for (model, field, pk), delta in deltas.items():
+            if delta:
+                groups[(model, field, delta)].append(pk)
+        for (model, field, delta), pks in groups.items():
+            try:
+                model.objects.filter(pk__in=pks).update(**{field: F(field) + delta})
+            except DatabaseError:
+                logging.exception(f"Could not flush {model.__name__}.{field} deltas")
+                with self._lock:
+                    for pk in pks:
+                        self._deltas[(model, field, pk)] += delta
+        metrics.increment("counters.flushed_updates", len(groups))
+
+
+counter_buffer = CounterBuffer(
+    flush_interval=settings.COUNTER_FLUSH_INTERVAL,
+    max_size=settings.COUNTER_BUFFER_SIZE,
+)
+os.register_at_fork(after_in_child=counter_buffer._after_fork)
+atexit.register(counter_buffer.flush)
@@ -1,17 +1,61 @@
 import logging
-from typing import List
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 import botocore.errorfactory
 from celery import shared_task
-from django.core.mail import EmailMessage
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection as db_connection
 from innotter import settings
+from innotter.metrics import metrics
 
-from core.models import Post
+from core.models import Page, PendingNotification, Post
+from users.models import User
 
+logger = logging.getLogger(__name__)
 
-def get_recipient_list(post: Post) -> List[str]:
-    """Gets recipient email list from followers list of the page"""
-    return [user.email for user in post.page.followers.all()]
+
+QUEUE_DIGEST_NOTIFICATIONS_QUERY = """
+    INSERT INTO {pending} (user_id, post_id, created_at)
+    SELECT followers.user_id, %s, NOW()
+    FROM {followers} AS followers
+    JOIN {users} AS users ON users.id = followers.user_id
+    WHERE followers.page_id = %s
+        AND followers.user_id BETWEEN %s AND %s
+        AND users.notification_mode <> %s
+    ON CONFLICT DO NOTHING
+"""
+
+
+def iter_chunks(items: Iterable[int], size: int) -> Iterator[List[int]]:
+    """Splits stream of ids into lists of given size"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def get_recipients(post: Post, first_id: int, last_id: int) -> Iterator[str]:
+    """
+    Streams emails of page followers with ids in [first_id, last_id]
+    who get notifications immediately through a server-side cursor.
+    """
+    return (
+        Page.followers.through.objects.filter(
+            page_id=post.page_id,
+            user_id__gte=first_id,
+            user_id__lte=last_id,
+            user__notification_mode=User.NotificationMode.IMMEDIATE,
+        )
+        .order_by("user_id")
+        .values_list("user__email", flat=True)
+        .iterator(chunk_size=settings.EMAIL_BATCH_SIZE)
+    )
 
 
 def get_message(post: Post, recipient: str) -> EmailMessage:
@@ -24,13 +68,187 @@ def get_message(post: Post, recipient: str) -> EmailMessage:
     )
 
 
-@shared_task
-def send_new_post_notification_email(post_id: int) -> None:
-    """Sends email newsletter"""
-    post = Post.objects.get(pk=post_id)
-    for recipient in get_recipient_list(post):
-        message = get_message(post, recipient)
+def queue_digest_notifications(post: Post, first_id: int, last_id: int) -> None:
+    """Queues post for digests of followers with ids in [first_id, last_id]"""
+    query = QUEUE_DIGEST_NOTIFICATIONS_QUERY.format(
+        pending=PendingNotification._meta.db_table,
+        followers=Page.followers.through._meta.db_table,
+        users=User._meta.db_table,
+    )
+    with db_connection.cursor() as cursor:
+        cursor.execute(
+            query,
+            [post.pk, post.page_id, first_id, last_id, User.NotificationMode.IMMEDIATE],
+        )
+
+
+def get_digest_message(recipient: str, posts: List[Post]) -> EmailMessage:
+    """Gets single EmailMessage listing all the new posts for the user"""
+    limit = settings.DIGEST_MAX_POSTS
+    lines = [f"{post.subject} on {post.page}" for post in posts[:limit]]
+    if len(posts) > limit:
+        lines.append(f"and {len(posts) - limit} more")
+    return EmailMessage(
+        f"{len(posts)} new posts on pages you follow",
+        "\n".join(lines),
+        settings.FROM_EMAIL,
+        [recipient],
+    )
+
+
+def get_pending_notifications(user_ids: List[int]) -> List[Tuple[int, int, int]]:
+    """Pending notifications of the users as (id, user_id, post_id)"""
+    return list(
+        PendingNotification.objects.filter(user_id__in=user_ids)
+        .order_by("id")
+        .values_list("id", "user_id", "post_id")
+    )
+
+
+def get_digest_messages(pending: List[Tuple[int, int, int]]) -> Dict[int, EmailMessage]:
+    """Gets digest message for every user with pending notifications"""
+    posts = Post.objects.select_related("page").in_bulk(
+        {post_id for _, _, post_id in pending}
+    )
+    user_posts = defaultdict(list)
+    for _, user_id, post_id in pending:
+        if post_id in posts:
+            user_posts[user_id].append(posts[post_id])
+    emails = dict(User.objects.filter(pk__in=user_posts).values_list("id", "email"))
+    return {
+        user_id: get_digest_message(
+            emails[user_id],
+            sorted(user_posts[user_id], key=lambda post: post.created_at, reverse=True),
+        )
+        for user_id in user_posts
+    }
+
+
+def send_each(connection, messages: List[EmailMessage]) -> List[bool]:
+    """
+    Sends messages one by one over an open connection, so a failure
+    affects only its own message. Returns whether each message was sent.
+    """
+    sent = []
+    for message in messages:
         try:
-            message.send(fail_silently=True)
+            sent.append(bool(connection.send_messages([message])))
         except (botocore.errorfactory.ClientError, Exception):
-            logging.error(f"Email {recipient} wasn't validated")
+            logger.exception("Digest email wasn't sent")
+            sent.append(False)
+    return sent
+
+
+def send_batch(connection, messages: List[EmailMessage]) -> int:
+    """Sends messages over an open connection, returns number of sent ones"""
+    try:
+        return connection.send_messages(messages) or 0
+    except (botocore.errorfactory.ClientError, Exception):
+        logger.exception(f"Batch of {len(messages)} emails wasn't sent")
+        return 0
+
+
+@shared_task
+def send_new_post_notification_email(post_id: int) -> None:
+    """
+    Sends email newsletter. Followers are streamed by id and split into
+    ranges of EMAIL_CHUNK_SIZE, every range is sent by a separate task.
+    """
+    post = Post.objects.filter(pk=post_id).only("page_id").first()
+    if post is None:
+        return
+    chunk_size = settings.EMAIL_CHUNK_SIZE
+    follower_ids = (
+        Page.followers.through.objects.filter(page_id=post.page_id)
+        .order_by("user_id")
+        .values_list("user_id", flat=True)
+        .iterator(chunk_size=chunk_size)
+    )
+    first_id = last_id = None
+    count = 0
+    for follower_id in follower_ids:
+        if first_id is None:
+            first_id = follower_id
+        last_id = follower_id
+        count += 1
+        if count == chunk_size:
+            send_notification_email_chunk.delay(post_id, first_id, last_id)
+            first_id, count = None, 0
+    if first_id is not None:
+        send_notification_email_chunk.delay(post_id, first_id, last_id)
+
+
+@shared_task
+def send_notification_email_chunk(post_id: int, first_id: int, last_id: int) -> None:
+    """
+    Sends notification to followers with ids in [first_id, last_id].
+    One email connection is opened for the whole chunk and messages
+    are sent in batches of EMAIL_BATCH_SIZE. Followers who read digests
+    get the post queued for the next digest instead.
+    """
+    post = Post.objects.select_related("page__owner").filter(pk=post_id).first()
+    if post is None:
+        return
+    queue_digest_notifications(post, first_id, last_id)
+    start = time.perf_counter()
+    sent = total = 0
+    batch = []
+    with get_connection() as connection:
+        for recipient in get_recipients(post, first_id, last_id):
+            batch.append(get_message(post, recipient))
+            if len(batch) == settings.EMAIL_BATCH_SIZE:
+                sent += send_batch(connection, batch)
+                total += len(batch)
+                batch = []
+        if batch:
+            sent += send_batch(connection, batch)
+            total += len(batch)
+    seconds = time.perf_counter() - start
+    metrics.increment("email.sent", sent)
+    metrics.increment("email.failed", total - sent)
+    metrics.observe("email.chunk_seconds", seconds)
+    if seconds:
+        metrics.observe("email.chunk_messages_per_second", sent / seconds)
+    logger.info(f"Post {post_id}: {sent} of {total} emails sent in {seconds:.2f}s")
+
+
+@shared_task
+def send_notification_digests(mode: str) -> None:
+    """
+    Periodic task that sends digests to users with given notification mode
+    who have pending notifications, in chunks of EMAIL_CHUNK_SIZE users.
+    """
+    user_ids = (
+        PendingNotification.objects.filter(user__notification_mode=mode)
+        .order_by("user_id")
+        .values_list("user_id", flat=True)
+        .distinct()
+        .iterator(chunk_size=settings.EMAIL_CHUNK_SIZE)
+    )
+    for chunk in iter_chunks(user_ids, settings.EMAIL_CHUNK_SIZE):
+        send_digest_chunk.delay(chunk)
+
+
+@shared_task
+def send_digest_chunk(user_ids: List[int]) -> None:
+    """
+    Sends one digest to every user of the chunk over one connection, in
+    batches of EMAIL_BATCH_SIZE users. Pending notifications of a user are
+    removed once the digest is sent, users whose digest failed keep them
+    for the next run. No transaction is kept open while sending.
+    """
+    sent = taken = 0
+    with get_connection() as connection:
+        for batch in iter_chunks(user_ids, settings.EMAIL_BATCH_SIZE):
+            pending = get_pending_notifications(batch)
+            messages = get_digest_messages(pending)
+            results = send_each(connection, list(messages.values()))
+            sent_users = {
+                user_id for user_id, is_sent in zip(messages, results) if is_sent
+            }
+            sent_ids = [pk for pk, user_id, _ in pending if user_id in sent_users]
+            if sent_ids:
+                taken += PendingNotification.objects.filter(pk__in=sent_ids).delete()[0]
+            sent += len(sent_users)
+    metrics.increment("email.digests_sent", sent)
+    metrics.increment("email.digest_notifications", taken)
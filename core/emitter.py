@@ -0,0 +1,192 @@
+import atexit
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from core.producer import publisher
+from innotter import settings
+from innotter.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class EventEmitter:
+    """
+    Bounded in-process queue of stats events.
+    Request handlers only append events to the queue, background thread
+    publishes them in batches, so API latency doesn't depend on the broker.
+    With coalesce on, repeated (method, page_id, action) events are folded
+    into one event with summed count while queued, so a burst of likes of
+    one page within flush interval is sent as a single counted delta. It is
+    only on when the consumer reads counts, otherwise events stay separate.
+    When queue is full, overflow policy decides which event is dropped:
+    "drop_oldest" evicts the oldest queued event, "drop_newest" rejects
+    the new one. Queue is drained on interpreter shutdown.
+    """
+
+    OVERFLOW_POLICIES = ("drop_oldest", "drop_newest")
+
+    def __init__(
+        self,
+        max_size: int,
+        batch_size: int,
+        flush_interval: float,
+        overflow: str,
+        coalesce: bool = True,
+    ):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.coalesce = coalesce
+        self._sequence = itertools.count(1)
+        self._after_fork()
+
+    def _key(self, method: str, body: dict) -> Tuple[str, int, str, int]:
+        """Queue key, unique per event when events aren't coalesced"""
+        sequence = 0 if self.coalesce else next(self._sequence)
+        return method, body["page_id"], body["action"], sequence
+
+    def _after_fork(self) -> None:
+        """Flusher thread doesn't survive fork, child starts its own one"""
+        self._pid = os.getpid()
+        self._events = OrderedDict()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def _ensure_thread(self) -> None:
+        if self._pid != os.getpid():
+            self._after_fork()
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="event-emitter", daemon=True
+            )
+            self._thread.start()
+
+    def emit(self, method: str, body: dict) -> bool:
+        """Queues event without blocking, returns whether it was queued"""
+        count = body.get("count", 1)
+        with self._condition:
+            self._ensure_thread()
+            key = self._key(method, body)
+            if key in self._events:
+                self._events[key] += count
+                metrics.increment("emitter.coalesced_events")
+                return True
+            if len(self._events) >= self.max_size:
+                metrics.increment("emitter.dropped_events")
+                if self.overflow == "drop_newest":
+                    return False
+                self._events.popitem(last=False)
+            self._events[key] = count
+            if len(self._events) >= self.batch_size:
+                self._condition.notify()
+        return True
+
+    def _take_batch(self) -> List[Tuple[str, dict]]:
+        batch = []
+        while self._events and len(batch) < self.batch_size:
+            (method, page_id, action, _), count = self._events.popitem(last=False)
+            batch.append((method, dict(page_id=page_id, action=action, count=count)))
+        return batch
+
+    def _run(self) -> None:
+        failed = False
+        while True:
+            with self._condition:
+                if not self._stopped and (
+                    failed or len(self._events) < self.batch_size
+                ):
+                    self._condition.wait(self.flush_interval)
+                if self._stopped:
+                    return
+                batch = self._take_batch()
+                metrics.gauge("emitter.queued_events", len(self._events))
+            try:
+                # Failed batch is retried after flush interval, not right away
+                failed = bool(batch) and not self._publish(batch)
+            except Exception:
+                logger.exception(f"Batch of {len(batch)} events wasn't published")
+                self._requeue(batch)
+                failed = True
+
+    def _publish(self, batch: List[Tuple[str, dict]]) -> bool:
+        """Publishes batch, returns whether all of it was confirmed"""
+        start = time.perf_counter()
+        published = publisher.publish_many(batch)
+        metrics.observe("emitter.batch_seconds", time.perf_counter() - start)
+        metrics.increment("emitter.published_events", published)
+        metrics.increment("emitter.failed_events", len(batch) - published)
+        self._requeue(batch[published:])
+        return published == len(batch)
+
+    def _requeue(self, events: List[Tuple[str, dict]]) -> None:
+        """
+        Puts unconfirmed events back to the head of the queue, events queued
+        meanwhile with the same key are folded into them. Events which don't
+        fit into the queue anymore are dropped.
+        """
+        with self._condition:
+            for method, body in reversed(events):
+                key = self._key(method, body)
+                if key in self._events:
+                    self._events[key] += body["count"]
+                elif len(self._events) < self.max_size:
+                    self._events[key] = body["count"]
+                else:
+                    metrics.increment("emitter.dropped_events")
+                    continue
+                self._events.move_to_end(key, last=False)
+
+    def clear(self) -> None:
+        """Drops all the queued events"""
+        with self._condition:
+            self._events.clear()
+
+    def drain(self, timeout: Optional[float] = None) -> None:
+        """
+        Stops flusher thread and publishes events left in the queue.
+        Events which can't be published within timeout are dropped.
+        """
+        if self._pid != os.getpid():
+            return
+        if timeout is None:
+            timeout = settings.EVENT_DRAIN_TIMEOUT
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        while time.monotonic() < deadline:
+            with self._condition:
+                batch = self._take_batch()
+            if not batch:
+                return
+            if not self._publish(batch):
+                break
+        with self._condition:
+            if self._events:
+                logger.error(f"{len(self._events)} events were dropped on shutdown")
+                metrics.increment("emitter.dropped_events", len(self._events))
+                self._events.clear()
+
+
+event_emitter = EventEmitter(
+    max_size=settings.EVENT_QUEUE_SIZE,
+    batch_size=settings.EVENT_BATCH_SIZE,
+    flush_interval=settings.EVENT_FLUSH_INTERVAL,
+    overflow=settings.EVENT_OVERFLOW_POLICY,
+    # External stats service reads one JSON message per event without count
+    coalesce=settings.STATS_EVENT_ENCODING == "binary"
+    or settings.STATS_BACKEND == "local",
+)
+os.register_at_fork(after_in_child=event_emitter._after_fork)
+atexit.register(event_emitter.drain)
@@ -0,0 +1,199 @@
+import heapq
+from datetime import datetime
+from itertools import islice
+from operator import attrgetter, itemgetter
+from typing import List, Optional, Tuple, Union
+
+from celery import shared_task
+from django.db.models import Q, QuerySet
+
+from core.models import FeedEntry, Notification, Page, Post, blocked_pages_q
+from core.notification_services import notify
+from core.page_sets import page_sets
+from innotter import settings
+from innotter.metrics import metrics
+
+
+def get_followed_posts(user) -> QuerySet:
+    """Posts of the pages user follows, not including posts on blocked pages"""
+    return Post.objects.filter(page_id__in=page_sets.get(user).followed)
+
+
+def _pushed_posts(user, limit: int, before: Optional[Tuple[datetime, int]]) -> QuerySet:
+    """Posts of regular pages which were written to user's feed on creation"""
+    entries = Post.objects.filter(feed_entries__user=user)
+    if before:
+        created_at, post_id = before
+        entries = entries.filter(
+            Q(feed_entries__created_at__lt=created_at)
+            | Q(feed_entries__created_at=created_at, feed_entries__post__lt=post_id),
+            feed_entries__created_at__lte=created_at,
+        )
+    return (
+        entries.select_related("page")
+        .exclude(page__is_celebrity=True)
+        .exclude(blocked_pages_q("page__"))
+        .order_by("-feed_entries__created_at", "-feed_entries__post")[:limit]
+    )
+
+
+def _pulled_posts(
+    page_id: int, limit: int, before: Optional[Tuple[datetime, int]]
+) -> QuerySet:
+    """Latest posts of celebrity page, read at request time"""
+    posts = Post.objects.filter(page_id=page_id)
+    if before:
+        created_at, post_id = before
+        posts = posts.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=post_id),
+            created_at__lte=created_at,
+        )
+    return posts.select_related("page").order_by("-created_at", "-id")[:limit]
+
+
+def assemble_feed(
+    user,
+    limit: int,
+    before: Optional[Tuple[datetime, int]] = None,
+    columns: Optional[List[str]] = None,
+) -> List[Union[Post, dict]]:
+    """
+    Hybrid newsfeed. Posts of regular pages are read from the materialized
+    feed, posts of celebrity pages are pulled at read time, and all the
+    streams are k-way merged by (created_at, id), newest posts first.
+    Before is the (created_at, id) key of the last post client has seen.
+    With columns, posts are read as rows of .values(*columns) instead.
+    """
+    celebrity_page_ids = list(
+        Page.objects.filter(
+            pk__in=page_sets.get(user).followed, is_celebrity=True
+        ).values_list("id", flat=True)
+    )
+    with metrics.timer("newsfeed.merge_seconds"):
+        streams = [_pushed_posts(user, limit, before)] + [
+            _pulled_posts(page_id, limit, before) for page_id in celebrity_page_ids
+        ]
+        if columns is not None:
+            streams = [stream.values(*columns) for stream in streams]
+            key = itemgetter("created_at", "id")
+        else:
+            key = attrgetter("created_at", "pk")
+        merged = heapq.merge(*streams, key=key, reverse=True)
+        feed = list(islice(merged, limit))
+    metrics.observe("newsfeed.merge_streams", len(streams))
+    return feed
+
+
+def backfill_feed(user_ids: List[int], page: Page) -> None:
+    """Puts latest posts of the page to the feeds of its new followers"""
+    if page.is_celebrity:
+        return
+    posts = page.posts.order_by("-created_at").values_list("id", "created_at")[
+        : settings.NEWSFEED_BACKFILL_SIZE
+    ]
+    FeedEntry.objects.bulk_create(
+        [
+            FeedEntry(user_id=user_id, post_id=post_id, created_at=created_at)
+            for post_id, created_at in posts
+            for user_id in user_ids
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def remove_page_from_feed(user_id: int, page: Page) -> None:
+    """Removes posts of the page from the feed of user who unfollowed it"""
+    FeedEntry.objects.filter(user_id=user_id, post__page=page).delete()
+
+
+def iter_follower_chunks(page_id: int):
+    """Streams follower ids of the page in chunks"""
+    chunk_size = settings.NEWSFEED_FANOUT_CHUNK_SIZE
+    follower_ids = (
+        Page.followers.through.objects.filter(page_id=page_id)
+        .order_by("user_id")
+        .values_list("user_id", flat=True)
+    )
+    chunk = []
+    for follower_id in follower_ids.iterator(chunk_size=chunk_size):
+        chunk.append(follower_id)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def dispatch_backfill(page_id: int, user_ids: List[int]) -> None:
+    """Schedules backfill of page posts for many new followers in chunks"""
+    chunk_size = settings.NEWSFEED_FANOUT_CHUNK_SIZE
+    for start in range(0, len(user_ids), chunk_size):
+        end = start + chunk_size
+        backfill_feed_chunk.delay(page_id, user_ids[start:end])
+
+
+@shared_task
+def fan_out_post(post_id: int) -> None:
+    """
+    Splits followers of the post's page into chunks and fills their feeds.
+    Pages with more followers than the celebrity threshold are switched
+    to pull mode instead, their posts are merged into feeds at read time.
+    Followers are notified of the post in both modes.
+    """
+    post = Post.objects.filter(pk=post_id).select_related("page").first()
+    if post is None:
+        return
+    page = post.page
+    is_celebrity = page.follower_count > settings.NEWSFEED_CELEBRITY_THRESHOLD
+    if is_celebrity != page.is_celebrity:
+        Page.objects.filter(pk=page.pk).update(is_celebrity=is_celebrity)
+        if not is_celebrity:
+            # Page went back to push mode, so posts which were only pulled
+            # so far have to be materialized for all of its followers
+            for chunk in iter_follower_chunks(page.pk):
+                backfill_feed_chunk.delay(page.pk, chunk)
+                notify_new_post_chunk.delay(post_id, chunk)
+            return
+    if is_celebrity:
+        for chunk in iter_follower_chunks(page.pk):
+            notify_new_post_chunk.delay(post_id, chunk)
+        metrics.increment("newsfeed.fanout.pulled_posts")
+        return
+    for chunk in iter_follower_chunks(page.pk):
+        fan_out_post_chunk.delay(post_id, chunk)
+    metrics.increment("newsfeed.fanout.pushed_posts")
+
+
+@shared_task
+def fan_out_post_chunk(post_id: int, user_ids: List[int]) -> None:
+    """Writes the post to the feeds and inboxes of a chunk of followers"""
+    post = Post.objects.filter(pk=post_id).only("created_at", "page_id").first()
+    if post is None:
+        return
+    FeedEntry.objects.bulk_create(
+        [
+            FeedEntry(user_id=user_id, post_id=post_id, created_at=post.created_at)
+            for user_id in user_ids
+        ],
+        ignore_conflicts=True,
+    )
+    notify(user_ids, Notification.Kind.NEW_POST, page_id=post.page_id, post_id=post_id)
+    metrics.increment("newsfeed.fanout.entries", len(user_ids))
+
+
+@shared_task
+def notify_new_post_chunk(post_id: int, user_ids: List[int]) -> None:
+    """Notifies a chunk of followers of the post without touching their feeds"""
+    post = Post.objects.filter(pk=post_id).only("page_id").first()
+    if post is not None:
+        notify(
+            user_ids, Notification.Kind.NEW_POST, page_id=post.page_id, post_id=post_id
+        )
+
+
+@shared_task
+def backfill_feed_chunk(page_id: int, user_ids: List[int]) -> None:
+    """Writes latest posts of the page to the feeds of a chunk of followers"""
+    page = Page.objects.filter(pk=page_id).first()
+    if page is not None:
+        backfill_feed(user_ids, page)
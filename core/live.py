@@ -0,0 +1,394 @@
+import asyncio
+import json
+import threading
+from collections import defaultdict, deque
+from typing import Iterable, List, Optional, Set, Tuple
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, transaction
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.models import Post
+from core.page_sets import page_sets
+from innotter import settings
+from innotter.metrics import metrics
+from users.models import User
+
+# Rough size of one coalesced like delta kept in the buffer
+LIKE_DELTA_SIZE = 64
+
+
+def encode_event(event: str, data) -> bytes:
+    """Encodes server-sent event frame"""
+    payload = json.dumps(data, cls=DjangoJSONEncoder, separators=(",", ":"))
+    return f"event: {event}\ndata: {payload}\n\n".encode()
+
+
+class Subscription:
+    """
+    Pending events of one live connection.
+    Events are put from any thread and are buffered on the event loop of
+    the connection. New posts are kept in order, like deltas are summed per
+    post, so a burst of likes takes one slot no matter how long it is.
+    When the buffer of a slow client exceeds max_events or max_bytes,
+    it is dropped and the connection is closed with a reset event, the
+    client reconnects and reloads the feed instead of the server buffering
+    without limit.
+    """
+
+    def __init__(
+        self,
+        loop,
+        max_events: int,
+        max_bytes: int,
+        max_posts: int,
+        user_id: Optional[int] = None,
+    ):
+        self.loop = loop
+        self.user_id = user_id
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_posts = max_posts
+        self.topics: Set[str] = set()
+        self.overflowed = False
+        self.closed = False
+        self._posts = deque()
+        self._likes = {}
+        self._size = 0
+        self._ready = asyncio.Event()
+
+    @property
+    def post_topics(self) -> int:
+        return sum(topic.startswith("post:") for topic in self.topics)
+
+    def put_post(self, post_id: int, frame: bytes) -> None:
+        if not self._reserve(len(frame)):
+            return
+        self._posts.append((post_id, frame))
+        self._ready.set()
+
+    def put_likes(self, post_id: int, delta: int) -> None:
+        if post_id in self._likes:
+            self._likes[post_id] += delta
+            metrics.increment("live.coalesced_events")
+            return
+        if not self._reserve(LIKE_DELTA_SIZE):
+            return
+        self._likes[post_id] = delta
+        self._ready.set()
+
+    def _reserve(self, size: int) -> bool:
+        if self.overflowed or self.closed:
+            return False
+        events = len(self._posts) + len(self._likes)
+        if events >= self.max_events or self._size + size > self.max_bytes:
+            self.overflowed = True
+            self._posts.clear()
+            self._likes.clear()
+            self._size = 0
+            self._ready.set()
+            metrics.increment("live.overflows")
+            return False
+        self._size += size
+        return True
+
+    def close(self) -> None:
+        self.closed = True
+        self._ready.set()
+
+    async def wait(self, timeout: float) -> bool:
+        """Waits for pending events, returns False on timeout"""
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def take(self) -> Tuple[List[bytes], List[int]]:
+        """
+        Takes all pending frames, new posts come before like deltas.
+        Ids of the new posts are returned too to follow their likes.
+        """
+        frames = []
+        new_posts = []
+        for post_id, frame in self._posts:
+            frames.append(frame)
+            new_posts.append(post_id)
+        likes = {post_id: delta for post_id, delta in self._likes.items() if delta}
+        if likes:
+            frames.append(encode_event("likes", likes))
+        self._posts.clear()
+        self._likes.clear()
+        self._size = 0
+        self._ready.clear()
+        return frames, new_posts
+
+
+class LiveBroker:
+    """
+    In-process pub/sub of live events.
+    Topics are "page:<id>" for new posts of the page and "post:<id>"
+    for like count changes of the post. Only connections served by this
+    process receive the events. Topics of a subscription are only changed
+    under the lock of the broker.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._topics = defaultdict(set)
+        self._users = defaultdict(set)
+
+    def subscribe(self, subscription: Subscription, topics: Iterable[str]) -> None:
+        with self._lock:
+            if subscription.user_id is not None:
+                self._users[subscription.user_id].add(subscription)
+            for topic in topics:
+                self._topics[topic].add(subscription)
+                subscription.topics.add(topic)
+
+    def follow_posts(self, subscription: Subscription, post_ids: List[int]) -> None:
+        """Subscribes to likes of the latest new posts, up to max_posts in total"""
+        with self._lock:
+            free = subscription.max_posts - subscription.post_topics
+            if free <= 0 or subscription.closed:
+                return
+            for post_id in post_ids[-free:]:
+                self._topics[f"post:{post_id}"].add(subscription)
+                subscription.topics.add(f"post:{post_id}")
+
+    def _discard(self, subscription: Subscription, topic: str) -> None:
+        subscribers = self._topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._topics[topic]
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self._lock:
+            for topic in subscription.topics:
+                self._discard(subscription, topic)
+            subscription.topics.clear()
+            subscriptions = self._users.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._users[subscription.user_id]
+
+    def drop_topics(
+        self, topics: Iterable[str], user_ids: Optional[Iterable[int]] = None
+    ) -> None:
+        """
+        Unsubscribes connections of the users, or all the connections if
+        users aren't given, from the topics they can't see anymore
+        """
+        user_ids = None if user_ids is None else set(user_ids)
+        with self._lock:
+            for topic in topics:
+                for subscription in list(self._topics.get(topic, ())):
+                    if user_ids is None or subscription.user_id in user_ids:
+                        self._discard(subscription, topic)
+                        subscription.topics.discard(topic)
+
+    def close_users(self, user_ids: Iterable[int]) -> None:
+        """Closes connections of the users, e.g. of blocked ones"""
+        with self._lock:
+            subscriptions = [
+                subscription
+                for user_id in user_ids
+                for subscription in self._users.get(user_id, ())
+            ]
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.close)
+
+    def _subscribers(self, topic: str) -> List[Subscription]:
+        with self._lock:
+            return list(self._topics.get(topic, ()))
+
+    def publish_post(self, page_id: int, post: dict) -> None:
+        """Pushes new post to followers of the page"""
+        subscribers = self._subscribers(f"page:{page_id}")
+        if not subscribers:
+            return
+        frame = encode_event("post", post)
+        for subscription in subscribers:
+            subscription.loop.call_soon_threadsafe(
+                subscription.put_post, post["id"], frame
+            )
+        metrics.increment("live.published_events", len(subscribers))
+
+    def publish_likes(self, post_id: int, delta: int) -> None:
+        """Pushes like count delta to the connections showing the post"""
+        subscribers = self._subscribers(f"post:{post_id}")
+        for subscription in subscribers:
+            subscription.loop.call_soon_threadsafe(
+                subscription.put_likes, post_id, delta
+            )
+        metrics.increment("live.published_events", len(subscribers))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._topics.clear()
+            self._users.clear()
+
+
+live_broker = LiveBroker()
+
+
+def post_published(post: dict) -> None:
+    """Publishes created post once the transaction is committed"""
+    transaction.on_commit(lambda: live_broker.publish_post(post["page"], post))
+
+
+def likes_changed(post_id: int, delta: int) -> None:
+    """Publishes like count delta once the transaction is committed"""
+    transaction.on_commit(lambda: live_broker.publish_likes(post_id, delta))
+
+
+def page_access_revoked(
+    page_ids: Iterable[int], user_ids: Optional[Iterable[int]] = None
+) -> None:
+    """
+    Stops pushing posts of the pages to open connections of the users,
+    or of everyone if users aren't given, once the transaction is committed
+    """
+    topics = [f"page:{page_id}" for page_id in page_ids]
+    transaction.on_commit(lambda: live_broker.drop_topics(topics, user_ids))
+
+
+def user_blocked(user_id: int, page_ids: Iterable[int]) -> None:
+    """Closes connections of blocked user, stops pushing posts of the user's pages"""
+    page_access_revoked(page_ids)
+    transaction.on_commit(lambda: live_broker.close_users([user_id]))
+
+
+def get_user_id(scope: dict) -> Optional[int]:
+    """Reads user id from the access token of the query string or header"""
+    query = parse_qs(scope.get("query_string", b"").decode())
+    raw_token = query.get("token", [None])[0]
+    if raw_token is None:
+        header = dict(scope.get("headers", ())).get(b"authorization", b"").split()
+        if len(header) != 2 or header[0].decode() not in api_settings.AUTH_HEADER_TYPES:
+            return None
+        raw_token = header[1].decode()
+    try:
+        return AccessToken(raw_token)[api_settings.USER_ID_CLAIM]
+    except (TokenError, KeyError):
+        return None
+
+
+def get_live_topics(user_id: int, post_ids: List[int]) -> Optional[List[str]]:
+    """
+    Topics of the connection: followed pages which aren't blocked and
+    requested posts the user can see. None if user can't be found.
+    """
+    try:
+        user = User.objects.filter(pk=user_id, is_blocked=False).first()
+        if user is None:
+            return None
+        sets = page_sets.get(user)
+        posts = Post.objects.filter(pk__in=post_ids[: settings.LIVE_MAX_POSTS])
+        if not user.is_staff:
+            posts = posts.visible_to(user, page_ids=sets.visible)
+        return [f"page:{page_id}" for page_id in sets.followed] + [
+            f"post:{post_id}" for post_id in posts.values_list("id", flat=True)
+        ]
+    finally:
+        # Stream outlives the request cycle, connection isn't kept open for it
+        close_old_connections()
+
+
+def get_post_ids(scope: dict) -> List[int]:
+    query = parse_qs(scope.get("query_string", b"").decode())
+    return [
+        int(post_id)
+        for value in query.get("posts", ())
+        for post_id in value.split(",")
+        if post_id.isdigit()
+    ]
+
+
+async def send_error(send, status: int) -> None:
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json")],
+        }
+    )
+    await send({"type": "http.response.body", "body": b"{}"})
+
+
+async def live_feed(scope: dict, receive, send) -> None:
+    """
+    ASGI application streaming server-sent events to authenticated users:
+    "post" events with new posts of followed pages and "likes" events
+    with like count deltas of the posts passed in the posts parameter
+    and of the pushed new posts. Clients get pushed updates instead of
+    polling the newsfeed.
+    """
+    if scope["method"] != "GET":
+        await send_error(send, 405)
+        return
+    user_id = get_user_id(scope)
+    topics = None
+    if user_id is not None:
+        topics = await sync_to_async(get_live_topics)(user_id, get_post_ids(scope))
+    if topics is None:
+        await send_error(send, 401)
+        return
+
+    subscription = Subscription(
+        asyncio.get_running_loop(),
+        max_events=settings.LIVE_MAX_EVENTS,
+        max_bytes=settings.LIVE_MAX_BUFFER_BYTES,
+        max_posts=settings.LIVE_MAX_POSTS,
+        user_id=user_id,
+    )
+
+    async def watch_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+        subscription.close()
+
+    watcher = asyncio.create_task(watch_disconnect())
+    live_broker.subscribe(subscription, topics)
+    metrics.increment("live.connections")
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        }
+    )
+    try:
+        while not subscription.closed:
+            if not await subscription.wait(settings.LIVE_HEARTBEAT_INTERVAL):
+                body = b": heartbeat\n\n"
+            elif subscription.overflowed:
+                body = encode_event("reset", {})
+                subscription.closed = True
+            else:
+                frames, new_posts = subscription.take()
+                if new_posts:
+                    live_broker.follow_posts(subscription, new_posts)
+                body = b"".join(frames)
+                metrics.increment("live.sent_events", len(frames))
+            if body:
+                await send(
+                    {"type": "http.response.body", "body": body, "more_body": True}
+                )
+        await send({"type": "http.response.body", "body": b""})
+    except OSError:
+        pass
+    finally:
+        live_broker.unsubscribe(subscription)
+        watcher.cancel()
+        metrics.increment("live.disconnections")
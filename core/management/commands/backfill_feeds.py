@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+
+from core.feed_services import backfill_feed_chunk, iter_follower_chunks
+from core.models import Page
+from innotter import settings
+
+
+class Command(BaseCommand):
+    help = (
+        "Fills materialized feeds with latest posts of the pages users already "
+        "follow, pages over the celebrity threshold are switched to pull mode"
+    )
+
+    def handle(self, *args, **options):
+        threshold = settings.NEWSFEED_CELEBRITY_THRESHOLD
+        switched = Page.objects.filter(
+            follower_count__gt=threshold, is_celebrity=False
+        ).update(is_celebrity=True)
+        self.stdout.write(f"{switched} pages switched to pull mode")
+        page_ids = (
+            Page.objects.filter(is_celebrity=False)
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        pages = chunks = 0
+        for page_id in page_ids.iterator():
+            for chunk in iter_follower_chunks(page_id):
+                backfill_feed_chunk(page_id, chunk)
+                chunks += 1
+            pages += 1
+        self.stdout.write(f"{pages} pages backfilled in {chunks} chunks")
@@ -0,0 +1,101 @@
+import logging
+import time
+from datetime import datetime, timezone
+from typing import List, Tuple
+
+import pika
+from django.core.management.base import BaseCommand
+from django.db import DataError, IntegrityError
+
+from core.producer import STATS_ROLLUP_QUEUE, declare_stats_queues
+from core.stats_services import consume_messages
+from innotter import settings
+from innotter.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def get_received_at(properties: pika.BasicProperties) -> datetime:
+    """Publish time of the message, or current time if producer didn't set it"""
+    if properties.timestamp is None:
+        return datetime.now(timezone.utc)
+    return datetime.fromtimestamp(properties.timestamp, timezone.utc)
+
+
+def flush(channel, messages: List[Tuple[bytes, str, datetime]], tags: List[int]) -> int:
+    """
+    Consumes batch and acknowledges it. If the batch can't be written,
+    its messages are consumed one by one and the ones which still fail
+    are rejected to the dead letter queue instead of being redelivered.
+    """
+    try:
+        consumed = consume_messages(messages)
+    except (DataError, IntegrityError):
+        logger.exception("Stats batch wasn't written, retrying message by message")
+    else:
+        channel.basic_ack(delivery_tag=tags[-1], multiple=True)
+        return consumed
+    consumed = 0
+    for message, tag in zip(messages, tags):
+        try:
+            consumed += consume_messages([message])
+        except (DataError, IntegrityError):
+            logger.exception("Stats message was dead-lettered")
+            metrics.increment("stats.rejected_messages")
+            channel.basic_reject(delivery_tag=tag, requeue=False)
+        else:
+            channel.basic_ack(delivery_tag=tag)
+    return consumed
+
+
+class Command(BaseCommand):
+    help = "Consumes stats events and maintains hourly and daily rollups of pages"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default=settings.CELERY_BROKER_URl)
+        parser.add_argument(
+            "--batch-size", type=int, default=settings.STATS_CONSUMER_BATCH_SIZE
+        )
+        parser.add_argument(
+            "--flush-interval",
+            type=float,
+            default=settings.STATS_CONSUMER_FLUSH_INTERVAL,
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        flush_interval = options["flush_interval"]
+        connection = pika.BlockingConnection(pika.URLParameters(options["url"]))
+        channel = connection.channel()
+        declare_stats_queues(channel, rollups=True)
+        channel.basic_qos(prefetch_count=batch_size)
+        messages = []
+        tags = []
+        flush_at = None
+        try:
+            # Yields (None, None, None) when nothing arrived for flush interval
+            for method, properties, body in channel.consume(
+                STATS_ROLLUP_QUEUE, inactivity_timeout=flush_interval
+            ):
+                if method is not None:
+                    if not messages:
+                        flush_at = time.monotonic() + flush_interval
+                    messages.append(
+                        (body, properties.content_type, get_received_at(properties))
+                    )
+                    tags.append(method.delivery_tag)
+                if messages and (
+                    method is None
+                    or len(messages) >= batch_size
+                    or time.monotonic() >= flush_at
+                ):
+                    consumed = flush(channel, messages, tags)
+                    self.stdout.write(f"Consumed {consumed} stats events")
+                    messages = []
+                    tags = []
+        except KeyboardInterrupt:
+            # Unacknowledged messages are redelivered to the next consumer
+            pass
+        finally:
+            if connection.is_open:
+                connection.close()
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from core.counters import counter_buffer
+from core.models import Notification, Page, Post
+from users.models import User
+
+
+def count_subquery(model, field: str, **filters) -> Coalesce:
+    """Number of rows of model related to the outer row by field"""
+    rows = (
+        model.objects.filter(**{field: OuterRef("pk")}, **filters)
+        .order_by()
+        .values(field)
+        .annotate(total=Count("*"))
+        .values("total")
+    )
+    return Coalesce(Subquery(rows, output_field=IntegerField()), 0)
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalculates denormalized like, follower, reply "
+        "and unread notification counters"
+    )
+
+    def handle(self, *args, **options):
+        counter_buffer.flush()
+        counters = (
+            (Post, "like_count", count_subquery(Post.likes.through, "post")),
+            (Post, "reply_count", count_subquery(Post, "reply_to")),
+            (Page, "follower_count", count_subquery(Page.followers.through, "page")),
+            (
+                User,
+                "unread_notifications",
+                count_subquery(Notification, "user", is_read=False),
+            ),
+        )
+        for model, field, actual in counters:
+            fixed = model.objects.exclude(**{field: actual}).update(**{field: actual})
+            self.stdout.write(f"{model.__name__}.{field}: {fixed} rows fixed")
@@ -2,6 +2,7 @@ from enum import Enum
 
 from django.utils import timezone
 from django.db import models
+from django.db.models import Exists, OuterRef, Q
 
 import uuid
 
@@ -13,6 +14,32 @@ class Tag(models.Model):
         return self.name
 
 
+def blocked_pages_q(prefix: str = "") -> Q:
+    """
+    Q object matching blocked pages, prefix is the lookup path to the page
+    (e.g. "page__" to filter posts). Temporary block lasts until unblock_date
+    or until the owner of the page is unblocked, whatever comes later.
+    """
+    return (
+        Q(**{f"{prefix}permanent_block": True})
+        | Q(**{f"{prefix}unblock_date__gt": timezone.now()})
+        | Q(
+            **{
+                f"{prefix}unblock_date__isnull": False,
+                f"{prefix}owner_blocked": True,
+            }
+        )
+    )
+
+
+class PageQuerySet(models.QuerySet):
+    def blocked(self):
+        return self.filter(blocked_pages_q())
+
+    def unblocked(self):
+        return self.exclude(blocked_pages_q())
+
+
 class Page(models.Model):
     name = models.CharField(max_length=80)
     uuid = models.UUIDField(auto_created=True, unique=True, default=uuid.uuid4)
@@ -37,7 +64,14 @@ class Page(models.Model):
         "users.User", related_name="requests", blank=True
     )
     permanent_block = models.BooleanField(default=False)
-    unblock_date = models.DateTimeField(default=None, null=True, blank=True)
+    unblock_date = models.DateTimeField(
+        default=None, null=True, blank=True, db_index=True
+    )
+    owner_blocked = models.BooleanField(default=False)
+    is_celebrity = models.BooleanField(default=False)
+    follower_count = models.IntegerField(default=0)
+
+    objects = PageQuerySet.as_manager()
 
     @property
     def is_blocked(self):
@@ -45,23 +79,45 @@ class Page(models.Model):
         This property defines whether page is
         still blocked if we set temporary blocking by using
         unblock_date field or whether page
-        must stay blocked because of permanent block
+        must stay blocked because of permanent block.
+        Expired blocks are cleared by clear_expired_blocks task.
         """
-        if self.permanent_block:
-            return True
-        elif self.unblock_date and (
-            self.owner.is_blocked or self.unblock_date > timezone.now()
-        ):
+        return self.get_block_state(
+            self.permanent_block, self.unblock_date, self.owner_blocked
+        )
+
+    @staticmethod
+    def get_block_state(permanent_block, unblock_date, owner_blocked) -> bool:
+        """Block state of the page with given field values"""
+        if permanent_block:
             return True
-        else:
-            self.unblock_date = None
-            self.save()
-            return False
+        return bool(unblock_date) and (owner_blocked or unblock_date > timezone.now())
 
     def __str__(self):
         return self.name
 
 
+class PostQuerySet(models.QuerySet):
+    def visible_to(self, user, page_ids=None):
+        """
+        Posts user can see: posts on public pages, on pages user follows
+        or owns, not including posts on blocked pages. Decided by a single
+        predicate, so lists are read in (created_at, id) index order.
+        Ids of the pages user follows or owns can be passed if they are
+        already known (e.g. cached), then followers aren't looked up.
+        """
+        if page_ids is not None:
+            return self.filter(
+                Q(page__is_private=False) | Q(page_id__in=page_ids)
+            ).exclude(blocked_pages_q("page__"))
+        follows = Page.followers.through.objects.filter(
+            page_id=OuterRef("page_id"), user_id=user.pk
+        )
+        return self.filter(
+            Q(page__is_private=False) | Q(page__owner=user) | Exists(follows)
+        ).exclude(blocked_pages_q("page__"))
+
+
 class Post(models.Model):
     class LikeState(Enum):
         LIKE = "like"
@@ -84,8 +140,174 @@ class Post(models.Model):
     likes = models.ManyToManyField(
         "users.User", related_name="liked_posts", blank=True, default=[]
     )
+    like_count = models.IntegerField(default=0)
+    reply_count = models.IntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = PostQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=("-created_at", "-id"), name="post_created_idx"),
+            models.Index(
+                fields=("page", "-created_at", "-id"), name="post_page_created_idx"
+            ),
+        ]
+
     def __str__(self):
         return f"Post {self.pk} on page {self.page}"
+
+
+class FeedEntry(models.Model):
+    """
+    Materialized newsfeed row. Filled on post creation for every
+    follower of the page, so reading a feed is a single range scan
+    over (user, created_at) instead of a join over followed pages.
+    """
+
+    user = models.ForeignKey(
+        "users.User", on_delete=models.CASCADE, related_name="feed_entries"
+    )
+    post = models.ForeignKey(
+        Post, on_delete=models.CASCADE, related_name="feed_entries"
+    )
+    created_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=("user", "post"), name="unique_feed_entry"),
+        ]
+        indexes = [
+            models.Index(
+                fields=("user", "-created_at", "-post"), name="feed_entry_user_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return f"Post {self.post_id} in feed of user {self.user_id}"
+
+
+class OutboxEvent(models.Model):
+    """
+    Stats event waiting to be published. Written in the same transaction
+    as the change it describes and deleted by the relay once the broker
+    confirms it, so events are neither lost nor sent for rolled back writes.
+    """
+
+    method = models.CharField(max_length=10)
+    body = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Outbox event {self.pk}: {self.body}"
+
+
+class PageStatsRollup(models.Model):
+    """
+    Per page stats events summed over an hour or a day. Filled by the
+    consume_stats command, page_id isn't a foreign key because events
+    of deleted pages still arrive after the page is gone.
+    """
+
+    class Granularity(models.TextChoices):
+        HOUR = "hour"
+        DAY = "day"
+
+    page_id = models.IntegerField()
+    granularity = models.CharField(max_length=4, choices=Granularity.choices)
+    bucket = models.DateTimeField()
+    likes = models.IntegerField(default=0)
+    unlikes = models.IntegerField(default=0)
+    follows = models.IntegerField(default=0)
+    unfollows = models.IntegerField(default=0)
+    posts = models.IntegerField(default=0)
+    deleted_posts = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=("page_id", "granularity", "bucket"),
+                name="unique_page_stats_bucket",
+            ),
+        ]
+
+    def __str__(self):
+        return f"Stats of page {self.page_id} for {self.granularity} {self.bucket}"
+
+
+class ProcessMetrics(models.Model):
+    """
+    Latest metrics snapshot of one web, worker or beat process. Written
+    periodically by every process, so the metrics endpoint can show
+    metrics recorded outside of the web process.
+    """
+
+    process = models.CharField(max_length=100, unique=True)
+    snapshot = models.JSONField()
+    updated_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"Metrics of process {self.process}"
+
+
+class PendingNotification(models.Model):
+    """
+    New post notification of a user who reads them in hourly or daily
+    digest. Rows are removed when the digest is sent.
+    """
+
+    user = models.ForeignKey(
+        "users.User", on_delete=models.CASCADE, related_name="pending_notifications"
+    )
+    post = models.ForeignKey(Post, on_delete=models.CASCADE, related_name="+")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=("user", "post"), name="unique_pending_notification"
+            ),
+        ]
+
+    def __str__(self):
+        return f"Post {self.post_id} for digest of user {self.user_id}"
+
+
+class Notification(models.Model):
+    """
+    In-app notification of a user. Number of unread ones is kept
+    in User.unread_notifications, so it is never counted.
+    """
+
+    class Kind(models.TextChoices):
+        NEW_POST = "new_post"
+        FOLLOW_REQUEST = "follow_request"
+        REQUEST_ACCEPTED = "request_accepted"
+        LIKE = "like"
+
+    user = models.ForeignKey(
+        "users.User", on_delete=models.CASCADE, related_name="notifications"
+    )
+    kind = models.CharField(max_length=16, choices=Kind.choices)
+    actor = models.ForeignKey(
+        "users.User", on_delete=models.CASCADE, null=True, related_name="+"
+    )
+    page = models.ForeignKey(
+        Page, on_delete=models.CASCADE, null=True, related_name="+"
+    )
+    post = models.ForeignKey(
+        Post, on_delete=models.CASCADE, null=True, related_name="+"
+    )
+    is_read = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=("user", "-created_at", "-id"), name="notification_user_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return f"Notification {self.kind} for user {self.user_id}"
@@ -0,0 +1,76 @@
+from typing import List, Optional
+
+from django.db import transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Greatest
+
+from core.models import Notification
+from users.models import User
+
+
+def notify(
+    user_ids: List[int],
+    kind: Notification.Kind,
+    actor_id: Optional[int] = None,
+    page_id: Optional[int] = None,
+    post_id: Optional[int] = None,
+) -> None:
+    """
+    Adds notification to the inboxes of users and increments their
+    unread counters, both in one transaction.
+    """
+    if not user_ids:
+        return
+    with transaction.atomic():
+        Notification.objects.bulk_create(
+            Notification(
+                user_id=user_id,
+                kind=kind,
+                actor_id=actor_id,
+                page_id=page_id,
+                post_id=post_id,
+            )
+            for user_id in user_ids
+        )
+        User.objects.filter(pk__in=user_ids).update(
+            unread_notifications=F("unread_notifications") + 1
+        )
+
+
+def mark_read(user: User, notification_ids: Optional[List[int]] = None) -> int:
+    """
+    Marks notifications of the user (all of them if ids aren't provided)
+    as read and decrements the unread counter. Returns number of marked.
+    """
+    notifications = Notification.objects.filter(user=user, is_read=False)
+    if notification_ids is not None:
+        notifications = notifications.filter(pk__in=notification_ids)
+    with transaction.atomic():
+        marked = notifications.update(is_read=True)
+        if marked:
+            User.objects.filter(pk=user.pk).update(
+                unread_notifications=Greatest(F("unread_notifications") - marked, 0)
+            )
+    return marked
+
+
+def discard_unread(condition: Q) -> int:
+    """
+    Called before notifications matching condition are deleted by a
+    cascade: decrements unread counters of their users in one update.
+    Returns number of updated users.
+    """
+    unread = Notification.objects.filter(condition, is_read=False)
+    counts = (
+        unread.filter(user=OuterRef("pk"))
+        .order_by()
+        .values("user")
+        .annotate(total=Count("*"))
+        .values("total")
+    )
+    return User.objects.filter(pk__in=unread.values("user_id")).update(
+        unread_notifications=Greatest(
+            F("unread_notifications") - Subquery(counts, output_field=IntegerField()),
+            0,
+        )
+    )
@@ -0,0 +1,66 @@
+import time
+
+from celery import shared_task
+from django.db import transaction
+from django.utils import timezone
+
+from core.models import OutboxEvent
+from core.producer import publisher
+from innotter import settings
+from innotter.metrics import metrics
+
+
+def record_event(method: str, body: dict) -> OutboxEvent:
+    """
+    Writes stats event to the outbox, must be called inside the
+    transaction of the change the event is about.
+    """
+    return OutboxEvent.objects.create(method=method, body=body)
+
+
+def get_outbox_lag() -> float:
+    """Age in seconds of the oldest event which hasn't been relayed yet"""
+    oldest = (
+        OutboxEvent.objects.order_by("id").values_list("created_at", flat=True).first()
+    )
+    if oldest is None:
+        return 0.0
+    return max((timezone.now() - oldest).total_seconds(), 0.0)
+
+
+@shared_task
+def relay_outbox() -> int:
+    """
+    Periodic task that publishes outbox events in batches and deletes
+    the confirmed ones. Rows are locked with SKIP LOCKED, so several
+    relays never publish the same event. Relay stops on the first batch
+    that isn't fully confirmed and retries it on the next run.
+    Returns number of relayed events.
+    """
+    relayed = 0
+    for _ in range(settings.OUTBOX_RELAY_MAX_BATCHES):
+        start = time.perf_counter()
+        with transaction.atomic():
+            events = list(
+                OutboxEvent.objects.select_for_update(skip_locked=True).order_by("id")[
+                    : settings.OUTBOX_BATCH_SIZE
+                ]
+            )
+            if not events:
+                break
+            published = publisher.publish_many(
+                [(event.method, event.body) for event in events]
+            )
+            OutboxEvent.objects.filter(
+                pk__in=[event.pk for event in events[:published]]
+            ).delete()
+        metrics.observe("outbox.batch_seconds", time.perf_counter() - start)
+        metrics.observe(
+            "outbox.lag_seconds",
+            (timezone.now() - events[0].created_at).total_seconds(),
+        )
+        metrics.increment("outbox.relayed_events", published)
+        relayed += published
+        if published < len(events):
+            break
+    return relayed
@@ -0,0 +1,249 @@
+import struct
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import BooleanField, Exists, ExpressionWrapper, OuterRef, Q
+from django.utils import timezone
+
+from core.models import Page, blocked_pages_q
+from innotter import settings
+from innotter.metrics import metrics
+
+# generation, version, expires_at, number of followed page ids
+HEADER = struct.Struct("=qqdI")
+
+
+class PageSets(NamedTuple):
+    """
+    Sorted ids of unblocked pages user follows and of unblocked pages
+    user can see besides public ones (followed or owned pages).
+    Generation and version are the global and the user's counters of
+    invalidations read before the sets were loaded.
+    """
+
+    followed: array
+    visible: array
+    expires_at: float
+    generation: int
+    version: int
+
+
+def encode(sets: PageSets) -> bytes:
+    return (
+        HEADER.pack(sets.generation, sets.version, sets.expires_at, len(sets.followed))
+        + sets.followed.tobytes()
+        + sets.visible.tobytes()
+    )
+
+
+def decode(data: bytes) -> PageSets:
+    generation, version, expires_at, count = HEADER.unpack_from(data)
+    ids = array("q")
+    start = HEADER.size
+    ids.frombytes(data[start:])
+    return PageSets(ids[:count], ids[count:], expires_at, generation, version)
+
+
+class LocalBackend:
+    """
+    LRU of page sets kept in the memory of the process. Versions are taken
+    from one counter and kept for the same number of users as entries,
+    users without a version get the last evicted one so it never goes back.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._versions = OrderedDict()
+        self._last_version = 0
+        self._evicted_version = 0
+        self._generation = 0
+
+    def get(self, user_id: int) -> Tuple[Optional[PageSets], int, int]:
+        with self._lock:
+            sets = self._entries.get(user_id)
+            if sets is not None:
+                self._entries.move_to_end(user_id)
+            version = self._versions.get(user_id, self._evicted_version)
+            return sets, self._generation, version
+
+    def set(self, user_id: int, sets: PageSets, timeout: float) -> None:
+        with self._lock:
+            self._entries[user_id] = sets
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def bump_versions(self, user_ids: Iterable[int]) -> None:
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+                self._last_version += 1
+                self._versions[user_id] = self._last_version
+                self._versions.move_to_end(user_id)
+            while len(self._versions) > self.size:
+                _, version = self._versions.popitem(last=False)
+                self._evicted_version = max(self._evicted_version, version)
+
+    def bump_generation(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
+class SharedBackend:
+    """
+    Page sets kept in the Django cache shared by all the processes.
+    Entry, current generation and version of the user are read with
+    a single get_many call.
+    """
+
+    GENERATION_KEY = "page_sets:generation"
+
+    def __init__(self, alias: str):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def key(user_id: int) -> str:
+        return f"page_sets:{user_id}"
+
+    @staticmethod
+    def version_key(user_id: int) -> str:
+        return f"page_sets:version:{user_id}"
+
+    def get(self, user_id: int) -> Tuple[Optional[PageSets], int, int]:
+        key, version_key = self.key(user_id), self.version_key(user_id)
+        values = self.cache.get_many([key, self.GENERATION_KEY, version_key])
+        data = values.get(key)
+        sets = decode(data) if data is not None else None
+        return sets, values.get(self.GENERATION_KEY, 0), values.get(version_key, 0)
+
+    def set(self, user_id: int, sets: PageSets, timeout: float) -> None:
+        self.cache.set(self.key(user_id), encode(sets), timeout)
+
+    def bump_versions(self, user_ids: Iterable[int]) -> None:
+        for user_id in user_ids:
+            version_key = self.version_key(user_id)
+            self.cache.add(version_key, 0, None)
+            self.cache.incr(version_key)
+
+    def bump_generation(self) -> None:
+        self.cache.add(self.GENERATION_KEY, 0, None)
+        self.cache.incr(self.GENERATION_KEY)
+
+    def clear(self) -> None:
+        self.bump_generation()
+
+
+class PageSetCache:
+    """
+    Cache of the pages every user follows and can see, so lists of posts
+    filter by page ids instead of joining followers and pages on every
+    request. Version of a user is bumped when the user follows, unfollows,
+    gets a request accepted or creates a page. Block changes may affect
+    any user, so they bump the generation which makes all the entries stale.
+    Entry is only used while both counters are the ones read before it was
+    loaded, so sets loaded concurrently with a change are never kept.
+    Entry expires after ttl or when a temporary block of one of its pages
+    ends, whatever comes first. Privacy of a page isn't cached, visible
+    pages are the ones user follows or owns regardless of their privacy.
+    """
+
+    def __init__(self, backend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, user) -> PageSets:
+        sets, generation, version = self.backend.get(user.pk)
+        hit = (
+            sets is not None
+            and sets.generation == generation
+            and sets.version == version
+            and sets.expires_at > time.time()
+        )
+        self._count(hit)
+        if hit:
+            return sets
+        sets = self.load(user.pk, generation, version)
+        self.backend.set(user.pk, sets, sets.expires_at - time.time())
+        return sets
+
+    def _count(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+            ratio = self._hits / (self._hits + self._misses)
+        metrics.increment("page_sets.hits" if hit else "page_sets.misses")
+        metrics.gauge("page_sets.hit_ratio", ratio)
+
+    def load(self, user_id: int, generation: int, version: int) -> PageSets:
+        """Reads page sets of the user with a single query"""
+        now = timezone.now()
+        follows = Page.followers.through.objects.filter(
+            page_id=OuterRef("pk"), user_id=user_id
+        )
+        pages = (
+            Page.objects.annotate(
+                followed=Exists(follows),
+                blocked=ExpressionWrapper(
+                    blocked_pages_q(), output_field=BooleanField()
+                ),
+            )
+            .filter(Q(followed=True) | Q(owner_id=user_id))
+            .order_by("id")
+            .values_list("id", "followed", "blocked", "unblock_date")
+        )
+        followed, visible = array("q"), array("q")
+        expires_at = time.time() + self.ttl
+        for page_id, is_followed, is_blocked, unblock_date in pages:
+            if unblock_date is not None and unblock_date > now:
+                expires_at = min(expires_at, unblock_date.timestamp())
+            if is_blocked:
+                continue
+            visible.append(page_id)
+            if is_followed:
+                followed.append(page_id)
+        return PageSets(followed, visible, expires_at, generation, version)
+
+    def invalidate(self, user_ids: Iterable[int]) -> None:
+        """Makes entries of the users stale once the transaction is committed"""
+        user_ids = list(user_ids)
+        transaction.on_commit(lambda: self.backend.bump_versions(user_ids))
+
+    def invalidate_all(self) -> None:
+        """Makes all the entries stale once the transaction is committed"""
+        transaction.on_commit(self.backend.bump_generation)
+
+    def clear(self) -> None:
+        self.backend.clear()
+        with self._lock:
+            self._hits = self._misses = 0
+
+
+def get_backend():
+    if settings.PAGE_SETS_BACKEND == "shared":
+        return SharedBackend(settings.PAGE_SETS_CACHE_ALIAS)
+    return LocalBackend(settings.PAGE_SETS_LOCAL_SIZE)
+
+
+page_sets = PageSetCache(get_backend(), ttl=settings.PAGE_SETS_TTL)
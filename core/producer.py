@@ -1,34 +1,219 @@
-import json
-import logging.config
-import socket
+import atexit
+import logging
+import os
+import queue
+import time
+from typing import List, Optional, Tuple
 
 import pika
+from pika.adapters.blocking_connection import BlockingChannel
+from pika.exceptions import AMQPError
 
-from kombu.exceptions import OperationalError
-
+from core import codec
 from innotter.celery import app
 from innotter import settings
+from innotter.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+STATS_EXCHANGE = "stats.events"
+# Queue read by the external stats microservice
+STATS_QUEUE = "stats"
+# Queue read by the consume_stats command and its dead letters
+STATS_ROLLUP_QUEUE = "stats.rollups"
+STATS_DEAD_LETTER_QUEUE = "stats.rollups.dead"
+
+
+def declare_stats_queues(channel: BlockingChannel, rollups: bool) -> None:
+    """
+    Declares fanout exchange of stats events with the queue of the external
+    stats service bound to it, and the queue of the local consumer with
+    rollups, so each of them receives every event. Messages rejected by the
+    local consumer are dead-lettered to their own queue.
+    """
+    channel.exchange_declare(exchange=STATS_EXCHANGE, exchange_type="fanout")
+    channel.queue_declare(queue=STATS_QUEUE)
+    channel.queue_bind(queue=STATS_QUEUE, exchange=STATS_EXCHANGE)
+    if rollups:
+        channel.queue_declare(queue=STATS_DEAD_LETTER_QUEUE)
+        channel.queue_declare(
+            queue=STATS_ROLLUP_QUEUE,
+            arguments={
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": STATS_DEAD_LETTER_QUEUE,
+            },
+        )
+        channel.queue_bind(queue=STATS_ROLLUP_QUEUE, exchange=STATS_EXCHANGE)
+
+
+class Publisher:
+    """
+    Process-wide RabbitMQ publisher.
+    Keeps a small pool of long-lived connections, each with one channel
+    in confirm mode and the stats queues declared when connection is opened.
+    Broken connections are dropped and reopened on the next publish,
+    after a failed connect no new attempts are made for reconnect_delay
+    seconds, so requests don't wait on connect timeouts while broker is down.
+    Pool is reset in forked children (e.g. Celery prefork workers),
+    connections of the parent process are never used by them.
+    """
+
+    def __init__(
+        self,
+        url: Optional[str],
+        rollups: bool,
+        pool_size: int,
+        retries: int,
+        reconnect_delay: float,
+        encoding: str = "json",
+    ):
+        self.url = url
+        self.rollups = rollups
+        self.pool_size = pool_size
+        self.retries = retries
+        self.reconnect_delay = reconnect_delay
+        self.encoding = encoding
+        self._after_fork()
+
+    def _after_fork(self) -> None:
+        """
+        Forgets connections inherited from the parent process.
+        They aren't closed, closing would send close frames on sockets
+        which are still used by the parent.
+        """
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._retry_at = 0.0
+
+    def _connect(self) -> Tuple[pika.BlockingConnection, BlockingChannel]:
+        if time.monotonic() < self._retry_at:
+            raise AMQPError("Broker is unavailable, reconnect is postponed")
+        try:
+            connection = pika.BlockingConnection(pika.URLParameters(self.url))
+            channel = connection.channel()
+            declare_stats_queues(channel, self.rollups)
+            channel.confirm_delivery()
+        except (AMQPError, OSError):
+            self._retry_at = time.monotonic() + self.reconnect_delay
+            raise
+        metrics.increment("producer.connections_opened")
+        return connection, channel
+
+    def _acquire(self) -> Tuple[pika.BlockingConnection, BlockingChannel]:
+        if self._pid != os.getpid():
+            self._after_fork()
+        while True:
+            try:
+                connection, channel = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if connection.is_open and channel.is_open:
+                try:
+                    # Services heartbeats missed while connection was idle
+                    connection.process_data_events(time_limit=0)
+                    return connection, channel
+                except (AMQPError, OSError):
+                    pass
+            self._discard(connection)
+        return self._connect()
+
+    def _release(self, connection: pika.BlockingConnection, channel) -> None:
+        if self._idle.qsize() < self.pool_size:
+            self._idle.put((connection, channel))
+        else:
+            self._discard(connection)
+
+    def _discard(self, connection: pika.BlockingConnection) -> None:
+        try:
+            if connection.is_open:
+                connection.close()
+        except (AMQPError, OSError):
+            pass
+
+    def publish(self, method: str, body: dict) -> bool:
+        """
+        Publishes message and waits for broker confirmation.
+        Returns whether message was confirmed, errors are logged.
+        """
+        return self.publish_many([(method, body)]) == 1
+
+    def publish_many(self, messages: List[Tuple[str, dict]]) -> int:
+        """
+        Publishes batch of (method, body) events over one pooled channel,
+        events are encoded to one or more messages with the codec.
+        Returns number of confirmed events, they are always a prefix
+        of the batch, so the rest can be published again later.
+        """
+        if not self.url:
+            metrics.increment("producer.publish_failures", len(messages))
+            logger.warning("Broker URL is not configured, messages are dropped")
+            return 0
+        encoded = codec.encode(messages, self.encoding)
+        sent = 0
+        published = 0
+        for _ in range(self.retries + 1):
+            try:
+                connection, channel = self._acquire()
+            except (AMQPError, OSError):
+                logger.info("Could not connect to RabbitMQ server")
+                break
+            try:
+                for payload, content_type, events in encoded[sent:]:
+                    start = time.perf_counter()
+                    channel.basic_publish(
+                        exchange=STATS_EXCHANGE,
+                        routing_key="",
+                        body=payload,
+                        properties=pika.BasicProperties(
+                            content_type, timestamp=int(time.time())
+                        ),
+                    )
+                    sent += 1
+                    published += events
+                    metrics.observe(
+                        "producer.publish_seconds", time.perf_counter() - start
+                    )
+                    metrics.increment("producer.published_bytes", len(payload))
+            except (AMQPError, OSError):
+                self._discard(connection)
+                metrics.increment("producer.publish_retries")
+                continue
+            self._release(connection, channel)
+            break
+        metrics.increment("producer.published", published)
+        if published < len(messages):
+            metrics.increment("producer.publish_failures", len(messages) - published)
+            logger.error("Could not publish messages to RabbitMQ")
+        return published
+
+    def close(self) -> None:
+        """Closes all the idle connections of this process"""
+        if self._pid != os.getpid():
+            return
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(connection)
+
+
+publisher = Publisher(
+    url=settings.CELERY_BROKER_URl,
+    # Rollup queue is declared by the publisher too, so no events are lost
+    # before the consumer starts for the first time
+    rollups=settings.STATS_BACKEND == "local",
+    pool_size=settings.PRODUCER_POOL_SIZE,
+    retries=settings.PRODUCER_PUBLISH_RETRIES,
+    reconnect_delay=settings.PRODUCER_RECONNECT_DELAY,
+    encoding=settings.STATS_EVENT_ENCODING,
+)
+os.register_at_fork(after_in_child=publisher._after_fork)
+atexit.register(publisher.close)
 
 
 @app.task(name="produce")
 def produce(method, body):
     """Sending message to RabbitMQ for stats microservice to consume"""
-    try:
-        # Setting up connection with RabbitMQ server
-        # Creating new queue for message exchange
-        params = pika.URLParameters(settings.CELERY_BROKER_URl)
-        connection = pika.BlockingConnection(params)
-        channel = connection.channel()
-        channel.queue_declare(queue="stats")
-        properties = pika.BasicProperties(method)
-
-        channel.basic_publish(
-            exchange="",
-            routing_key="stats",
-            body=json.dumps(body),
-            properties=properties,
-        )
-
-        logging.info("Successfully published")
-    except (OperationalError, socket.gaierror, Exception):
-        logging.info("Could not connect to RabbitMQ server")
+    if publisher.publish(method, body):
+        logger.info("Successfully published")
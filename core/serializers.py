@@ -4,11 +4,17 @@ from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 from core.services import get_tag_set_for_page
-from users.serializers import UserSerializer
-from core.models import Page, Tag, Post
+from innotter.permissions import get_permission_context
+from innotter.serializers import (
+    BatchListSerializer,
+    DynamicFieldsMixin,
+    ValuesSerializer,
+)
+from users.serializers import UserShortSerializer
+from core.models import Notification, Page, Tag, Post
 
 
-class TagSerializer(serializers.ModelSerializer):
+class TagSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     """Tag model serializer"""
 
     name = serializers.CharField(max_length=30, required=True)
@@ -16,9 +22,10 @@ class TagSerializer(serializers.ModelSerializer):
     class Meta:
         model = Tag
         fields = "__all__"
+        list_serializer_class = BatchListSerializer
 
 
-class PageSerializer(serializers.ModelSerializer):
+class PageSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     """Page model serializer"""
 
     name = serializers.CharField(max_length=80, required=True)
@@ -26,7 +33,7 @@ class PageSerializer(serializers.ModelSerializer):
     description = serializers.CharField(allow_null=False)
     tags = TagSerializer(many=True, required=False)
     owner = serializers.HiddenField(default=serializers.CurrentUserDefault())
-    followers = UserSerializer(many=True, read_only=True)
+    followers = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
     image = serializers.ImageField(
         allow_null=True,
         required=False,
@@ -37,14 +44,22 @@ class PageSerializer(serializers.ModelSerializer):
         ],
     )
     is_private = serializers.BooleanField(required=True)
-    follow_requests = UserSerializer(read_only=True, many=True)
+    follower_count = serializers.IntegerField(read_only=True)
+    follow_requests = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
     permanent_block = serializers.BooleanField(read_only=True)
     unblock_date = serializers.DateTimeField(read_only=True, required=False)
+    owner_blocked = serializers.BooleanField(read_only=True)
     is_blocked = serializers.ReadOnlyField()
+    is_celebrity = serializers.BooleanField(read_only=True)
 
     class Meta:
         model = Page
         fields = "__all__"
+        list_serializer_class = BatchListSerializer
+        expandable_fields = {
+            "followers": (UserShortSerializer, {"many": True}),
+            "follow_requests": (UserShortSerializer, {"many": True}),
+        }
 
     def create(self, validated_data):
         """
@@ -86,7 +101,15 @@ class BlockPageSerializer(serializers.ModelSerializer):
         return attrs
 
 
-class PostSerializer(serializers.ModelSerializer):
+class FollowRequestsSerializer(serializers.Serializer):
+    """Ids of users whose follow requests are accepted or declined"""
+
+    user_ids = serializers.ListField(
+        child=serializers.IntegerField(), required=False, allow_empty=False
+    )
+
+
+class PostSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     """Post model serializer"""
 
     subject = serializers.CharField(required=True, max_length=200)
@@ -95,26 +118,26 @@ class PostSerializer(serializers.ModelSerializer):
     reply_to = serializers.PrimaryKeyRelatedField(
         queryset=Post.objects.all(), required=False, allow_empty=True
     )
-    likes = UserSerializer(
-        many=True,
-        default=None,
-        read_only=True,
-        allow_null=True
-    )
+    likes = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+    like_count = serializers.IntegerField(read_only=True)
+    reply_count = serializers.IntegerField(read_only=True)
     created_at = serializers.DateTimeField(read_only=True)
     updated_at = serializers.DateTimeField(read_only=True)
 
     class Meta:
         model = Post
         fields = "__all__"
+        list_serializer_class = BatchListSerializer
         partial = True
+        expandable_fields = {
+            "likes": (UserShortSerializer, {"many": True}),
+        }
 
     def validate(self, attrs):
         """Checking if user has access to chosen page"""
-        request = self.context.get("request")
-        user = request.user
+        context = get_permission_context(self.context.get("request"))
         page = attrs.get("page")
-        if page not in user.pages.all() or page.is_blocked:
+        if page is None or not context.owns_page(page.pk) or page.is_blocked:
             raise serializers.ValidationError(
                 {
                     "detail":
@@ -122,3 +145,41 @@ class PostSerializer(serializers.ModelSerializer):
                 }
             )
         return attrs
+
+
+class ThreadPostSerializer(PostSerializer):
+    """Post serializer for flattened reply trees"""
+
+    depth = serializers.IntegerField(read_only=True)
+
+
+class NotificationSerializer(serializers.ModelSerializer):
+    """Notification model serializer"""
+
+    class Meta:
+        model = Notification
+        fields = ("id", "kind", "actor", "page", "post", "is_read", "created_at")
+        read_only_fields = fields
+        list_serializer_class = BatchListSerializer
+
+
+class ReadNotificationsSerializer(serializers.Serializer):
+    """Ids of notifications marked as read, all of them if not provided"""
+
+    ids = serializers.ListField(
+        child=serializers.IntegerField(), required=False, allow_empty=False
+    )
+
+
+# Fast path of the list endpoints, see ValuesListMixin
+tag_values = ValuesSerializer(TagSerializer)
+page_values = ValuesSerializer(
+    PageSerializer,
+    computed={
+        "is_blocked": (
+            ("permanent_block", "unblock_date", "owner_blocked"),
+            Page.get_block_state,
+        )
+    },
+)
+post_values = ValuesSerializer(PostSerializer)
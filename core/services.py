@@ -1,33 +1,93 @@
-from typing import List
+from typing import List, Optional
 
-from rest_framework.status import HTTP_409_CONFLICT, HTTP_200_OK
+from django.db import connection, transaction
+from django.db.models import QuerySet
+from rest_framework.status import HTTP_409_CONFLICT, HTTP_200_OK, HTTP_404_NOT_FOUND
 from rest_framework.response import Response
 import jwt
 
 from innotter import settings
-from core.models import Page, Post, Tag
-from core.producer import produce
+from core.feed_services import backfill_feed, dispatch_backfill, remove_page_from_feed
+from core.counters import counter_buffer
+from core.emitter import event_emitter
+from core.live import likes_changed, page_access_revoked
+from core.models import Notification, Page, Post, Tag
+from core.notification_services import notify
+from core.page_sets import page_sets
 from users.models import User
 
 
-def accept_request(page: Page, target_user: User) -> None:
-    """Accept single user request to follow other user's page"""
-    page.follow_requests.remove(target_user)
-    page.followers.add(target_user)
-    produce(method="PUT", body=dict(page_id=page.pk, action="follow"))
+def add_relation(relation, owner_id: int, user_id: int) -> bool:
+    """
+    Inserts row to the table of many-to-many relation (e.g. Page.followers)
+    unless it already exists. Returns whether the row was inserted.
+    """
+    field = relation.field
+    query = (
+        f"INSERT INTO {relation.through._meta.db_table} "
+        f"({field.m2m_column_name()}, {field.m2m_reverse_name()}) "
+        "VALUES (%s, %s) ON CONFLICT DO NOTHING RETURNING 1"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(query, [owner_id, user_id])
+        return cursor.fetchone() is not None
+
+
+def remove_relation(relation, owner_id: int, user_id: int) -> bool:
+    """Deletes row of many-to-many relation, returns whether it existed"""
+    field = relation.field
+    removed, _ = relation.through.objects.filter(
+        **{field.m2m_column_name(): owner_id, field.m2m_reverse_name(): user_id}
+    ).delete()
+    return bool(removed)
+
+
+def has_relation(relation, owner_id: int, user_id: int) -> bool:
+    """Checks row of many-to-many relation by its unique index"""
+    field = relation.field
+    return relation.through.objects.filter(
+        **{field.m2m_column_name(): owner_id, field.m2m_reverse_name(): user_id}
+    ).exists()
 
 
-def accept_all_requests(page: Page) -> None:
-    """Accept all users' requests to follow a page"""
-    [accept_request(page, user) for user in page.follow_requests.all()]
+ACCEPT_REQUESTS_QUERY = """
+    WITH accepted AS (
+        DELETE FROM {requests}
+        WHERE page_id = %s {user_filter}
+        RETURNING user_id
+    )
+    INSERT INTO {followers} (page_id, user_id)
+    SELECT %s, user_id FROM accepted
+    ON CONFLICT DO NOTHING
+    RETURNING user_id
+"""
 
 
-def decline_all_requests(page: Page) -> None:
-    """Decline all users' requests to follow a page"""
-    [page.follow_requests.remove(user) for user in page.follow_requests.all()]
+def move_requests_to_followers(
+    page: Page, user_ids: Optional[List[int]] = None
+) -> List[int]:
+    """
+    Moves follow requests of users with given ids (all the requests if
+    ids aren't provided) to followers with one set-based statement.
+    Returns ids of users who became followers.
+    """
+    params = [page.pk]
+    user_filter = ""
+    if user_ids is not None:
+        user_filter = "AND user_id = ANY(%s)"
+        params.append(list(user_ids))
+    params.append(page.pk)
+    query = ACCEPT_REQUESTS_QUERY.format(
+        requests=Page.follow_requests.through._meta.db_table,
+        followers=Page.followers.through._meta.db_table,
+        user_filter=user_filter,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        return [user_id for (user_id,) in cursor.fetchall()]
 
 
-def get_posts(cur_user: User) -> List[Post]:
+def get_posts(cur_user: User) -> QuerySet:
     """
     Get post list not including posts on blocked pages
     and posts on private pages current user isn't subscribed on.
@@ -35,105 +95,227 @@ def get_posts(cur_user: User) -> List[Post]:
     if cur_user.is_staff:
         return Post.objects.all()
     else:
-        pages = (
-            Page.objects.select_related("posts").filter(is_private=False)
-            ^ cur_user.follows.all()
+        return Post.objects.select_related("page").visible_to(
+            cur_user, page_ids=page_sets.get(cur_user).visible
+        )
+
+
+THREAD_QUERY = """
+    WITH RECURSIVE thread AS (
+        SELECT id, 0 AS depth, ARRAY[id] AS path
+        FROM core_post
+        WHERE id = %s
+        UNION ALL
+        SELECT id, depth, path
+        FROM (
+            SELECT reply.id, thread.depth + 1 AS depth, thread.path || reply.id AS path,
+                ROW_NUMBER() OVER (
+                    PARTITION BY reply.reply_to_id ORDER BY reply.id
+                ) AS position
+            FROM core_post AS reply
+            JOIN thread ON reply.reply_to_id = thread.id
+            WHERE thread.depth < %s
+        ) AS replies
+        WHERE position <= %s
+    )
+    SELECT core_post.*, thread.depth, thread.path
+    FROM thread
+    JOIN core_post ON core_post.id = thread.id
+    {visibility}
+    ORDER BY thread.path
+    LIMIT %s
+"""
+
+
+def get_thread(post: Post, cur_user: User, depth: int, breadth: int) -> List[Post]:
+    """
+    Loads reply tree of the post with a single recursive query.
+    Returns flattened tree in depth-first order, each post has depth
+    attribute, at most breadth replies are loaded for every post.
+    Replies user can't see are left out together with their subtrees.
+    """
+    params = [post.pk, depth, breadth]
+    visibility = ""
+    if not cur_user.is_staff:
+        visible_sql, visible_params = (
+            Post.objects.visible_to(cur_user, page_ids=page_sets.get(cur_user).visible)
+            .values("id")
+            .query.sql_with_params()
         )
-        return Post.objects.select_related("page").filter(page__in=pages)
+        visibility = f"WHERE core_post.id IN ({visible_sql})"
+        params.extend(visible_params)
+    params.append(settings.THREAD_MAX_NODES)
+    nodes = list(Post.objects.raw(THREAD_QUERY.format(visibility=visibility), params))
+    loaded = {node.pk for node in nodes}
+    return [node for node in nodes if loaded.issuperset(node.path)]
 
 
 def like_unlike(cur_user: User, post: Post, if_like: Post.LikeState) -> Response:
     """Like or remove your like from the post if you already liked it"""
     if if_like == Post.LikeState.LIKE:
-        post.likes.add(cur_user)
-        produce(method="GET", body=dict(page_id=post.page.pk, action="like"))
+        if add_relation(Post.likes, post.pk, cur_user.pk):
+            counter_buffer.add(Post, post.pk, "like_count", 1)
+            likes_changed(post.pk, 1)
+            owner_id = Page.objects.values_list("owner_id", flat=True).get(
+                pk=post.page_id
+            )
+            if owner_id != cur_user.pk:
+                notify(
+                    [owner_id],
+                    Notification.Kind.LIKE,
+                    actor_id=cur_user.pk,
+                    page_id=post.page_id,
+                    post_id=post.pk,
+                )
+        event_emitter.emit(method="GET", body=dict(page_id=post.page_id, action="like"))
         return Response(
             data={"response": "Post was added to your liked posts"}, status=HTTP_200_OK
         )
     elif if_like == Post.LikeState.UNLIKE:
-        post.likes.remove(cur_user)
-        produce(method="GET", body=dict(page_id=post.page.pk, action="unlike"))
+        if remove_relation(Post.likes, post.pk, cur_user.pk):
+            counter_buffer.add(Post, post.pk, "like_count", -1)
+            likes_changed(post.pk, -1)
+        event_emitter.emit(
+            method="GET", body=dict(page_id=post.page_id, action="unlike")
+        )
         return Response(
             data={"response": "Post was removed from your liked posts"},
             status=HTTP_200_OK,
         )
 
 
-def follow_or_unfollow_page(cur_user: User, page: Page) -> Response:
+def follow_page(cur_user: User, page: Page) -> Response:
     """
-    Service that adds/removes user to/from page followers or
-    sends follow request if page is private.
+    Idempotent service that adds user to page followers
+    or sends follow request if page is private.
     """
-    if page in cur_user.pages.all():
+    if page.owner_id == cur_user.pk:
         return Response(
             {"response": "You're trying to follow your own page"},
             status=HTTP_409_CONFLICT,
         )
-
-    if cur_user not in page.followers.all():
-        if not page.is_private:
-            page.followers.add(cur_user)
-            produce(method="PUT", body=dict(page_id=page.pk, action="follow"))
-            return Response(
-                {"response": "Now you follow this page."},
-                status=HTTP_200_OK,
+    if not page.is_private:
+        if add_relation(Page.followers, page.pk, cur_user.pk):
+            counter_buffer.add(Page, page.pk, "follower_count", 1)
+            page_sets.invalidate([cur_user.pk])
+            backfill_feed([cur_user.pk], page)
+            event_emitter.emit(
+                method="PUT", body=dict(page_id=page.pk, action="follow")
             )
-        else:
-            page.follow_requests.add(cur_user)
-            return Response(
-                {"response": "Owner of the page will review your request."},
-                status=HTTP_200_OK,
-            )
-    else:
-        page.followers.remove(cur_user)
-        produce(method="PUT", body=dict(page_id=page.pk, action="unfollow"))
         return Response(
-            {"response": "You're successfully unsubscribed."},
+            {"response": "Now you follow this page."},
             status=HTTP_200_OK,
         )
+    if has_relation(Page.followers, page.pk, cur_user.pk):
+        return Response(
+            {"response": "You already follow this page."},
+            status=HTTP_200_OK,
+        )
+    if add_relation(Page.follow_requests, page.pk, cur_user.pk):
+        notify(
+            [page.owner_id],
+            Notification.Kind.FOLLOW_REQUEST,
+            actor_id=cur_user.pk,
+            page_id=page.pk,
+        )
+    return Response(
+        {"response": "Owner of the page will review your request."},
+        status=HTTP_200_OK,
+    )
+
+
+def unfollow_page(cur_user: User, page: Page) -> Response:
+    """Idempotent service that removes user from page followers"""
+    if remove_relation(Page.followers, page.pk, cur_user.pk):
+        counter_buffer.add(Page, page.pk, "follower_count", -1)
+        page_sets.invalidate([cur_user.pk])
+        remove_page_from_feed(cur_user.pk, page)
+        page_access_revoked([page.pk], [cur_user.pk])
+        event_emitter.emit(method="PUT", body=dict(page_id=page.pk, action="unfollow"))
+    else:
+        remove_relation(Page.follow_requests, page.pk, cur_user.pk)
+    return Response(
+        {"response": "You're successfully unsubscribed."},
+        status=HTTP_200_OK,
+    )
+
+
+def follow_or_unfollow_page(cur_user: User, page: Page) -> Response:
+    """
+    Service that adds/removes user to/from page followers or
+    sends follow request if page is private.
+    """
+    if has_relation(Page.followers, page.pk, cur_user.pk):
+        return unfollow_page(cur_user, page)
+    return follow_page(cur_user, page)
 
 
-def decline_requests(page: Page, user: User = None) -> Response:
+def decline_requests(page: Page, user_ids: Optional[List[int]] = None) -> Response:
     """
-    Service that accepts declines request if follower id is provided.
+    Service that declines requests of users with provided ids.
     Otherwise, declines all requests for certain page.
     """
-    if user in page.followers.all():
+    follow_requests = Page.follow_requests.through.objects.filter(page=page)
+    if user_ids is None:
+        follow_requests.delete()
         return Response(
-            {"response": "User already follows you"}, status=HTTP_409_CONFLICT
+            {"response": "All requests have been declined"}, status=HTTP_200_OK
         )
-    if user in page.follow_requests.all():
-        page.follow_requests.remove(user)
-        return Response({"response": "Request has been declined"}, status=HTTP_200_OK)
-    else:
-        decline_all_requests(page)
+    declined, _ = follow_requests.filter(user_id__in=user_ids).delete()
+    if not declined and page.followers.filter(pk__in=user_ids).exists():
         return Response(
-            {"response": "All requests have been declined"}, status=HTTP_200_OK
+            {"response": "User already follows you"}, status=HTTP_409_CONFLICT
         )
+    if not declined:
+        return Response({"response": "Request not found"}, status=HTTP_404_NOT_FOUND)
+    return Response(
+        {"response": "Request has been declined", "declined": declined},
+        status=HTTP_200_OK,
+    )
 
 
-def accept_requests(page: Page, user: User = None) -> Response:
+def accept_requests(page: Page, user_ids: Optional[List[int]] = None) -> Response:
     """
-    Service that accepts certain request if follower id is provided.
-    Otherwise, accepts all requests for certain page
+    Service that accepts requests of users with provided ids.
+    Otherwise, accepts all requests for certain page.
+    Requests are moved in one transaction and a single "follow"
+    event with the number of new followers is sent.
     """
-    if not user:
-        accept_all_requests(page)
+    with transaction.atomic():
+        accepted = move_requests_to_followers(page, user_ids)
+        if accepted:
+            page_sets.invalidate(accepted)
+            notify(
+                accepted,
+                Notification.Kind.REQUEST_ACCEPTED,
+                actor_id=page.owner_id,
+                page_id=page.pk,
+            )
+            transaction.on_commit(
+                lambda: event_emitter.emit(
+                    method="PUT",
+                    body=dict(page_id=page.pk, action="follow", count=len(accepted)),
+                )
+            )
+            transaction.on_commit(lambda: dispatch_backfill(page.pk, accepted))
+    if accepted:
+        counter_buffer.add(Page, page.pk, "follower_count", len(accepted))
+    if user_ids is None:
         return Response(
-            {"response": "All requests have been accepted"},
+            {"response": "All requests have been accepted", "accepted": len(accepted)},
             status=HTTP_200_OK,
         )
-    elif user in page.followers.all():
+    if not accepted and page.followers.filter(pk__in=user_ids).exists():
         return Response(
             {"response": "User already follows you."},
             status=HTTP_409_CONFLICT,
         )
-    elif user in page.follow_requests.all():
-        accept_request(page, user)
-        return Response(
-            {"response": "Request has been accepted"},
-            status=HTTP_200_OK,
-        )
+    if not accepted:
+        return Response({"response": "Request not found"}, status=HTTP_404_NOT_FOUND)
+    return Response(
+        {"response": "Request has been accepted", "accepted": len(accepted)},
+        status=HTTP_200_OK,
+    )
 
 
 def get_tag_set_for_page(tags: List[dict]) -> List[Tag]:
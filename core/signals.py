@@ -0,0 +1,42 @@
+from django.db.models import Q
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+
+from core.models import Page, Post
+from core.notification_services import discard_unread
+from users.models import User
+
+
+def is_deleted_directly(instance, origin) -> bool:
+    """
+    Whether instance is deleted by its own delete() or by delete() of a
+    queryset of its model, not by a cascade. Notifications of cascades are
+    discarded in one call by the receiver of the origin.
+    """
+    return origin is instance or getattr(origin, "model", None) is type(instance)
+
+
+@receiver(pre_delete, sender=Post)
+def discard_post_notifications(sender, instance: Post, origin=None, **kwargs) -> None:
+    """Unread notifications about the post are removed with it"""
+    if is_deleted_directly(instance, origin):
+        discard_unread(Q(post=instance))
+
+
+@receiver(pre_delete, sender=Page)
+def discard_page_notifications(sender, instance: Page, origin=None, **kwargs) -> None:
+    """Unread notifications about the page and its posts are removed with it"""
+    if is_deleted_directly(instance, origin):
+        discard_unread(Q(page=instance) | Q(post__page=instance))
+
+
+@receiver(pre_delete, sender=User)
+def discard_user_notifications(sender, instance: User, origin=None, **kwargs) -> None:
+    """
+    Unread notifications about actions of the user, about the user's pages
+    and their posts are removed with the user
+    """
+    if is_deleted_directly(instance, origin):
+        discard_unread(
+            Q(actor=instance) | Q(page__owner=instance) | Q(post__page__owner=instance)
+        )
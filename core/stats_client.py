@@ -0,0 +1,184 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import FrozenSet, Iterable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from core.services import get_access_token
+from innotter import settings
+from innotter.metrics import metrics
+
+
+class StatsUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Stats service is unavailable, try again later."
+    default_code = "stats_unavailable"
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and rejects calls
+    for reset_timeout seconds, then lets a single trial call through.
+    Successful trial closes the circuit, failed one opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._trial = False
+                metrics.increment("stats_client.circuit_opened")
+
+
+class _Call:
+    """Request in flight, shared by all the callers asking for the same key"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class StatsClient:
+    """
+    Client of the stats microservice.
+    Requests go through a pooled session with connect and read timeouts
+    and a circuit breaker. Responses are cached for cache_ttl seconds per
+    set of page ids, concurrent callers asking for the same set wait for
+    a single request instead of sending their own (single-flight).
+    """
+
+    def __init__(
+        self,
+        url: Optional[str],
+        timeout: tuple,
+        pool_size: int,
+        cache_ttl: float,
+        cache_size: int,
+        breaker: CircuitBreaker,
+    ):
+        self.url = url
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.breaker = breaker
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._calls = {}
+        self._pid = None
+        self._session = None
+
+    @property
+    def session(self) -> requests.Session:
+        """Session is created per process, sockets of the parent aren't reused"""
+        if self._pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.pool_size, max_retries=0
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session, self._pid = session, os.getpid()
+        return self._session
+
+    def get_pages_stats(self, page_ids: Iterable[int]) -> dict:
+        """Stats of the pages, raises StatsUnavailable if service can't answer"""
+        key = frozenset(page_ids)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] > time.monotonic():
+                self._cache.move_to_end(key)
+                metrics.increment("stats_client.cache_hits")
+                return cached[1]
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            metrics.increment("stats_client.shared_calls")
+            if not call.done.wait(sum(self.timeout)):
+                raise StatsUnavailable()
+        else:
+            try:
+                call.result = self._fetch(key)
+            except Exception as error:
+                call.error = error
+                raise
+            finally:
+                with self._lock:
+                    if call.result is not None:
+                        self._store(key, call.result)
+                    del self._calls[key]
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _store(self, key: FrozenSet[int], result: dict) -> None:
+        self._cache[key] = (time.monotonic() + self.cache_ttl, result)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _fetch(self, key: FrozenSet[int]) -> dict:
+        metrics.increment("stats_client.cache_misses")
+        if not self.breaker.allow():
+            metrics.increment("stats_client.rejected_calls")
+            raise StatsUnavailable()
+        headers = {"token": get_access_token({"pages_ids": sorted(key)})}
+        start = time.perf_counter()
+        try:
+            response = self.session.get(self.url, headers=headers, timeout=self.timeout)
+            response.raise_for_status()
+            result = response.json()
+        except (requests.RequestException, ValueError):
+            self.breaker.record_failure()
+            metrics.increment("stats_client.failed_calls")
+            raise StatsUnavailable()
+        finally:
+            metrics.observe("stats_client.call_seconds", time.perf_counter() - start)
+        self.breaker.record_success()
+        return result
+
+
+stats_client = StatsClient(
+    url=settings.STATS_MICROSERVICE_URL,
+    timeout=(settings.STATS_CLIENT_CONNECT_TIMEOUT, settings.STATS_CLIENT_READ_TIMEOUT),
+    pool_size=settings.STATS_CLIENT_POOL_SIZE,
+    cache_ttl=settings.STATS_CLIENT_CACHE_TTL,
+    cache_size=settings.STATS_CLIENT_CACHE_SIZE,
+    breaker=CircuitBreaker(
+        failure_threshold=settings.STATS_CLIENT_FAILURE_THRESHOLD,
+        reset_timeout=settings.STATS_CLIENT_RESET_TIMEOUT,
+    ),
+)
@@ -0,0 +1,131 @@
+import logging
+import struct
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Tuple
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from core import codec
+from core.models import PageStatsRollup
+from innotter.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Stats event action to the rollup column it is counted in
+ROLLUP_FIELDS = {
+    "like": "likes",
+    "unlike": "unlikes",
+    "follow": "follows",
+    "unfollow": "unfollows",
+    "post_created": "posts",
+    "post_deleted": "deleted_posts",
+}
+COLUMNS = ("likes", "unlikes", "follows", "unfollows", "posts", "deleted_posts")
+
+UPSERT_ROLLUPS_QUERY = """
+    INSERT INTO {table} (page_id, granularity, bucket, {columns})
+    VALUES {values}
+    ON CONFLICT (page_id, granularity, bucket)
+    DO UPDATE SET {updates}
+"""
+
+RollupKey = Tuple[int, str, datetime]
+
+
+def get_bucket(moment: datetime, granularity: str) -> datetime:
+    """Start of the hour or the day the moment belongs to"""
+    bucket = moment.replace(minute=0, second=0, microsecond=0)
+    if granularity == PageStatsRollup.Granularity.DAY:
+        bucket = bucket.replace(hour=0)
+    return bucket
+
+
+def aggregate_events(
+    events: Iterable[Tuple[dict, datetime]]
+) -> Dict[RollupKey, Counter]:
+    """
+    Sums counts of (body, received_at) stats events per page, granularity
+    and bucket. Events of actions without rollup column are skipped.
+    """
+    rollups = defaultdict(Counter)
+    for body, received_at in events:
+        column = ROLLUP_FIELDS.get(body["action"])
+        if column is None:
+            continue
+        for granularity in PageStatsRollup.Granularity.values:
+            key = (body["page_id"], granularity, get_bucket(received_at, granularity))
+            rollups[key][column] += body.get("count", 1)
+    return rollups
+
+
+def upsert_rollups(rollups: Dict[RollupKey, Counter]) -> None:
+    """Adds aggregated counts to the rollup rows with one INSERT ... ON CONFLICT"""
+    if not rollups:
+        return
+    params = []
+    for (page_id, granularity, bucket), counts in rollups.items():
+        params.extend([page_id, granularity, bucket])
+        params.extend(counts[column] for column in COLUMNS)
+    row = f"({', '.join(['%s'] * (3 + len(COLUMNS)))})"
+    query = UPSERT_ROLLUPS_QUERY.format(
+        table=PageStatsRollup._meta.db_table,
+        columns=", ".join(COLUMNS),
+        values=", ".join([row] * len(rollups)),
+        updates=", ".join(
+            f"{column} = {PageStatsRollup._meta.db_table}.{column} + EXCLUDED.{column}"
+            for column in COLUMNS
+        ),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+
+
+def consume_messages(messages: List[Tuple[bytes, str, datetime]]) -> int:
+    """
+    Decodes batch of (payload, content type, received_at) stats messages
+    and adds them to the rollups in one transaction. Messages which can't
+    be decoded are logged and skipped. Returns number of consumed events.
+    """
+    events = []
+    for payload, content_type, received_at in messages:
+        try:
+            decoded = codec.decode(payload, content_type)
+        except (ValueError, struct.error):
+            logger.exception("Could not decode stats message")
+            metrics.increment("stats.rejected_messages")
+            continue
+        events.extend((body, received_at) for _, body in decoded)
+    with metrics.timer("stats.upsert_seconds"), transaction.atomic():
+        upsert_rollups(aggregate_events(events))
+    metrics.increment("stats.consumed_events", len(events))
+    return len(events)
+
+
+def get_pages_stats(page_ids: List[int], granularity: str, buckets: int) -> dict:
+    """
+    Stats of the pages over the last buckets hours or days:
+    totals and per bucket counts of every page, oldest bucket first.
+    """
+    step = timedelta(hours=1)
+    if granularity == PageStatsRollup.Granularity.DAY:
+        step = timedelta(days=1)
+    since = get_bucket(timezone.now(), granularity) - step * (buckets - 1)
+    rows = (
+        PageStatsRollup.objects.filter(
+            page_id__in=page_ids, granularity=granularity, bucket__gte=since
+        )
+        .order_by("page_id", "bucket")
+        .values("page_id", "bucket", *COLUMNS)
+    )
+    stats = {
+        page_id: {"totals": dict.fromkeys(COLUMNS, 0), "buckets": []}
+        for page_id in page_ids
+    }
+    for row in rows:
+        page_stats = stats[row.pop("page_id")]
+        for column in COLUMNS:
+            page_stats["totals"][column] += row[column]
+        page_stats["buckets"].append(row)
+    return stats
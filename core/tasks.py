@@ -0,0 +1,34 @@
+import logging
+
+from celery import shared_task
+from django.utils import timezone
+
+from core.models import Page
+
+# Tasks defined next to the services that use them are imported here,
+# so they are registered by workers through tasks autodiscovery
+from core.email_services import (  # noqa: F401
+    send_digest_chunk,
+    send_new_post_notification_email,
+    send_notification_digests,
+    send_notification_email_chunk,
+)
+from core.feed_services import (  # noqa: F401
+    backfill_feed_chunk,
+    fan_out_post,
+    fan_out_post_chunk,
+)
+from core.outbox_services import relay_outbox  # noqa: F401
+from core.producer import produce  # noqa: F401
+
+
+@shared_task
+def clear_expired_blocks() -> None:
+    """
+    Periodic task that removes expired temporary blocks in bulk.
+    Pages of blocked owners stay blocked until the owner is unblocked.
+    """
+    cleared = Page.objects.filter(
+        unblock_date__lte=timezone.now(), owner_blocked=False
+    ).update(unblock_date=None)
+    logging.info(f"Expired blocks cleared: {cleared}")
@@ -7,6 +7,8 @@ from core.views import (
     NewsFeedViewSet,
     BlockPageViewSet,
     GetMyPagesViewSet,
+    MetricsViewSet,
+    NotificationViewSet,
 )
 
 router = SimpleRouter()
@@ -16,6 +18,8 @@ router.register(r"tags", viewset=TagListViewSet, basename="Tags")
 router.register(r"newsfeed", viewset=NewsFeedViewSet, basename="Posts")
 router.register("block-page", viewset=BlockPageViewSet, basename="BlockPages")
 router.register("get_my_pages", viewset=GetMyPagesViewSet, basename="get_my_pages")
+router.register("metrics", viewset=MetricsViewSet, basename="metrics")
+router.register("notifications", viewset=NotificationViewSet, basename="notifications")
 
 app_name = "core"
 urlpatterns = [
@@ -1,10 +1,12 @@
-import requests
+from typing import List, Optional
 
 from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.viewsets import GenericViewSet
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework import status
 
@@ -17,35 +19,57 @@ from rest_framework.mixins import (
 )
 
 from core.email_services import send_new_post_notification_email
+from core.counters import counter_buffer
+from core.feed_services import assemble_feed, fan_out_post, get_followed_posts
+from core.live import page_access_revoked, post_published
+from core.outbox_services import get_outbox_lag, record_event
+from core.page_sets import page_sets
+from core.stats_client import stats_client
+from core.stats_services import get_pages_stats
+from users.authentication import principal_cache
 from users.serializers import UserSerializer
-from core.models import Page, Tag, Post
-from core.producer import produce
+from core.models import Page, PageStatsRollup, Tag, Post
+from core.notification_services import mark_read
+from innotter.pagination import CreatedAtCursorPagination
+from innotter.serializers import ValuesListMixin, prefetch_shape
+from innotter.metrics import metrics
 from innotter import settings
-from users.models import User
 
 
 from core.serializers import (
+    FollowRequestsSerializer,
     BlockPageSerializer,
+    NotificationSerializer,
+    ReadNotificationsSerializer,
     PageSerializer,
     PostSerializer,
     TagSerializer,
+    ThreadPostSerializer,
+    page_values,
+    post_values,
+    tag_values,
 )
 from core.services import (
     follow_or_unfollow_page,
+    unfollow_page,
+    follow_page,
     decline_requests,
-    get_access_token,
     accept_requests,
     like_unlike,
     get_posts,
+    get_thread,
 )
 from innotter.permissions import (
     PostIsOwnerAdminModerOrReadOnly,
     IsAdminOrModer,
+    IsAdmin,
     IsOwner,
+    get_permission_context,
 )
 
 
 class PageViewSet(
+    ValuesListMixin,
     RetrieveModelMixin,
     DestroyModelMixin,
     CreateModelMixin,
@@ -57,6 +81,7 @@ class PageViewSet(
 
     queryset = Page.objects.prefetch_related("tags").all()
     serializer_class = PageSerializer
+    values_serializer = page_values
     filter_backends = (DjangoFilterBackend,)
     filterset_fields = ("owner", "tags", "uuid")
     permission_classes = (
@@ -64,22 +89,31 @@ class PageViewSet(
         (IsAdminOrModer | IsOwner),
     )
 
+    def get_queryset(self):
+        """Prefetches relations in the shape requested by the client"""
+        return prefetch_shape(super().get_queryset(), PageSerializer, self.request)
+
     def create(self, request, *args, **kwargs):
-        """Implements producer call"""
-        response = super().create(request, *args, **kwargs)
-        produce.delay(
-            method="POST",
-            body=dict(page_id=response.data.get("id"), action="page_created"),
-        )
+        """Writes stats event in the transaction of page creation"""
+        with transaction.atomic():
+            response = super().create(request, *args, **kwargs)
+            record_event(
+                method="POST",
+                body=dict(page_id=response.data.get("id"), action="page_created"),
+            )
+        page_sets.invalidate([request.user.pk])
+        principal_cache.invalidate([request.user.pk])
         return response
 
     def destroy(self, request, *args, **kwargs):
-        """Implements producer call"""
+        """Writes stats event in the transaction of page deletion"""
         page = self.get_object()
-        super(PageViewSet, self).destroy(request, *args, **kwargs)
-        produce.delay(
-            method="DELETE", body=dict(page_id=page.pk, action="page_deleted")
-        )
+        with transaction.atomic():
+            super(PageViewSet, self).destroy(request, *args, **kwargs)
+            record_event(
+                method="DELETE", body=dict(page_id=page.pk, action="page_deleted")
+            )
+        principal_cache.invalidate([page.owner_id])
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(
@@ -104,14 +138,15 @@ class PageViewSet(
         permission_classes=(IsAuthenticated, IsOwner),
     )
     def decline_requests_action(self, *args, **kwargs):
-        """This action provides functionality for declining follow requests"""
+        """
+        This action provides functionality for declining follow requests.
+        Declines request of target user, of users listed in user_ids
+        or all the requests of the page.
+        """
         page = get_object_or_404(Page.objects.all(), pk=kwargs.get("pk"))
         self.check_permissions(self.request)
         self.check_object_permissions(self.request, page)
-        if pk := kwargs.get("target_user_id"):
-            user = User.objects.get(pk=int(pk))
-            return decline_requests(page, user)
-        return decline_requests(page)
+        return decline_requests(page, self.get_target_user_ids(**kwargs))
 
     @action(
         methods=["put"],
@@ -119,14 +154,23 @@ class PageViewSet(
         permission_classes=(IsAuthenticated, IsOwner),
     )
     def accept_requests_action(self, *args, **kwargs):
-        """Service that provides functionality for accepting follow requests"""
+        """
+        Service that provides functionality for accepting follow requests.
+        Accepts request of target user, of users listed in user_ids
+        or all the requests of the page.
+        """
         page = get_object_or_404(Page.objects.all(), pk=kwargs.get("pk"))
         self.check_permissions(self.request)
         self.check_object_permissions(self.request, page)
+        return accept_requests(page, self.get_target_user_ids(**kwargs))
+
+    def get_target_user_ids(self, **kwargs) -> Optional[List[int]]:
+        """Ids of users whose requests are handled, None means all requests"""
         if pk := kwargs.get("target_user_id"):
-            user = User.objects.get(pk=int(pk))
-            return accept_requests(page, user)
-        return accept_requests(page)
+            return [int(pk)]
+        serializer = FollowRequestsSerializer(data=self.request.data)
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data.get("user_ids")
 
     @action(
         methods=["put"],
@@ -140,6 +184,30 @@ class PageViewSet(
         self.check_permissions(self.request)
         return follow_or_unfollow_page(self.request.user, self.get_object())
 
+    @action(
+        methods=["put"],
+        url_name="follow_page",
+        url_path="follow",
+        detail=True,
+        permission_classes=(IsAuthenticated,),
+    )
+    def follow_page_action(self, *args, **kwargs):
+        """Idempotent api for following pages"""
+        self.check_permissions(self.request)
+        return follow_page(self.request.user, self.get_object())
+
+    @action(
+        methods=["put"],
+        url_name="unfollow_page",
+        url_path="unfollow",
+        detail=True,
+        permission_classes=(IsAuthenticated,),
+    )
+    def unfollow_page_action(self, *args, **kwargs):
+        """Idempotent api for unfollowing pages"""
+        self.check_permissions(self.request)
+        return unfollow_page(self.request.user, self.get_object())
+
 
 class BlockPageViewSet(
     UpdateModelMixin,
@@ -151,8 +219,16 @@ class BlockPageViewSet(
     serializer_class = BlockPageSerializer
     permission_classes = (IsAuthenticated, IsAdminOrModer)
 
+    def perform_update(self, serializer):
+        """Block of the page changes what its followers and owner can see"""
+        page = serializer.save()
+        page_sets.invalidate_all()
+        if page.is_blocked:
+            page_access_revoked([page.pk])
+
 
 class PostViewSet(
+    ValuesListMixin,
     CreateModelMixin,
     UpdateModelMixin,
     ListModelMixin,
@@ -163,6 +239,8 @@ class PostViewSet(
     """Post view set."""
 
     serializer_class = PostSerializer
+    values_serializer = post_values
+    pagination_class = CreatedAtCursorPagination
     permission_classes = (
         IsAuthenticated,
         PostIsOwnerAdminModerOrReadOnly,
@@ -171,29 +249,41 @@ class PostViewSet(
     def get_queryset(self):
         """Excludes posts on blocked pages and private pages"""
         cur_user = self.request.user
-        return (
+        queryset = (
             cur_user.liked_posts.all()
             if self.action == "get_liked_posts"
             else get_posts(cur_user)
         )
+        if self.detail:
+            # Block state of the page is checked by the object permission
+            queryset = queryset.select_related("page")
+        return prefetch_shape(queryset, PostSerializer, self.request)
 
     def create(self, request, *args, **kwargs):
-        """Implements producer call"""
-        response = super().create(request, *args, **kwargs)
-        produce.delay(
-            method="POST",
-            body=dict(page_id=response.data.get("page"), action="post_created"),
-        )
+        """Writes stats event in the transaction of post creation"""
+        with transaction.atomic():
+            response = super().create(request, *args, **kwargs)
+            record_event(
+                method="POST",
+                body=dict(page_id=response.data.get("page"), action="post_created"),
+            )
+        if reply_to := response.data.get("reply_to"):
+            counter_buffer.add(Post, reply_to, "reply_count", 1)
+        post_published(response.data)
         send_new_post_notification_email.delay(response.data.get("id"))
+        fan_out_post.delay(response.data.get("id"))
         return response
 
     def destroy(self, request, *args, **kwargs):
-        """Implements producer call"""
+        """Writes stats event in the transaction of post deletion"""
         post = self.get_object()
-        super(PostViewSet, self).destroy(request, *args, **kwargs)
-        produce.delay(
-            method="DELETE", body=dict(page_id=post.page.pk, action="post_deleted")
-        )
+        with transaction.atomic():
+            super(PostViewSet, self).destroy(request, *args, **kwargs)
+            record_event(
+                method="DELETE", body=dict(page_id=post.page_id, action="post_deleted")
+            )
+        if post.reply_to_id:
+            counter_buffer.add(Post, post.reply_to_id, "reply_count", -1)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(
@@ -214,6 +304,40 @@ class PostViewSet(
         post = self.get_object()
         return like_unlike(cur_user, post, if_like)
 
+    @action(
+        methods=["get"],
+        detail=True,
+        url_path="thread",
+        url_name="thread",
+        serializer_class=ThreadPostSerializer,
+        permission_classes=(IsAuthenticated,),
+    )
+    def get_thread(self, *args, **kwargs):
+        """
+        Get whole conversation under the post in one request.
+        Pass depth and breadth parameters to limit the number of levels
+        and the number of replies loaded for every post.
+        """
+        self.check_permissions(self.request)
+        try:
+            depth = int(
+                self.request.query_params.get("depth", settings.THREAD_MAX_DEPTH)
+            )
+            breadth = int(
+                self.request.query_params.get("breadth", settings.THREAD_MAX_BREADTH)
+            )
+        except ValueError:
+            raise ValidationError({"detail": "Depth and breadth must be integers"})
+        thread = get_thread(
+            self.get_object(),
+            self.request.user,
+            depth=min(max(depth, 0), settings.THREAD_MAX_DEPTH),
+            breadth=min(max(breadth, 1), settings.THREAD_MAX_BREADTH),
+        )
+        prefetch_shape(thread, ThreadPostSerializer, self.request)
+        serializer = self.get_serializer(thread, many=True)
+        return Response(serializer.data)
+
     @action(
         methods=["get"],
         detail=False,
@@ -227,19 +351,65 @@ class PostViewSet(
         return super().list(self.request)
 
 
-class NewsFeedViewSet(ListModelMixin, RetrieveModelMixin, GenericViewSet):
+class NewsFeedViewSet(
+    ValuesListMixin, ListModelMixin, RetrieveModelMixin, GenericViewSet
+):
     """Displays newsfeed with post of pages you currently follow."""
 
     serializer_class = PostSerializer
+    values_serializer = post_values
+    pagination_class = CreatedAtCursorPagination
+    permission_classes = (IsAuthenticated,)
+
+    def get_queryset(self):
+        return get_followed_posts(self.request.user)
+
+    def list(self, request, *args, **kwargs):
+        """Assembles feed from pushed posts and posts pulled from celebrity pages"""
+        if self.use_values():
+            columns = self.values_serializer.columns
+            rows = self.paginator.paginate_keyed(
+                lambda before, limit: assemble_feed(
+                    request.user, limit, before, columns=columns
+                ),
+                request,
+            )
+            data = self.values_serializer.to_representation(rows, request)
+            return self.get_paginated_response(data)
+        feed = self.paginator.paginate_keyed(
+            lambda before, limit: assemble_feed(request.user, limit, before), request
+        )
+        prefetch_shape(feed, PostSerializer, request)
+        serializer = self.get_serializer(feed, many=True)
+        return self.get_paginated_response(serializer.data)
+
+
+class NotificationViewSet(ListModelMixin, GenericViewSet):
+    """Inbox of in-app notifications of the current user, newest first"""
+
+    serializer_class = NotificationSerializer
+    pagination_class = CreatedAtCursorPagination
     permission_classes = (IsAuthenticated,)
 
     def get_queryset(self):
-        user = self.request.user
-        pages = [page.pk for page in user.follows.all() if not page.is_blocked]
-        return Post.objects.filter(page__in=pages)
+        return self.request.user.notifications.all()
+
+    @action(methods=["get"], detail=False, url_path="unread-count")
+    def unread_count(self, request, *args, **kwargs):
+        """Number of unread notifications, read from the maintained counter"""
+        return Response({"unread": request.user.unread_notifications})
+
+    @action(methods=["post"], detail=False, url_path="read")
+    def read(self, request, *args, **kwargs):
+        """Marks listed notifications (all if ids aren't provided) as read"""
+        serializer = ReadNotificationsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        marked = mark_read(request.user, serializer.validated_data.get("ids"))
+        return Response({"marked": marked})
 
 
 class TagListViewSet(
+    ValuesListMixin,
     RetrieveModelMixin,
     ListModelMixin,
     CreateModelMixin,
@@ -252,6 +422,7 @@ class TagListViewSet(
 
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
+    values_serializer = tag_values
     permission_classes = (IsAuthenticatedOrReadOnly,)
 
 
@@ -262,15 +433,52 @@ class GetMyPagesViewSet(GenericViewSet, ListModelMixin):
     permission_classes = (IsAuthenticated,)
 
     def get_queryset(self):
-        user = self.request.user
-        return user.pages.all()
+        """Pages are listed by ids of the permission context"""
+        page_ids = get_permission_context(self.request).owned_page_ids
+        return prefetch_shape(
+            Page.objects.filter(pk__in=page_ids).prefetch_related("tags"),
+            PageSerializer,
+            self.request,
+        )
 
     @action(methods=["get"], detail=False, url_name="get_stats", url_path="stats")
     def get_my_pages_stats(self, *args, **kwargs):
-        """Get statistics of your pages"""
-        my_pages_ids = {
-            "pages_ids": [page.pk for page in self.request.user.pages.all()],
-        }
-        headers = {"token": get_access_token(my_pages_ids)}
-        response = requests.get(url=settings.STATS_MICROSERVICE_URL, headers=headers)
-        return Response(response.json())
+        """
+        Get statistics of your pages. Local backend answers from the rollups
+        over the last ?buckets=N hours or days (?granularity=hour|day).
+        """
+        page_ids = sorted(get_permission_context(self.request).owned_page_ids)
+        if settings.STATS_BACKEND == "microservice":
+            return Response(stats_client.get_pages_stats(page_ids))
+        granularity = self.request.query_params.get(
+            "granularity", PageStatsRollup.Granularity.DAY
+        )
+        if granularity not in PageStatsRollup.Granularity.values:
+            raise ValidationError({"detail": "Granularity must be hour or day"})
+        try:
+            buckets = int(
+                self.request.query_params.get("buckets", settings.STATS_MAX_BUCKETS)
+            )
+        except ValueError:
+            raise ValidationError({"detail": "Buckets must be an integer"})
+        buckets = min(max(buckets, 1), settings.STATS_MAX_BUCKETS)
+        return Response(
+            {
+                "granularity": granularity,
+                "pages": get_pages_stats(page_ids, granularity, buckets),
+            }
+        )
+
+
+class MetricsViewSet(GenericViewSet):
+    """Displays metrics of the web, worker and beat processes of the service"""
+
+    permission_classes = (IsAuthenticated, IsAdmin)
+
+    def list(self, request, *args, **kwargs):
+        snapshot = metrics.collect()
+        snapshot["gauges"][
+            "newsfeed.celebrity_threshold"
+        ] = settings.NEWSFEED_CELEBRITY_THRESHOLD
+        snapshot["gauges"]["outbox.lag_seconds"] = get_outbox_lag()
+        return Response(snapshot)
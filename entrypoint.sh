@@ -3,4 +3,4 @@ set -ex
 python manage.py makemigrations users
 python manage.py makemigrations core
 python manage.py migrate
-python manage.py runserver 0.0.0.0:8000
\ No newline at end of file
+uvicorn innotter.asgi:application --host 0.0.0.0 --port 8000
\ No newline at end of file
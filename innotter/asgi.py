@@ -2,6 +2,9 @@
 ASGI config for innotter project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Live feed is served by its own streaming ASGI application, everything else
+goes to the WSGI application of Django run in a pool of WSGI_THREADS threads.
+Sync views served by the ASGI handler of Django would all run on one thread.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
@@ -9,8 +12,23 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+from django.core.wsgi import get_wsgi_application
+from uvicorn.middleware.wsgi import WSGIMiddleware
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "innotter.settings")
 
-application = get_asgi_application()
+django_application = get_wsgi_application()
+
+from core.live import live_feed  # noqa: E402 (apps must be loaded first)
+from innotter import settings  # noqa: E402
+
+wsgi_application = WSGIMiddleware(django_application, workers=settings.WSGI_THREADS)
+
+LIVE_FEED_PATH = "/api/live/"
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] == LIVE_FEED_PATH:
+        await live_feed(scope, receive, send)
+    else:
+        await wsgi_application(scope, receive, send)
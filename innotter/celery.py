@@ -3,6 +3,7 @@ from __future__ import absolute_import, unicode_literals
 import os
 
 from celery import Celery
+from celery.schedules import crontab
 
 from innotter import settings
 
@@ -12,3 +13,24 @@ app = Celery("innotter", broker=settings.CELERY_BROKER_URl)
 app.config_from_object("django.conf.settings")
 
 app.autodiscover_tasks()
+
+app.conf.beat_schedule = {
+    "clear-expired-blocks": {
+        "task": "core.tasks.clear_expired_blocks",
+        "schedule": settings.BLOCK_SWEEP_INTERVAL,
+    },
+    "relay-outbox": {
+        "task": "core.outbox_services.relay_outbox",
+        "schedule": settings.OUTBOX_RELAY_INTERVAL,
+    },
+    "send-hourly-digests": {
+        "task": "core.email_services.send_notification_digests",
+        "schedule": crontab(minute=0),
+        "args": ("hourly",),
+    },
+    "send-daily-digests": {
+        "task": "core.email_services.send_notification_digests",
+        "schedule": crontab(minute=0, hour=settings.DIGEST_DAILY_HOUR),
+        "args": ("daily",),
+    },
+}
@@ -0,0 +1,155 @@
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Iterable
+
+from innotter import settings
+from innotter.periodic import PeriodicThread
+
+
+def merge_snapshots(snapshots: Iterable[dict]) -> dict:
+    """
+    Merges snapshots of several processes: counters and observations are
+    summed, gauges are taken from the latest snapshot which has them.
+    """
+    counters = defaultdict(int)
+    gauges = {}
+    observations = {}
+    for snapshot in snapshots:
+        for name, value in snapshot["counters"].items():
+            counters[name] += value
+        gauges.update(snapshot["gauges"])
+        for name, value in snapshot["observations"].items():
+            count, total, maximum = observations.get(name, (0, 0.0, value["max"]))
+            observations[name] = (
+                count + value["count"],
+                total + value["sum"],
+                max(maximum, value["max"]),
+            )
+    return {
+        "counters": dict(counters),
+        "gauges": gauges,
+        "observations": {
+            name: {"count": count, "sum": total, "avg": total / count, "max": maximum}
+            for name, (count, total, maximum) in observations.items()
+        },
+    }
+
+
+class Metrics:
+    """
+    Thread-safe in-process registry of counters, gauges and timings.
+    Values are per process. When export_interval is set, background thread
+    writes the snapshot of the process to the database, so metrics of
+    celery workers and beat are exposed through the metrics endpoint too.
+    """
+
+    def __init__(self, export_interval: float = 0, process_ttl: float = 60):
+        self.export_interval = export_interval
+        self.process_ttl = process_ttl
+        self._exporter = PeriodicThread(
+            "metrics-exporter", self.export, lambda: self.export_interval
+        )
+        self._after_fork()
+
+    def _after_fork(self) -> None:
+        """Child process starts with empty registry and its own exporter"""
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._observations = {}
+        self.process = f"{socket.gethostname()}:{os.getpid()}"
+
+    def increment(self, name: str, value: int = 1) -> None:
+        """Adds value to the counter"""
+        with self._lock:
+            self._exporter.start()
+            self._counters[name] += value
+
+    def gauge(self, name: str, value: float) -> None:
+        """Sets current value of the gauge"""
+        with self._lock:
+            self._exporter.start()
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        """Records single observation (count, sum and max are kept)"""
+        with self._lock:
+            self._exporter.start()
+            count, total, maximum = self._observations.get(name, (0, 0.0, value))
+            self._observations[name] = (count + 1, total + value, max(maximum, value))
+
+    @contextmanager
+    def timer(self, name: str):
+        """Observes duration of the block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        """Returns copy of all the metrics"""
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "observations": {
+                    name: {
+                        "count": count,
+                        "sum": total,
+                        "avg": total / count,
+                        "max": maximum,
+                    }
+                    for name, (count, total, maximum) in self._observations.items()
+                },
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._observations.clear()
+
+    def export(self) -> None:
+        """Writes snapshot of this process to the database"""
+        from django.utils import timezone
+
+        from core.models import ProcessMetrics
+
+        ProcessMetrics.objects.update_or_create(
+            process=self.process,
+            defaults=dict(snapshot=self.snapshot(), updated_at=timezone.now()),
+        )
+
+    def collect(self) -> dict:
+        """
+        Metrics of all the processes which exported them within process_ttl,
+        including the current one. Rows of stopped processes are removed.
+        Counters of a process are gone once its row expires.
+        """
+        from django.utils import timezone
+
+        from core.models import ProcessMetrics
+
+        self.export()
+        now = timezone.now()
+        stale = now - timedelta(seconds=self.process_ttl)
+        ProcessMetrics.objects.filter(updated_at__lt=stale).delete()
+        snapshots = (
+            ProcessMetrics.objects.filter(updated_at__gte=stale)
+            .order_by("updated_at")
+            .values_list("snapshot", flat=True)
+        )
+        return merge_snapshots(snapshots)
+
+
+metrics = Metrics(
+    export_interval=settings.METRICS_EXPORT_INTERVAL,
+    process_ttl=settings.METRICS_PROCESS_TTL,
+)
+os.register_at_fork(after_in_child=metrics._after_fork)
@@ -0,0 +1,165 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Callable, List, Optional, Tuple
+
+from django.db.models import Q, QuerySet
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from innotter import settings
+
+# Largest value of bigint key column
+MAX_KEY = 2**63 - 1
+
+
+class KeysetPagination(BasePagination):
+    """
+    Opaque cursor pagination over a unique ordering key.
+    Cursor stores the key of the last returned object, so every page
+    is a single index range scan, no OFFSET and no COUNT(*) are used.
+    All the ordering fields must have the same direction.
+    """
+
+    ordering = ("id",)
+    datetime_fields = ("created_at",)
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    invalid_cursor_message = "Invalid cursor"
+
+    def __init__(self):
+        self.page_size = settings.REST_FRAMEWORK["PAGE_SIZE"]
+        self.request = None
+        self.next_position = None
+
+    @property
+    def fields(self) -> List[str]:
+        return [field.lstrip("-") for field in self.ordering]
+
+    @property
+    def descending(self) -> bool:
+        return self.ordering[0].startswith("-")
+
+    def get_page_size(self, request) -> int:
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def encode_cursor(self, position: Tuple) -> str:
+        values = [
+            value.isoformat() if isinstance(value, datetime) else value
+            for value in position
+        ]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+    def decode_value(self, field: str, value):
+        """
+        Value of the field read from the cursor: aware datetime for datetime
+        fields, integer in the range of bigint for the others.
+        """
+        if field in self.datetime_fields:
+            if not isinstance(value, str):
+                raise ValueError
+            value = parse_datetime(value)
+            if value is None or value.tzinfo is None:
+                raise ValueError
+            return value
+        if type(value) is not int or not -MAX_KEY - 1 <= value <= MAX_KEY:
+            raise ValueError
+        return value
+
+    def decode_cursor(self, request) -> Optional[Tuple]:
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            values = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            if not isinstance(values, list) or len(values) != len(self.fields):
+                raise ValueError
+            return tuple(
+                self.decode_value(field, value)
+                for field, value in zip(self.fields, values)
+            )
+        except (binascii.Error, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_position(self, item) -> Tuple:
+        """Key of object, or of row read with .values()"""
+        if isinstance(item, dict):
+            return tuple(item[field] for field in self.fields)
+        return tuple(getattr(item, field) for field in self.fields)
+
+    def filter_after(self, queryset: QuerySet, position: Tuple) -> QuerySet:
+        """
+        Keeps objects placed after position. Leading field is also bounded
+        with a plain comparison, so it can be used as index condition.
+        """
+        lookup = "lt" if self.descending else "gt"
+        bound = "lte" if self.descending else "gte"
+        after = Q()
+        for index, field in enumerate(self.fields):
+            equal = {name: value for name, value in zip(self.fields, position[:index])}
+            after |= Q(**equal, **{f"{field}__{lookup}": position[index]})
+        return queryset.filter(after, **{f"{self.fields[0]}__{bound}": position[0]})
+
+    def paginate_keyed(self, fetch: Callable[[Optional[Tuple], int], List], request):
+        """
+        Paginates any ordered source, fetch gets position of the last seen
+        object and limit, and returns list of the following objects.
+        """
+        self.request = request
+        page_size = self.get_page_size(request)
+        items = list(fetch(self.decode_cursor(request), page_size + 1))
+        has_next = len(items) > page_size
+        items = items[:page_size]
+        self.next_position = self.get_position(items[-1]) if has_next else None
+        return items
+
+    def paginate_queryset(self, queryset, request, view=None):
+        def fetch(position, limit):
+            if position is not None:
+                return self.filter_after(queryset, position).order_by(*self.ordering)[
+                    :limit
+                ]
+            return queryset.order_by(*self.ordering)[:limit]
+
+        return self.paginate_keyed(fetch, request)
+
+    def get_next_link(self) -> Optional[str]:
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(self.next_position)
+        )
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+
+class IdCursorPagination(KeysetPagination):
+    """Cursor pagination in order of creation, used for users, pages and tags"""
+
+    ordering = ("id",)
+
+
+class CreatedAtCursorPagination(KeysetPagination):
+    """Cursor pagination of posts and feeds, newest first"""
+
+    ordering = ("-created_at", "-id")
@@ -0,0 +1,47 @@
+import logging
+import os
+import threading
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicThread:
+    """
+    Daemon thread calling func every interval seconds of the process.
+    Thread is started by the first start call of each process, so forked
+    child starts its own instead of relying on the thread of the parent.
+    Interval is read before each sleep, thread stops once it returns 0.
+    Callers serialize start calls with the lock of the owner.
+    """
+
+    def __init__(
+        self, name: str, func: Callable[[], None], interval: Callable[[], float]
+    ):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self._pid = None
+
+    def start(self) -> None:
+        """Starts the thread unless it was started in this process already"""
+        if self._pid != os.getpid() and self.interval():
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name=self.name, daemon=True).start()
+
+    def _run(self) -> None:
+        from django.db import connection
+
+        while True:
+            interval = self.interval()
+            if not interval:
+                return
+            time.sleep(interval)
+            try:
+                self.func()
+            except Exception:
+                logger.exception(f"Periodic call of {self.name} thread failed")
+            finally:
+                # Thread isn't a request, connection isn't kept open between calls
+                connection.close()
@@ -1,11 +1,71 @@
+from typing import Dict, FrozenSet, Optional
+
 from rest_framework import permissions
 
+from core.models import Page, Post
+from users.authentication import get_owned_page_ids
+
+
+class PermissionContext:
+    """
+    Request-scoped facts permission checks depend on: role of the user,
+    ids of the pages user owns and block states of pages. Each of them is
+    loaded at most once per request, so object-level checks don't query
+    the database for every object.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self.user_id: Optional[int] = user.pk if user.is_authenticated else None
+        self.is_admin = bool(self.user_id) and user.is_admin
+        self.is_moderator = bool(self.user_id) and user.is_moderator
+        self.is_staff = self.is_admin or self.is_moderator
+        self._owned_page_ids = None
+        self._page_block_states: Dict[int, bool] = {}
+
+    @property
+    def owned_page_ids(self) -> FrozenSet[int]:
+        if self._owned_page_ids is None:
+            self._owned_page_ids = (
+                frozenset(get_owned_page_ids(self.user))
+                if self.user_id
+                else frozenset()
+            )
+        return self._owned_page_ids
+
+    def owns_page(self, page_id: int) -> bool:
+        return page_id in self.owned_page_ids
+
+    def is_page_blocked(self, page_id: int, page: Optional[Page] = None) -> bool:
+        """
+        Block state of the page, taken from the page instance if it's loaded,
+        otherwise only this page is queried.
+        """
+        if page_id not in self._page_block_states:
+            self._page_block_states[page_id] = (
+                page.is_blocked
+                if page is not None
+                else Page.objects.blocked().filter(pk=page_id).exists()
+            )
+        return self._page_block_states[page_id]
+
+
+def get_permission_context(request) -> PermissionContext:
+    """Permission context of the request, built on first use"""
+    context = getattr(request, "_permission_context", None)
+    if context is None or context.user is not request.user:
+        context = request._permission_context = PermissionContext(request.user)
+    return context
+
 
 class IsAdminOrReadOnly(permissions.BasePermission):
     """Determines whether user is Admin or Read Only."""
 
     def has_permission(self, request, view):
-        return request.user.is_admin or request.method in permissions.SAFE_METHODS
+        return (
+            get_permission_context(request).is_admin
+            or request.method in permissions.SAFE_METHODS
+        )
 
 
 class IsAdminOrModerOrReadOnly(permissions.BasePermission):
@@ -16,19 +76,16 @@ class IsAdminOrModerOrReadOnly(permissions.BasePermission):
 
     def has_permission(self, request, view):
         return (
-            request.user and (request.user.is_admin or request.user.is_moderator)
-        ) or request.method in permissions.SAFE_METHODS
+            get_permission_context(request).is_staff
+            or request.method in permissions.SAFE_METHODS
+        )
 
 
 class IsAdminOrModer(permissions.BasePermission):
     """Determines whether user is Admin or Moderator."""
 
     def has_permission(self, request, view):
-        return (
-            True
-            if request.user and (request.user.is_admin or request.user.is_moderator)
-            else False
-        )
+        return get_permission_context(request).is_staff
 
 
 class IsOwnerAdminModerOrReadOnly(permissions.BasePermission):
@@ -38,12 +95,12 @@ class IsOwnerAdminModerOrReadOnly(permissions.BasePermission):
     """
 
     def has_object_permission(self, request, view, obj):
+        context = get_permission_context(request)
         return (
             True
             if (
-                request.user.is_admin
-                or request.user.is_moderator
-                or obj.owner == request.user
+                context.is_staff
+                or obj.owner_id == context.user_id
                 or request.method in permissions.SAFE_METHODS
             )
             else False
@@ -62,14 +119,16 @@ class PostIsOwnerAdminModerOrReadOnly(permissions.BasePermission):
     """
 
     def has_object_permission(self, request, view, obj):
+        context = get_permission_context(request)
         return (
             True
             if (
-                request.user.is_admin
-                or request.user.is_moderator
-                or obj.page.owner == request.user
+                context.is_staff
+                or context.owns_page(obj.page_id)
                 or request.method in permissions.SAFE_METHODS
-                and not obj.page.is_blocked
+                and not context.is_page_blocked(
+                    obj.page_id, obj.page if Post.page.is_cached(obj) else None
+                )
             )
             else False
         )
@@ -86,11 +145,11 @@ class IsOwner(permissions.BasePermission):
     """Checks if user is the owner of the object"""
 
     def has_object_permission(self, request, view, obj):
-        return obj.owner == request.user
+        return obj.owner_id == get_permission_context(request).user_id
 
 
 class IsAdmin(permissions.BasePermission):
     """Checks if user is admin"""
 
     def has_permission(self, request, view):
-        return request.user.is_admin
+        return get_permission_context(request).is_admin
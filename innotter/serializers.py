@@ -0,0 +1,385 @@
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.db.models import Manager, Prefetch, QuerySet, prefetch_related_objects
+from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from innotter import settings
+from innotter.renderers import FastJSONRenderer
+
+# Fields rendering database values as they are
+PLAIN_FIELDS = (
+    serializers.IntegerField,
+    serializers.CharField,
+    serializers.BooleanField,
+    serializers.ChoiceField,
+    serializers.ReadOnlyField,
+)
+
+
+def parse_shape(request) -> Tuple[Set[str], Set[str]]:
+    """Reads requested fields and expanded relations from the query params"""
+    if request is None:
+        return set(), set()
+
+    def parse(param: str) -> Set[str]:
+        value = request.query_params.get(param, "")
+        return {name.strip() for name in value.split(",") if name.strip()}
+
+    return parse("fields"), parse("expand")
+
+
+class DynamicFieldsMixin:
+    """
+    Serializer mixin for sparse fieldsets and expandable relations.
+    ?fields=id,name keeps only listed fields in the response.
+    Relations listed in Meta.expandable_fields are rendered as lists of
+    primary keys, ?expand=name renders them with the given serializer.
+    Shape is read from the request on reads only, writes keep all the fields.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get("request")
+        if request is None or request.method not in SAFE_METHODS:
+            return
+        fields, expand = parse_shape(request)
+        expandable = getattr(self.Meta, "expandable_fields", {})
+        for name in expand & set(expandable):
+            serializer_class, options = expandable[name]
+            self.fields[name] = serializer_class(read_only=True, **options)
+        if fields:
+            for name in set(self.fields) - fields:
+                self.fields.pop(name)
+
+    @classmethod
+    def get_prefetch_lookups(cls, request) -> List[Union[str, Prefetch]]:
+        """
+        Prefetch lookups matching the requested shape: expanded relations
+        are loaded fully, collapsed ones only with primary keys,
+        relations left out of the fieldset are not loaded at all.
+        """
+        fields, expand = parse_shape(request)
+        model = cls.Meta.model
+        lookups = []
+        for name in getattr(cls.Meta, "expandable_fields", {}):
+            if fields and name not in fields:
+                continue
+            if name in expand:
+                lookups.append(name)
+            else:
+                related_model = model._meta.get_field(name).related_model
+                pk_name = related_model._meta.pk.name
+                lookups.append(
+                    Prefetch(name, queryset=related_model.objects.only(pk_name))
+                )
+        return lookups
+
+
+def prefetch_shape(
+    objects: Union[QuerySet, list], serializer_class, request
+) -> Union[QuerySet, list]:
+    """Prefetches relations of queryset or list of instances for the serializer"""
+    lookups = serializer_class.get_prefetch_lookups(request)
+    if isinstance(objects, QuerySet):
+        return objects.prefetch_related(*lookups)
+    prefetch_related_objects(objects, *lookups)
+    return objects
+
+
+def get_batch_lookups(
+    serializer: serializers.Serializer, prefix: str = ""
+) -> List[Union[str, Prefetch]]:
+    """
+    Prefetch lookups of the relations rendered by the serializer fields.
+    Nested serializers load full objects and are walked recursively,
+    many-related primary key fields load primary keys only. Forward
+    primary key fields are skipped, they are read from the foreign key.
+    """
+    model = getattr(getattr(serializer, "Meta", None), "model", None)
+    if model is None:
+        return []
+    lookups = []
+    for field in serializer.fields.values():
+        if field.write_only or len(field.source_attrs) != 1:
+            continue
+        try:
+            model_field = model._meta.get_field(field.source)
+        except FieldDoesNotExist:
+            continue
+        if not model_field.is_relation:
+            continue
+        lookup = f"{prefix}{field.source}"
+        nested = getattr(field, "child", field)
+        if isinstance(nested, serializers.BaseSerializer):
+            lookups.append(lookup)
+            lookups.extend(get_batch_lookups(nested, prefix=f"{lookup}__"))
+        elif isinstance(field, serializers.ManyRelatedField):
+            related_model = model_field.related_model
+            queryset = related_model.objects.only(related_model._meta.pk.name)
+            lookups.append(Prefetch(lookup, queryset=queryset))
+        elif not getattr(field, "use_pk_only_optimization", lambda: False)():
+            lookups.append(lookup)
+    return lookups
+
+
+class BatchListSerializer(serializers.ListSerializer):
+    """
+    List serializer which loads relations of all the items before rendering,
+    so a list costs one IN query per relation instead of one per item.
+    Relations the view has already prefetched are not loaded again.
+    """
+
+    def to_representation(self, data):
+        items = list(data.all() if isinstance(data, Manager) else data)
+        lookups = get_batch_lookups(self.child)
+        if items and lookups:
+            prefetch_related_objects(items, *lookups)
+        return super().to_representation(items)
+
+
+def is_plain(field: serializers.Field) -> bool:
+    return any(
+        type(field).to_representation is plain.to_representation
+        for plain in PLAIN_FIELDS
+    )
+
+
+def column_mapper(column: str) -> Callable:
+    return lambda row, relations, request: row[column]
+
+
+def converted_mapper(column: str, convert: Callable) -> Callable:
+    def mapper(row, relations, request):
+        value = row[column]
+        return None if value is None else convert(value)
+
+    return mapper
+
+
+def computed_mapper(columns: Tuple[str, ...], compute: Callable) -> Callable:
+    return lambda row, relations, request: compute(*(row[name] for name in columns))
+
+
+def file_mapper(column: str, storage, use_url: bool) -> Callable:
+    def mapper(row, relations, request):
+        name = row[column]
+        if not name:
+            return None
+        if not use_url:
+            return name
+        url = storage.url(name)
+        return request.build_absolute_uri(url) if request is not None else url
+
+    return mapper
+
+
+def relation_mapper(name: str, pk: str) -> Callable:
+    return lambda row, relations, request: relations[name].get(row[pk], [])
+
+
+class ValuesSerializer:
+    """
+    Read-only fast path of a model serializer for lists.
+    Rows are read with .values() and shaped by mappers compiled once from
+    the serializer fields, so the output is the one of the serializer
+    without building model instances and running fields one by one.
+    Many-related primary keys and nested lists are loaded with one query
+    per relation for all the rows. Fields which aren't columns, like model
+    properties, are computed from the given columns by the functions of
+    computed, e.g. {"is_blocked": (("permanent_block",), is_blocked)}.
+    """
+
+    def __init__(
+        self,
+        serializer_class,
+        computed: Optional[Dict[str, Tuple[Tuple[str, ...], Callable]]] = None,
+    ):
+        self.serializer_class = serializer_class
+        self.computed = computed or {}
+        self._columns = None
+        self._mappers = None
+        self._relations = None
+
+    @property
+    def model(self):
+        return self.serializer_class.Meta.model
+
+    @property
+    def columns(self) -> List[str]:
+        """Columns to be passed to .values() of the queryset"""
+        self._compile()
+        return self._columns
+
+    def _compile(self) -> None:
+        if self._mappers is not None:
+            return
+        model = self.model
+        pk = model._meta.pk.attname
+        columns = [pk]
+        mappers = []
+        relations = []
+        for field in self.serializer_class()._readable_fields:
+            name = field.field_name
+            if field.source in self.computed:
+                sources, compute = self.computed[field.source]
+                columns.extend(sources)
+                mappers.append((name, computed_mapper(sources, compute)))
+                continue
+            try:
+                model_field = model._meta.get_field(field.source)
+            except FieldDoesNotExist:
+                model_field = None
+            if model_field is None or not model_field.concrete:
+                raise ImproperlyConfigured(
+                    f"Field {name} of {self.serializer_class.__name__} "
+                    f"is neither a column nor computed"
+                )
+            if model_field.many_to_many:
+                relations.append((name, self._relation_loader(field, model_field)))
+                mappers.append((name, relation_mapper(name, pk)))
+            elif model_field.is_relation:
+                if not isinstance(field, serializers.PrimaryKeyRelatedField):
+                    raise ImproperlyConfigured(f"Relation {name} isn't rendered by pk")
+                columns.append(model_field.attname)
+                if field.pk_field is None:
+                    mappers.append((name, column_mapper(model_field.attname)))
+                else:
+                    convert = field.pk_field.to_representation
+                    mappers.append(
+                        (name, converted_mapper(model_field.attname, convert))
+                    )
+            elif isinstance(field, serializers.FileField):
+                columns.append(model_field.attname)
+                use_url = getattr(field, "use_url", api_settings.UPLOADED_FILES_USE_URL)
+                mappers.append(
+                    (
+                        name,
+                        file_mapper(model_field.attname, model_field.storage, use_url),
+                    )
+                )
+            else:
+                columns.append(model_field.attname)
+                if is_plain(field):
+                    mappers.append((name, column_mapper(model_field.attname)))
+                else:
+                    mappers.append(
+                        (
+                            name,
+                            converted_mapper(
+                                model_field.attname, field.to_representation
+                            ),
+                        )
+                    )
+        self._columns = list(dict.fromkeys(columns))
+        self._relations = relations
+        self._mappers = mappers
+
+    def _relation_loader(self, field, model_field) -> Callable:
+        """
+        Loader of many-to-many relation, gets primary keys of the rows and
+        returns rendered related items by primary key of the row. Items
+        are ordered by primary key, model serializers don't define an order.
+        """
+        through = model_field.remote_field.through
+        source = through._meta.get_field(model_field.m2m_field_name()).attname
+        target = through._meta.get_field(model_field.m2m_reverse_field_name()).attname
+        child = getattr(field, "child", None) or getattr(field, "child_relation", None)
+        if isinstance(child, serializers.ModelSerializer):
+            nested = ValuesSerializer(type(child))
+        elif isinstance(child, serializers.PrimaryKeyRelatedField) and (
+            child.pk_field is None
+        ):
+            nested = None
+        else:
+            raise ImproperlyConfigured(f"Relation {field.field_name} isn't supported")
+
+        def load(pks: List, request) -> Dict:
+            pairs = list(
+                through.objects.filter(**{f"{source}__in": pks})
+                .order_by(source, target)
+                .values_list(source, target)
+            )
+            if nested is not None and pairs:
+                items = nested.render_by_pk(
+                    {target_pk for _, target_pk in pairs}, request
+                )
+            else:
+                items = None
+            related = defaultdict(list)
+            for source_pk, target_pk in pairs:
+                related[source_pk].append(
+                    target_pk if items is None else items[target_pk]
+                )
+            return related
+
+        return load
+
+    def render_by_pk(self, pks: Iterable, request=None) -> Dict:
+        """Renders objects with given primary keys, returns them by primary key"""
+        pk = self.model._meta.pk.attname
+        rows = list(self.model.objects.filter(pk__in=pks).values(*self.columns))
+        return {
+            row[pk]: item
+            for row, item in zip(rows, self.to_representation(rows, request))
+        }
+
+    def to_representation(self, rows: Iterable[dict], request=None) -> List[dict]:
+        """Renders rows read with .values(*columns)"""
+        self._compile()
+        rows = list(rows)
+        if not rows:
+            return []
+        relations = {}
+        if self._relations:
+            pk = self.model._meta.pk.attname
+            pks = [row[pk] for row in rows]
+            relations = {name: load(pks, request) for name, load in self._relations}
+        mappers = self._mappers
+        return [
+            {name: mapper(row, relations, request) for name, mapper in mappers}
+            for row in rows
+        ]
+
+
+class ValuesListMixin:
+    """
+    View mixin serving list action through the values serializer when
+    FAST_READ_PATH is on. Requests asking for a custom shape with ?fields
+    or ?expand are served by the model serializer as usual. Responses of
+    the view set are rendered with orjson under the same flag.
+    """
+
+    values_serializer: ValuesSerializer = None
+
+    def get_renderers(self):
+        renderers = super().get_renderers()
+        if not settings.FAST_READ_PATH:
+            return renderers
+        return [
+            FastJSONRenderer() if type(renderer) is JSONRenderer else renderer
+            for renderer in renderers
+        ]
+
+    def use_values(self) -> bool:
+        fields, expand = parse_shape(self.request)
+        return settings.FAST_READ_PATH and not fields and not expand
+
+    def list(self, request, *args, **kwargs):
+        if not self.use_values():
+            return super().list(request, *args, **kwargs)
+        # Prefetches are dropped, values serializer loads relations itself
+        queryset = self.filter_queryset(self.get_queryset()).prefetch_related(None)
+        rows = queryset.values(*self.values_serializer.columns)
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            rows = page
+        data = self.values_serializer.to_representation(rows, request)
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
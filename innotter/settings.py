@@ -37,6 +37,10 @@ class Config:
     AWS_LOCATION = "static"
     EMAIL_BACKEND = "django_ses.SESBackend"
     FROM_EMAIL = os.getenv("FROM_EMAIL")
+    EMAIL_CHUNK_SIZE = int(os.getenv("EMAIL_CHUNK_SIZE", 1000))
+    EMAIL_BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", 50))
+    DIGEST_MAX_POSTS = int(os.getenv("DIGEST_MAX_POSTS", 20))
+    DIGEST_DAILY_HOUR = int(os.getenv("DIGEST_DAILY_HOUR", 8))
     DEFAULT_FILE_STORAGE = "storages.backends.s3boto3.S3Boto3Storage"
     STATIC_URL = f"https://{AWS_S3_CUSTOM_DOMAIN}/static/"
     STATICFILES_STORAGE = "storages.backends.s3boto3.S3StaticStorage"
@@ -48,6 +52,21 @@ class Config:
     BROKER_PORT = os.getenv("BROKER_PORT")
     BROKER_VHOST = os.getenv("BROKER_VHOST")
     CELERY_BROKER_URl = os.getenv("CELERY_BROKER_URL")
+    BLOCK_SWEEP_INTERVAL = float(os.getenv("BLOCK_SWEEP_INTERVAL", 60))
+
+    # Stats producer
+    PRODUCER_POOL_SIZE = int(os.getenv("PRODUCER_POOL_SIZE", 4))
+    PRODUCER_PUBLISH_RETRIES = int(os.getenv("PRODUCER_PUBLISH_RETRIES", 1))
+    PRODUCER_RECONNECT_DELAY = float(os.getenv("PRODUCER_RECONNECT_DELAY", 5))
+    EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", 10000))
+    EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", 100))
+    EVENT_FLUSH_INTERVAL = float(os.getenv("EVENT_FLUSH_INTERVAL", 0.5))
+    EVENT_OVERFLOW_POLICY = os.getenv("EVENT_OVERFLOW_POLICY", "drop_oldest")
+    EVENT_DRAIN_TIMEOUT = float(os.getenv("EVENT_DRAIN_TIMEOUT", 5))
+    STATS_EVENT_ENCODING = os.getenv("STATS_EVENT_ENCODING", "json")
+    OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 500))
+    OUTBOX_RELAY_MAX_BATCHES = int(os.getenv("OUTBOX_RELAY_MAX_BATCHES", 20))
+    OUTBOX_RELAY_INTERVAL = float(os.getenv("OUTBOX_RELAY_INTERVAL", 1))
 
     # DB config
     POSTGRES_DB = os.getenv("POSTGRES_DB")
@@ -56,8 +75,64 @@ class Config:
     POSTGRES_PORT = os.getenv("POSTGRES_PORT")
     POSTGRES_HOST = os.getenv("POSTGRES_HOST")
 
-    # Microservice
+    # Stats
+    STATS_BACKEND = os.getenv("STATS_BACKEND", "local")
     STATS_MICROSERVICE_URL = os.getenv("MICROSERVICE_URL")
+    STATS_CONSUMER_BATCH_SIZE = int(os.getenv("STATS_CONSUMER_BATCH_SIZE", 500))
+    STATS_CONSUMER_FLUSH_INTERVAL = float(os.getenv("STATS_CONSUMER_FLUSH_INTERVAL", 1))
+    STATS_MAX_BUCKETS = int(os.getenv("STATS_MAX_BUCKETS", 30))
+    STATS_CLIENT_CONNECT_TIMEOUT = float(os.getenv("STATS_CLIENT_CONNECT_TIMEOUT", 0.5))
+    STATS_CLIENT_READ_TIMEOUT = float(os.getenv("STATS_CLIENT_READ_TIMEOUT", 2))
+    STATS_CLIENT_POOL_SIZE = int(os.getenv("STATS_CLIENT_POOL_SIZE", 10))
+    STATS_CLIENT_CACHE_TTL = float(os.getenv("STATS_CLIENT_CACHE_TTL", 30))
+    STATS_CLIENT_CACHE_SIZE = int(os.getenv("STATS_CLIENT_CACHE_SIZE", 1000))
+    STATS_CLIENT_FAILURE_THRESHOLD = int(os.getenv("STATS_CLIENT_FAILURE_THRESHOLD", 5))
+    STATS_CLIENT_RESET_TIMEOUT = float(os.getenv("STATS_CLIENT_RESET_TIMEOUT", 30))
+
+    # Newsfeed
+    NEWSFEED_FANOUT_CHUNK_SIZE = int(os.getenv("NEWSFEED_FANOUT_CHUNK_SIZE", 1000))
+    NEWSFEED_BACKFILL_SIZE = int(os.getenv("NEWSFEED_BACKFILL_SIZE", 50))
+    NEWSFEED_CELEBRITY_THRESHOLD = int(os.getenv("NEWSFEED_CELEBRITY_THRESHOLD", 10000))
+
+    # Threads
+    THREAD_MAX_DEPTH = int(os.getenv("THREAD_MAX_DEPTH", 20))
+    THREAD_MAX_BREADTH = int(os.getenv("THREAD_MAX_BREADTH", 100))
+    THREAD_MAX_NODES = int(os.getenv("THREAD_MAX_NODES", 1000))
+
+    # Live feed
+    LIVE_MAX_EVENTS = int(os.getenv("LIVE_MAX_EVENTS", 1000))
+    LIVE_MAX_BUFFER_BYTES = int(os.getenv("LIVE_MAX_BUFFER_BYTES", 1024 * 1024))
+    LIVE_MAX_POSTS = int(os.getenv("LIVE_MAX_POSTS", 500))
+    LIVE_HEARTBEAT_INTERVAL = float(os.getenv("LIVE_HEARTBEAT_INTERVAL", 15))
+
+    # Server
+    WSGI_THREADS = int(os.getenv("WSGI_THREADS", 20))
+
+    # Cache
+    CACHE_BACKEND = os.getenv(
+        "CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+    )
+    CACHE_LOCATION = os.getenv("CACHE_LOCATION", "")
+    PAGE_SETS_BACKEND = os.getenv("PAGE_SETS_BACKEND", "local")
+    PAGE_SETS_CACHE_ALIAS = os.getenv("PAGE_SETS_CACHE_ALIAS", "default")
+    PAGE_SETS_TTL = float(os.getenv("PAGE_SETS_TTL", 300))
+    PAGE_SETS_LOCAL_SIZE = int(os.getenv("PAGE_SETS_LOCAL_SIZE", 10000))
+    PRINCIPAL_CACHE_ALIAS = os.getenv("PRINCIPAL_CACHE_ALIAS", "default")
+    PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", 300))
+
+    # Denormalized counters
+    COUNTER_FLUSH_INTERVAL = float(os.getenv("COUNTER_FLUSH_INTERVAL", 5))
+    COUNTER_BUFFER_SIZE = int(os.getenv("COUNTER_BUFFER_SIZE", 1000))
+
+    # Metrics
+    METRICS_EXPORT_INTERVAL = float(os.getenv("METRICS_EXPORT_INTERVAL", 10))
+    METRICS_PROCESS_TTL = float(os.getenv("METRICS_PROCESS_TTL", 60))
+
+    # Pagination
+    PAGE_SIZE = int(os.getenv("PAGE_SIZE", 50))
+
+    # Read path
+    FAST_READ_PATH = bool(int(os.getenv("FAST_READ_PATH", 0)))
 
 
 config = Config()
@@ -98,10 +173,12 @@ REST_FRAMEWORK = {
         "rest_framework.permissions.IsAuthenticatedOrReadOnly",
     ),
     "DEFAULT_AUTHENTICATION_CLASSES": (
-        "rest_framework_simplejwt.authentication.JWTAuthentication",
+        "users.authentication.CachedJWTAuthentication",
         "rest_framework.authentication.SessionAuthentication",
     ),
     "DEFAULT_FILTER_BACKENDS": ["django_filters.rest_framework.DjangoFilterBackend"],
+    "DEFAULT_PAGINATION_CLASS": "innotter.pagination.IdCursorPagination",
+    "PAGE_SIZE": config.PAGE_SIZE,
 }
 
 SIMPLE_JWT = {
@@ -160,6 +237,13 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    "default": {
+        "BACKEND": config.CACHE_BACKEND,
+        "LOCATION": config.CACHE_LOCATION,
+    }
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -202,6 +286,10 @@ AWS_DEFAULT_ACL = config.AWS_DEFAULT_ACL
 AWS_LOCATION = config.AWS_LOCATION
 EMAIL_BACKEND = config.EMAIL_BACKEND
 FROM_EMAIL = config.FROM_EMAIL
+EMAIL_CHUNK_SIZE = config.EMAIL_CHUNK_SIZE
+EMAIL_BATCH_SIZE = config.EMAIL_BATCH_SIZE
+DIGEST_MAX_POSTS = config.DIGEST_MAX_POSTS
+DIGEST_DAILY_HOUR = config.DIGEST_DAILY_HOUR
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/4.1/howto/static-files/
@@ -222,8 +310,74 @@ broker_host = config.BROKER_HOST
 broker_port = config.BROKER_PORT
 broker_vhost = config.BROKER_VHOST
 CELERY_BROKER_URl = config.CELERY_BROKER_URl
-
+BLOCK_SWEEP_INTERVAL = config.BLOCK_SWEEP_INTERVAL
+
+# STATS PRODUCER
+PRODUCER_POOL_SIZE = config.PRODUCER_POOL_SIZE
+PRODUCER_PUBLISH_RETRIES = config.PRODUCER_PUBLISH_RETRIES
+PRODUCER_RECONNECT_DELAY = config.PRODUCER_RECONNECT_DELAY
+EVENT_QUEUE_SIZE = config.EVENT_QUEUE_SIZE
+EVENT_BATCH_SIZE = config.EVENT_BATCH_SIZE
+EVENT_FLUSH_INTERVAL = config.EVENT_FLUSH_INTERVAL
+EVENT_OVERFLOW_POLICY = config.EVENT_OVERFLOW_POLICY
+EVENT_DRAIN_TIMEOUT = config.EVENT_DRAIN_TIMEOUT
+STATS_EVENT_ENCODING = config.STATS_EVENT_ENCODING
+OUTBOX_BATCH_SIZE = config.OUTBOX_BATCH_SIZE
+OUTBOX_RELAY_MAX_BATCHES = config.OUTBOX_RELAY_MAX_BATCHES
+OUTBOX_RELAY_INTERVAL = config.OUTBOX_RELAY_INTERVAL
+
+STATS_BACKEND = config.STATS_BACKEND
 STATS_MICROSERVICE_URL = config.STATS_MICROSERVICE_URL
+STATS_CONSUMER_BATCH_SIZE = config.STATS_CONSUMER_BATCH_SIZE
+STATS_CONSUMER_FLUSH_INTERVAL = config.STATS_CONSUMER_FLUSH_INTERVAL
+STATS_MAX_BUCKETS = config.STATS_MAX_BUCKETS
+STATS_CLIENT_CONNECT_TIMEOUT = config.STATS_CLIENT_CONNECT_TIMEOUT
+STATS_CLIENT_READ_TIMEOUT = config.STATS_CLIENT_READ_TIMEOUT
+STATS_CLIENT_POOL_SIZE = config.STATS_CLIENT_POOL_SIZE
+STATS_CLIENT_CACHE_TTL = config.STATS_CLIENT_CACHE_TTL
+STATS_CLIENT_CACHE_SIZE = config.STATS_CLIENT_CACHE_SIZE
+STATS_CLIENT_FAILURE_THRESHOLD = config.STATS_CLIENT_FAILURE_THRESHOLD
+STATS_CLIENT_RESET_TIMEOUT = config.STATS_CLIENT_RESET_TIMEOUT
+
+# NEWSFEED
+NEWSFEED_FANOUT_CHUNK_SIZE = config.NEWSFEED_FANOUT_CHUNK_SIZE
+NEWSFEED_BACKFILL_SIZE = config.NEWSFEED_BACKFILL_SIZE
+NEWSFEED_CELEBRITY_THRESHOLD = config.NEWSFEED_CELEBRITY_THRESHOLD
+
+# THREADS
+THREAD_MAX_DEPTH = config.THREAD_MAX_DEPTH
+THREAD_MAX_BREADTH = config.THREAD_MAX_BREADTH
+THREAD_MAX_NODES = config.THREAD_MAX_NODES
+
+# LIVE FEED
+LIVE_MAX_EVENTS = config.LIVE_MAX_EVENTS
+LIVE_MAX_BUFFER_BYTES = config.LIVE_MAX_BUFFER_BYTES
+LIVE_MAX_POSTS = config.LIVE_MAX_POSTS
+LIVE_HEARTBEAT_INTERVAL = config.LIVE_HEARTBEAT_INTERVAL
+
+# SERVER
+WSGI_THREADS = config.WSGI_THREADS
+
+# PAGE SETS CACHE
+PAGE_SETS_BACKEND = config.PAGE_SETS_BACKEND
+PAGE_SETS_CACHE_ALIAS = config.PAGE_SETS_CACHE_ALIAS
+PAGE_SETS_TTL = config.PAGE_SETS_TTL
+PAGE_SETS_LOCAL_SIZE = config.PAGE_SETS_LOCAL_SIZE
+
+# PRINCIPAL CACHE
+PRINCIPAL_CACHE_ALIAS = config.PRINCIPAL_CACHE_ALIAS
+PRINCIPAL_CACHE_TTL = config.PRINCIPAL_CACHE_TTL
+
+# COUNTERS
+COUNTER_FLUSH_INTERVAL = config.COUNTER_FLUSH_INTERVAL
+COUNTER_BUFFER_SIZE = config.COUNTER_BUFFER_SIZE
+
+# METRICS
+METRICS_EXPORT_INTERVAL = config.METRICS_EXPORT_INTERVAL
+METRICS_PROCESS_TTL = config.METRICS_PROCESS_TTL
+
+# READ PATH
+FAST_READ_PATH = config.FAST_READ_PATH
 
 LOGGING = {
     "version": 1,
@@ -236,8 +390,10 @@ LOGGING = {
     "loggers": {
         "core.email_services": {
             "handlers": ["console"],
-            "level": "ERROR",
+            # Per-chunk throughput is logged at INFO
+            "level": "INFO",
         },
         "core.producer": {"handlers": ["console"], "level": "INFO"},
+        "core.emitter": {"handlers": ["console"], "level": "INFO"},
     },
 }
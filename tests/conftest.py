@@ -1,11 +1,54 @@
 import pytest
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from rest_framework.test import APIClient
 
+from core.counters import counter_buffer
+from core.emitter import event_emitter
+from core.live import live_broker
+from core.page_sets import page_sets
+from innotter.metrics import metrics
 from core.models import Page, Tag, Post
+from users.authentication import principal_cache
 from users.models import User
 
 
+@pytest.fixture(autouse=True, scope="session")
+def disable_background_threads():
+    """
+    Exporter and flusher threads would write to the test database
+    outside of test transactions. Counter deltas are flushed only
+    explicitly, so query counts don't depend on how long tests run.
+    """
+    metrics.export_interval = 0
+    counter_buffer.background_flush = False
+    counter_buffer.flush_interval = float("inf")
+
+
+@pytest.fixture(autouse=True)
+def reset_process_state():
+    """Buffers, queues and caches of the process must not leak between tests"""
+    yield
+    counter_buffer.clear()
+    event_emitter.clear()
+    live_broker.clear()
+    page_sets.clear()
+    principal_cache.cache.clear()
+
+
+@pytest.fixture
+def count_queries():
+    """Returns function which runs the callable and counts its queries"""
+
+    def count(func, *args, **kwargs) -> int:
+        with CaptureQueriesContext(connection) as context:
+            func(*args, **kwargs)
+        return len(context.captured_queries)
+
+    return count
+
+
 @pytest.fixture
 def user_payload():
     return dict(
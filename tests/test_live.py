@@ -0,0 +1,141 @@
+import asyncio
+import json
+import threading
+
+import pytest
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.live import Subscription, live_broker, live_feed
+
+
+def test_subscription_coalesces_likes_and_drops_slow_client():
+    """Test like deltas take one slot per post and overflow resets buffer"""
+    subscription = Subscription(None, max_events=3, max_bytes=1024, max_posts=10)
+    subscription.put_post(1, b"event: post\n\n")
+    for _ in range(100):
+        subscription.put_likes(2, 1)
+    subscription.put_likes(2, -1)
+
+    frames, new_posts = subscription.take()
+    assert new_posts == [1]
+    assert frames == [b"event: post\n\n", b'event: likes\ndata: {"2":99}\n\n']
+
+    for post_id in range(4):
+        subscription.put_likes(post_id, 1)
+    assert subscription.overflowed
+    assert subscription.take() == ([], [])
+
+
+def parse_events(body: bytes) -> list:
+    return [
+        (frame.split("\n")[0][7:], json.loads(frame.split("\n")[1][6:]))
+        for frame in body.decode().split("\n\n")
+        if frame.startswith("event:")
+    ]
+
+
+async def stream(scope: dict, publish) -> list:
+    """Runs live feed until publish is done, returns sent messages"""
+    disconnected = asyncio.Event()
+    messages = []
+
+    async def receive():
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+        if message["type"] == "http.response.start" and message["status"] == 200:
+            await asyncio.to_thread(publish)
+        elif message.get("body"):
+            disconnected.set()
+
+    await asyncio.wait_for(live_feed(scope, receive, send), 5)
+    return messages
+
+
+@pytest.mark.django_db(transaction=True)
+def test_live_feed_pushes_posts_and_likes(user, user_additional, user_page, post):
+    """Test follower gets new posts and like deltas of requested posts"""
+    user_page.followers.add(user_additional)
+    token = AccessToken.for_user(user_additional)
+    scope = dict(
+        type="http",
+        method="GET",
+        path="/api/live/",
+        query_string=f"token={token}&posts={post.pk},0".encode(),
+        headers=[],
+    )
+
+    def publish():
+        assert threading.current_thread() is not threading.main_thread()
+        live_broker.publish_post(user_page.pk, dict(id=10, page=user_page.pk))
+        live_broker.publish_post(user_page.pk + 1, dict(id=11, page=user_page.pk + 1))
+        live_broker.publish_likes(post.pk, 1)
+        live_broker.publish_likes(post.pk, 1)
+
+    messages = asyncio.run(stream(scope, publish))
+
+    assert messages[0]["headers"][0] == (b"content-type", b"text/event-stream")
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+    assert parse_events(body) == [
+        ("post", dict(id=10, page=user_page.pk)),
+        ("likes", {str(post.pk): 2}),
+    ]
+    assert live_broker._subscribers(f"page:{user_page.pk}") == []
+
+
+def test_live_feed_rejects_anonymous():
+    """Test connection without valid access token is rejected"""
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = dict(type="http", method="GET", query_string=b"token=wrong", headers=[])
+    asyncio.run(live_feed(scope, None, send))
+
+    assert messages[0]["status"] == 401
+
+
+@pytest.mark.django_db
+def test_live_topics_are_dropped_when_access_is_revoked(
+    django_capture_on_commit_callbacks, client, user, user_additional, admin, user_page
+):
+    """Test open connections stop getting posts of pages users can't see anymore"""
+    loop = asyncio.new_event_loop()
+    topic = f"page:{user_page.pk}"
+    follower, other, owner = (
+        Subscription(loop, max_events=10, max_bytes=1024, max_posts=10, user_id=pk)
+        for pk in (user_additional.pk, admin.pk, user.pk)
+    )
+    live_broker.subscribe(follower, [topic])
+    live_broker.subscribe(other, [topic])
+    live_broker.subscribe(owner, [])
+    user_page.followers.add(user_additional)
+
+    client.login(username="user2", password="userpass")
+    with django_capture_on_commit_callbacks(execute=True):
+        client.put(f"/api/pages/{user_page.pk}/unfollow/")
+
+    assert live_broker._subscribers(topic) == [other]
+    assert follower.topics == set()
+
+    client.login(username="admin", password="adminpass")
+    with django_capture_on_commit_callbacks(execute=True):
+        response = client.put(
+            f"/api/block-page/{user_page.pk}/",
+            json.dumps(dict(permanent_block=True)),
+            content_type="application/json",
+        )
+
+    assert response.status_code == 200
+    assert live_broker._subscribers(topic) == []
+
+    with django_capture_on_commit_callbacks(execute=True):
+        client.put(f"/api/users/{user.pk}/block-unblock/")
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+    assert owner.closed
+    assert not other.closed
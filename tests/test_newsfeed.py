@@ -1,4 +1,26 @@
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
 import pytest
+from django.core.management import call_command
+from django.utils import timezone
+
+from core.feed_services import (
+    fan_out_post,
+    fan_out_post_chunk,
+    notify_new_post_chunk,
+)
+from core.models import (
+    FeedEntry,
+    Notification,
+    OutboxEvent,
+    Page,
+    Post,
+    ProcessMetrics,
+)
+from core.outbox_services import record_event
+from innotter.metrics import metrics
 
 
 @pytest.mark.django_db
@@ -9,5 +31,177 @@ def test_get_newsfeed(client, user_page, user_additional, post):
     response = client.get("/api/newsfeed/")
 
     assert response.status_code == 200
-    assert len(response.data) == 1
-    assert response.data[0]["id"] == 1
+    assert len(response.data["results"]) == 1
+    assert response.data["results"][0]["id"] == post.pk
+
+
+@pytest.mark.django_db
+@patch("innotter.settings.NEWSFEED_FANOUT_CHUNK_SIZE", 2)
+@patch("core.feed_services.fan_out_post_chunk.delay")
+def test_fan_out_post_in_chunks(
+    fan_out_chunk, user_page, admin, moderator, user_additional
+):
+    """Test new post is written to the feeds of followers chunk by chunk"""
+    user_page.followers.set([admin, moderator, user_additional])
+    post = Post.objects.create(subject="New", page=user_page, content="Content")
+    fan_out_chunk.side_effect = fan_out_post_chunk
+
+    fan_out_post(post.pk)
+
+    assert fan_out_chunk.call_count == 2
+    assert set(FeedEntry.objects.values_list("user_id", flat=True)) == {
+        admin.pk,
+        moderator.pk,
+        user_additional.pk,
+    }
+
+
+@pytest.mark.django_db
+@patch("core.feed_services.fan_out_post_chunk.delay")
+def test_newsfeed_ordering_and_unfollow(
+    fan_out_chunk, client, user_page, user_additional, post
+):
+    """Test feed shows newest posts first and is cleaned up on unfollow"""
+    fan_out_chunk.side_effect = fan_out_post_chunk
+    client.login(username="user2", password="userpass")
+    client.put(f"/api/pages/{user_page.pk}/follow-unfollow/")
+    newer = Post.objects.create(subject="Newer", page=user_page, content="Content")
+    fan_out_post(newer.pk)
+    response = client.get("/api/newsfeed/")
+
+    assert [item["id"] for item in response.data["results"]] == [newer.pk, post.pk]
+
+    client.put(f"/api/pages/{user_page.pk}/follow-unfollow/")
+    response = client.get("/api/newsfeed/")
+
+    assert response.data["results"] == []
+
+
+@pytest.mark.django_db
+@patch("innotter.settings.NEWSFEED_CELEBRITY_THRESHOLD", 0)
+@patch("core.feed_services.notify_new_post_chunk.delay")
+@patch("core.feed_services.fan_out_post_chunk.delay")
+def test_celebrity_page_posts_are_pulled(
+    fan_out_chunk, notify_chunk, client, user_page, admin_page, user_additional, post
+):
+    """
+    Test posts of pages above celebrity threshold are merged at read time,
+    followers are still notified of them
+    """
+    fan_out_chunk.side_effect = fan_out_post_chunk
+    notify_chunk.side_effect = notify_new_post_chunk
+    user_page.followers.add(user_additional)
+    admin_page.followers.add(user_additional)
+    Page.objects.filter(pk=admin_page.pk).update(follower_count=1)
+    admin_post = Post.objects.create(subject="Boss", page=admin_page, content="Hi")
+    fan_out_post(admin_post.pk)
+    admin_page.refresh_from_db()
+
+    assert admin_page.is_celebrity
+    assert not FeedEntry.objects.filter(post=admin_post).exists()
+    notify_chunk.assert_called_once_with(admin_post.pk, [user_additional.pk])
+    assert list(Notification.objects.values_list("user", "kind", "post", "page")) == [
+        (user_additional.pk, "new_post", admin_post.pk, admin_page.pk)
+    ]
+
+    FeedEntry.objects.create(
+        user=user_additional, post=post, created_at=post.created_at
+    )
+    client.login(username="user2", password="userpass")
+    response = client.get("/api/newsfeed/?page_size=1")
+
+    assert [item["id"] for item in response.data["results"]] == [admin_post.pk]
+
+    response = client.get(response.data["next"])
+
+    assert [item["id"] for item in response.data["results"]] == [post.pk]
+    assert response.data["next"] is None
+
+
+@pytest.mark.django_db
+@patch("innotter.settings.NEWSFEED_BACKFILL_SIZE", 2)
+@patch("innotter.settings.NEWSFEED_CELEBRITY_THRESHOLD", 1)
+def test_backfill_feeds_command(user_page, admin_page, user_additional, post):
+    """Test follows made before feeds were materialized get their posts"""
+    newer = Post.objects.create(subject="Newer", page=user_page, content="Content")
+    newest = Post.objects.create(subject="Newest", page=user_page, content="Content")
+    Post.objects.create(subject="Boss", page=admin_page, content="Hi")
+    Page.followers.through.objects.bulk_create(
+        Page.followers.through(page_id=page.pk, user_id=user_additional.pk)
+        for page in (user_page, admin_page)
+    )
+    Page.objects.filter(pk=admin_page.pk).update(follower_count=2)
+
+    call_command("backfill_feeds", stdout=StringIO())
+    call_command("backfill_feeds", stdout=StringIO())
+    admin_page.refresh_from_db()
+
+    assert admin_page.is_celebrity
+    assert set(FeedEntry.objects.values_list("user_id", "post_id")) == {
+        (user_additional.pk, newer.pk),
+        (user_additional.pk, newest.pk),
+    }
+
+
+@pytest.mark.django_db
+def test_get_metrics(client, admin, user_additional):
+    """Test only admins can read service metrics"""
+    client.login(username="user2", password="userpass")
+    response = client.get("/api/metrics/")
+
+    assert response.status_code == 403
+
+    client.login(username="admin", password="adminpass")
+    response = client.get("/api/metrics/")
+
+    assert response.status_code == 200
+    assert "counters" in response.data
+
+
+@pytest.mark.django_db
+@patch("innotter.settings.NEWSFEED_CELEBRITY_THRESHOLD", 7)
+def test_metrics_of_worker_processes(client, admin):
+    """Test metrics exported by other processes are merged into the response"""
+    metrics.reset()
+    observation = {"count": 2, "sum": 3.0, "avg": 1.5, "max": 2.0}
+    for process, updated_at in (
+        ("worker:1", timezone.now()),
+        ("worker:2", timezone.now()),
+        ("stopped:1", timezone.now() - timedelta(hours=1)),
+    ):
+        ProcessMetrics.objects.create(
+            process=process,
+            updated_at=updated_at,
+            snapshot={
+                "counters": {"newsfeed.fanout.entries": 5},
+                "gauges": {"emitter.queued_events": 1},
+                "observations": {"outbox.batch_seconds": observation},
+            },
+        )
+    client.login(username="admin", password="adminpass")
+
+    response = client.get("/api/metrics/")
+
+    assert response.data["counters"]["newsfeed.fanout.entries"] == 10
+    assert response.data["gauges"]["newsfeed.celebrity_threshold"] == 7
+    assert response.data["observations"]["outbox.batch_seconds"] == {
+        "count": 4,
+        "sum": 6.0,
+        "avg": 1.5,
+        "max": 2.0,
+    }
+    assert not ProcessMetrics.objects.filter(process="stopped:1").exists()
+    assert response.data["gauges"]["outbox.lag_seconds"] == 0
+
+
+@pytest.mark.django_db
+def test_metrics_report_outbox_lag(client, admin):
+    """Test lag is computed from the oldest event the relay hasn't published"""
+    record_event("POST", dict(page_id=1, action="page_created"))
+    OutboxEvent.objects.update(created_at=timezone.now() - timedelta(minutes=1))
+    record_event("POST", dict(page_id=1, action="post_created"))
+    client.login(username="admin", password="adminpass")
+
+    response = client.get("/api/metrics/")
+
+    assert 60 <= response.data["gauges"]["outbox.lag_seconds"] < 120
@@ -0,0 +1,151 @@
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from core.feed_services import fan_out_post_chunk
+from core.models import Notification, Post
+from core.notification_services import mark_read, notify
+from users.models import User
+
+
+def users_updates(queries) -> list:
+    return [query["sql"] for query in queries if 'UPDATE "users_user"' in query["sql"]]
+
+
+def unread(user: User) -> int:
+    return User.objects.values_list("unread_notifications", flat=True).get(pk=user.pk)
+
+
+@pytest.mark.django_db
+def test_notifications_of_follow_request_and_accept(
+    client, user, user_additional, private_user_page
+):
+    """Test owner is notified of request and requester of its acceptance"""
+    client.login(username="user2", password="userpass")
+    client.put(f"/api/pages/{private_user_page.pk}/follow/")
+    client.put(f"/api/pages/{private_user_page.pk}/follow/")
+
+    assert unread(user) == 1
+    request = Notification.objects.get(user=user)
+    assert (request.kind, request.actor, request.page) == (
+        "follow_request",
+        user_additional,
+        private_user_page,
+    )
+
+    client.login(username="user", password="userpass")
+    client.put(f"/api/pages/{private_user_page.pk}/requests/accept/")
+
+    assert unread(user_additional) == 1
+    assert Notification.objects.get(user=user_additional).kind == "request_accepted"
+
+
+@pytest.mark.django_db
+def test_notifications_of_likes_and_new_posts(client, user, user_additional, post):
+    """Test post owner is notified of likes and followers of new posts"""
+    client.login(username="user2", password="userpass")
+    client.get(f"/api/posts/{post.pk}/like/")
+    client.login(username="user", password="userpass")
+    client.get(f"/api/posts/{post.pk}/like/")
+
+    assert list(Notification.objects.values_list("user", "kind", "post")) == [
+        (user.pk, "like", post.pk)
+    ]
+
+    fan_out_post_chunk(post.pk, [user_additional.pk])
+
+    assert unread(user_additional) == 1
+    assert Notification.objects.get(user=user_additional).kind == "new_post"
+
+
+@pytest.mark.django_db
+def test_notification_inbox(
+    client, django_assert_num_queries, user, user_page, post, admin
+):
+    """Test inbox is paginated and unread count is read without counting"""
+    Notification.objects.bulk_create(
+        Notification(user=user, kind="like", actor=admin, post=post) for _ in range(3)
+    )
+    User.objects.filter(pk=user.pk).update(unread_notifications=3)
+    client.login(username="user", password="userpass")
+
+    response = client.get("/api/notifications/?page_size=2")
+    assert len(response.data["results"]) == 2
+    response = client.get(response.data["next"])
+    assert len(response.data["results"]) == 1
+    assert response.data["next"] is None
+
+    # Session and user lookups of the login only, nothing is counted
+    with django_assert_num_queries(2):
+        response = client.get("/api/notifications/unread-count/")
+    assert response.data == {"unread": 3}
+
+    first = Notification.objects.order_by("id").first()
+    response = client.post(
+        "/api/notifications/read/", {"ids": [first.pk]}, format="json"
+    )
+    assert response.data == {"marked": 1}
+    response = client.post("/api/notifications/read/", {}, format="json")
+    assert response.data == {"marked": 2}
+    assert unread(user) == 0
+    assert not Notification.objects.filter(is_read=False).exists()
+
+
+@pytest.mark.django_db
+def test_deleted_notifications_leave_unread_counter(
+    user, user_additional, admin, user_page, private_user_page, post
+):
+    """
+    Test unread notifications removed by cascades are taken off the counters
+    in one update per delete, however many posts are deleted with the page.
+    """
+    other = Post.objects.create(subject="Other", page=user_page, content="Other")
+    private = Post.objects.create(
+        subject="Private", page=private_user_page, content="Private"
+    )
+    for new_post in (post, other):
+        notify(
+            [user_additional.pk, admin.pk],
+            "new_post",
+            page_id=user_page.pk,
+            post_id=new_post.pk,
+        )
+    notify(
+        [user_additional.pk], "new_post", page_id=private.page_id, post_id=private.pk
+    )
+    notify([user_additional.pk], "follow_request", actor_id=user.pk)
+    notify([user.pk], "like", actor_id=admin.pk, post_id=post.pk)
+    notify([user.pk], "follow_request", actor_id=admin.pk)
+    mark_read(admin)
+
+    with CaptureQueriesContext(connection) as context:
+        user_page.delete()
+
+    assert len(users_updates(context.captured_queries)) == 1
+    assert (unread(user), unread(user_additional), unread(admin)) == (1, 2, 0)
+
+    admin.delete()
+
+    assert unread(user) == 0
+
+    with CaptureQueriesContext(connection) as context:
+        user.delete()
+
+    assert len(users_updates(context.captured_queries)) == 1
+    assert unread(user_additional) == 0
+    assert not Notification.objects.exists()
+
+
+@pytest.mark.django_db
+def test_reconcile_unread_notifications(user, user_additional, post):
+    """Test reconciliation command fixes drifted unread counters"""
+    notify([user.pk, user_additional.pk], "like", post_id=post.pk)
+    User.objects.filter(pk=user.pk).update(unread_notifications=5)
+    Notification.objects.filter(user=user_additional).update(is_read=True)
+
+    call_command("reconcile_counters", stdout=StringIO())
+
+    assert (unread(user), unread(user_additional)) == (1, 0)
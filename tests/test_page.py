@@ -2,8 +2,15 @@ import datetime
 from unittest.mock import patch
 
 import pytest
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from core.models import Tag
+from core.models import OutboxEvent, Page, Tag
+from core.services import follow_page, unfollow_page
+from core.tasks import clear_expired_blocks
+from users.models import User
 
 
 @pytest.mark.django_db
@@ -13,9 +20,10 @@ def test_get_pages(client, user, user_page, private_user_page):
     response = client.get("/api/pages/")
 
     assert response.status_code == 200
-    assert len(response.data) == 2
-    assert response.data[0]["id"] == user_page.pk
-    assert response.data[1]["id"] == private_user_page.pk
+    assert len(response.data["results"]) == 2
+    assert response.data["results"][0]["id"] == user_page.pk
+    assert response.data["results"][1]["id"] == private_user_page.pk
+    assert response.data["next"] is None
 
 
 @pytest.mark.django_db
@@ -29,8 +37,7 @@ def test_retrieve_page(client, user, user_page):
 
 
 @pytest.mark.django_db
-@patch("core.views.produce.delay")
-def test_page_create(produce_delay, client, user, user_page_payload):
+def test_page_create(client, user, user_page_payload):
     """Test creating page"""
     client.login(username="user", password="userpass")
     response = client.post("/api/pages/", user_page_payload, format="json")
@@ -41,6 +48,9 @@ def test_page_create(produce_delay, client, user, user_page_payload):
     assert data["description"] == user_page_payload["description"]
     assert Tag.objects.filter(name=user_page_payload["tags"][0]["name"]).exists()
     assert data["is_private"] == user_page_payload["is_private"]
+    assert OutboxEvent.objects.get().body == dict(
+        page_id=data["id"], action="page_created"
+    )
 
 
 @pytest.mark.django_db
@@ -121,8 +131,7 @@ def test_accept_all_requests(
     assert response.data["response"] == "All requests have been accepted"
     assert len(private_user_page.follow_requests.all()) == 0
     assert len(private_user_page.followers.all()) == 2
-    assert private_user_page.followers.all()[0] == moderator
-    assert private_user_page.followers.all()[1] == admin
+    assert set(private_user_page.followers.all()) == {admin, moderator}
 
 
 @pytest.mark.django_db
@@ -159,8 +168,7 @@ def test_get_requests(client, private_user_page, user, admin, moderator):
     response = client.get(f"/api/pages/{private_user_page.pk}/requests/")
 
     assert len(response.data) == 2
-    assert private_user_page.follow_requests.all()[0] == admin
-    assert private_user_page.follow_requests.all()[1] == moderator
+    assert {user["id"] for user in response.data} == {admin.pk, moderator.pk}
 
 
 @pytest.mark.django_db
@@ -208,3 +216,155 @@ def test_temporary_block_page_without_permission(client, user_additional, user_p
     response = client.put(f"/api/block-page/{user_page.pk}/", headers=payload)
 
     assert response.status_code == 403
+
+
+@pytest.mark.django_db
+def test_reading_expired_block_does_not_write(client, user, user_page):
+    """Test page with expired temporary block is unblocked without any UPDATE"""
+    user_page.unblock_date = timezone.now() - datetime.timedelta(days=1)
+    user_page.save()
+    client.login(username="user", password="userpass")
+    with CaptureQueriesContext(connection) as context:
+        response = client.get(f"/api/pages/{user_page.pk}/")
+
+    assert response.data["is_blocked"] is False
+    assert not any(
+        query["sql"].startswith("UPDATE") for query in context.captured_queries
+    )
+
+
+@pytest.mark.django_db
+def test_clear_expired_blocks(user, user_page, private_user_page, admin_page):
+    """Test sweeper clears only expired blocks of pages with unblocked owners"""
+    expired = timezone.now() - datetime.timedelta(days=1)
+    user_page.unblock_date = expired
+    user_page.save()
+    private_user_page.unblock_date = timezone.now() + datetime.timedelta(days=1)
+    private_user_page.save()
+    admin_page.unblock_date = expired
+    admin_page.owner_blocked = True
+    admin_page.save()
+
+    clear_expired_blocks()
+
+    assert Page.objects.get(pk=user_page.pk).unblock_date is None
+    assert Page.objects.get(pk=private_user_page.pk).unblock_date is not None
+    assert Page.objects.get(pk=admin_page.pk).unblock_date == expired
+    assert set(Page.objects.blocked()) == {private_user_page, admin_page}
+
+
+@pytest.mark.django_db
+def test_block_owner_keeps_page_blocked(client, user, admin, user_page):
+    """Test blocking user keeps temporary block of the user's pages"""
+    user_page.unblock_date = timezone.now() - datetime.timedelta(days=1)
+    user_page.save()
+    client.login(username="admin", password="adminpass")
+    client.put(f"/api/users/{user.pk}/block-unblock/")
+
+    assert Page.objects.get(pk=user_page.pk).is_blocked
+
+    client.put(f"/api/users/{user.pk}/block-unblock/?if_block=unblock")
+
+    assert not Page.objects.get(pk=user_page.pk).is_blocked
+
+
+@pytest.mark.django_db
+def test_page_followers_shape(client, user, user_page, admin, moderator):
+    """Test followers are loaded only in the requested shape"""
+    user_page.followers.set([admin, moderator])
+    client.login(username="user", password="userpass")
+    response = client.get(f"/api/pages/{user_page.pk}/")
+
+    assert sorted(response.data["followers"]) == sorted([admin.pk, moderator.pk])
+
+    response = client.get(f"/api/pages/{user_page.pk}/?expand=followers")
+
+    assert sorted(item["username"] for item in response.data["followers"]) == [
+        "admin",
+        "moder",
+    ]
+
+    with CaptureQueriesContext(connection) as context:
+        response = client.get(f"/api/pages/{user_page.pk}/?fields=id,name")
+
+    assert response.data == {"id": user_page.pk, "name": user_page.name}
+    assert not any(
+        "core_page_followers" in query["sql"] for query in context.captured_queries
+    )
+
+
+@pytest.mark.django_db
+def test_accept_listed_requests(client, user, admin, moderator, private_user_page):
+    """Test accepting requests of listed users with one aggregated event"""
+    private_user_page.follow_requests.set([admin, moderator])
+    private_user_page.followers.add(user)
+    client.login(username="user", password="userpass")
+    with patch("core.services.event_emitter.emit") as emit, patch(
+        "core.services.dispatch_backfill"
+    ) as dispatch_backfill:
+        with TestCase.captureOnCommitCallbacks(execute=True):
+            response = client.put(
+                f"/api/pages/{private_user_page.pk}/requests/accept/",
+                {"user_ids": [admin.pk, user.pk]},
+                format="json",
+            )
+
+    assert response.status_code == 200
+    assert response.data["accepted"] == 1
+    assert list(private_user_page.follow_requests.all()) == [moderator]
+    assert set(private_user_page.followers.all()) == {user, admin}
+    emit.assert_called_once_with(
+        method="PUT",
+        body=dict(page_id=private_user_page.pk, action="follow", count=1),
+    )
+    dispatch_backfill.assert_called_once_with(private_user_page.pk, [admin.pk])
+
+
+@pytest.mark.django_db
+def test_accept_request_of_follower(client, user, admin, private_user_page):
+    """Test accepting request of user who already follows the page"""
+    private_user_page.followers.add(admin)
+    client.login(username="user", password="userpass")
+    response = client.put(
+        f"/api/pages/{private_user_page.pk}/requests/accept/{admin.pk}"
+    )
+
+    assert response.status_code == 409
+
+
+@pytest.mark.django_db
+def test_follow_unfollow_idempotent(client, user_page, admin):
+    """Test repeated follow and unfollow requests don't change the result"""
+    client.login(username="admin", password="adminpass")
+    for _ in range(2):
+        response = client.put(f"/api/pages/{user_page.pk}/follow/")
+
+        assert response.data["response"] == "Now you follow this page."
+        assert list(user_page.followers.all()) == [admin]
+
+    for _ in range(2):
+        response = client.put(f"/api/pages/{user_page.pk}/unfollow/")
+
+        assert response.data["response"] == "You're successfully unsubscribed."
+        assert not user_page.followers.exists()
+
+
+@pytest.mark.django_db
+def test_follow_queries_do_not_depend_on_followers(user_page, admin, moderator):
+    """Test follow and unfollow never load the list of followers"""
+
+    def count_queries(cur_user):
+        with CaptureQueriesContext(connection) as context:
+            follow_page(cur_user, user_page)
+            unfollow_page(cur_user, user_page)
+        return len(context.captured_queries)
+
+    few_followers = count_queries(admin)
+    user_page.followers.add(
+        *User.objects.bulk_create(
+            User(username=f"follower{i}", email=f"follower{i}@user.com")
+            for i in range(500)
+        )
+    )
+
+    assert count_queries(moderator) == few_followers
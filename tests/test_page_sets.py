@@ -0,0 +1,127 @@
+from array import array
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+from django.utils import timezone
+
+from core.page_sets import (
+    LocalBackend,
+    PageSetCache,
+    PageSets,
+    SharedBackend,
+    decode,
+    encode,
+)
+from innotter.metrics import metrics
+
+
+@pytest.fixture(params=["local", "shared"])
+def cache(request):
+    backend = LocalBackend(10) if request.param == "local" else SharedBackend("default")
+    cache = PageSetCache(backend, ttl=60)
+    yield cache
+    cache.clear()
+
+
+@pytest.mark.django_db
+def test_page_sets_are_cached_until_invalidated(
+    cache,
+    django_assert_num_queries,
+    django_capture_on_commit_callbacks,
+    user_additional,
+    user_page,
+    private_user_page,
+):
+    """Test sets are read once and reloaded after the user's entry is dropped"""
+    user_page.followers.add(user_additional)
+    own_page = user_additional.pages.create(name="Own", description="Own")
+
+    with django_assert_num_queries(1):
+        sets = cache.get(user_additional)
+    with django_assert_num_queries(0):
+        assert cache.get(user_additional) == sets
+    assert list(sets.followed) == [user_page.pk]
+    assert list(sets.visible) == [user_page.pk, own_page.pk]
+    assert metrics.snapshot()["gauges"]["page_sets.hit_ratio"] == 0.5
+
+    private_user_page.followers.add(user_additional)
+    with django_capture_on_commit_callbacks(execute=True):
+        cache.invalidate([user_additional.pk])
+    assert list(cache.get(user_additional).followed) == [
+        user_page.pk,
+        private_user_page.pk,
+    ]
+
+
+@pytest.mark.django_db
+def test_page_sets_follow_blocks(
+    cache,
+    django_capture_on_commit_callbacks,
+    user_additional,
+    user_page,
+    private_user_page,
+):
+    """Test block changes make entries stale and temporary blocks expire"""
+    user_page.followers.add(user_additional, user_page.owner)
+    private_user_page.followers.add(user_additional)
+    cache.get(user_page.owner)
+
+    user_page.permanent_block = True
+    user_page.save()
+    with django_capture_on_commit_callbacks(execute=True):
+        cache.invalidate_all()
+    assert list(cache.get(user_page.owner).followed) == []
+
+    private_user_page.unblock_date = timezone.now() + timedelta(seconds=1)
+    private_user_page.save()
+    sets = cache.get(user_additional)
+    assert list(sets.followed) == []
+    assert sets.expires_at <= private_user_page.unblock_date.timestamp()
+
+
+@pytest.mark.django_db
+def test_stale_page_sets_are_not_used(
+    cache, django_capture_on_commit_callbacks, user_additional, user_page
+):
+    """Test sets loaded before the user's entry was invalidated are rejected"""
+    _, generation, version = cache.backend.get(user_additional.pk)
+    stale = cache.load(user_additional.pk, generation, version)
+
+    user_page.followers.add(user_additional)
+    with django_capture_on_commit_callbacks(execute=True):
+        cache.invalidate([user_additional.pk])
+    cache.backend.set(user_additional.pk, stale, 60)
+
+    assert list(cache.get(user_additional).followed) == [user_page.pk]
+
+
+def test_page_sets_encoding():
+    """Test sets survive compact encoding used by the shared backend"""
+    sets = PageSets(array("q", [1, 5]), array("q", [1, 2, 5]), 1.5, 3, 4)
+
+    assert decode(encode(sets)) == sets
+
+
+@pytest.mark.django_db
+@patch("core.services.dispatch_backfill")
+def test_posts_list_sees_accepted_page(
+    dispatch_backfill,
+    client,
+    django_capture_on_commit_callbacks,
+    user,
+    user_additional,
+    private_user_page,
+):
+    """Test posts of private page are listed right after the request is accepted"""
+    private_user_page.posts.create(subject="Hidden", content="Hidden")
+    client.login(username="user2", password="userpass")
+    assert client.get("/api/posts/").data["results"] == []
+    client.put(f"/api/pages/{private_user_page.pk}/follow/")
+
+    client.login(username="user", password="userpass")
+    with django_capture_on_commit_callbacks(execute=True):
+        client.put(f"/api/pages/{private_user_page.pk}/requests/accept/")
+
+    client.login(username="user2", password="userpass")
+    assert len(client.get("/api/posts/").data["results"]) == 1
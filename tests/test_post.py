@@ -1,13 +1,40 @@
+import base64
+import json
+import os
+import time
+from io import StringIO
 from unittest.mock import patch
 
 import pytest
+from django.core import mail
+from django.core.mail import get_connection
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.counters import CounterBuffer, counter_buffer
+from core.email_services import (
+    send_digest_chunk,
+    send_new_post_notification_email,
+    send_notification_digests,
+    send_notification_email_chunk,
+)
+from core.models import OutboxEvent, PendingNotification, Post
+from users.models import User
+
+# Planner picks the index only on a large table, the test inserts that many
+# posts and is skipped unless the size is set, e.g. PLAN_TEST_POSTS=1000000
+PLAN_TEST_POSTS = int(os.getenv("PLAN_TEST_POSTS", 0))
 
 
 @pytest.mark.django_db
-@patch("core.views.produce.delay")
 @patch("core.views.send_new_post_notification_email.delay")
+@patch("core.views.fan_out_post.delay")
 def test_create_post(
-    produce_delay,
+    fan_out,
     send_email,
     client,
     user_page,
@@ -24,6 +51,10 @@ def test_create_post(
     assert response.data["content"] == post_payload["content"]
     assert response.data["reply_to"] == post_on_private_page.pk
     assert response.data["page"] == user_page.pk
+    fan_out.assert_called_once_with(response.data["id"])
+    event = OutboxEvent.objects.get()
+    assert event.method == "POST"
+    assert event.body == dict(page_id=user_page.pk, action="post_created")
 
 
 @pytest.mark.django_db
@@ -70,14 +101,16 @@ def test_retrieve_post(client, admin, user_page, post):
 
 
 @pytest.mark.django_db
-@patch("core.views.produce.delay")
-def test_delete_post(produce_delay, client, user, user_page, post):
+def test_delete_post(client, user, user_page, post):
     """Test delete post"""
     client.login(username="user", password="userpass")
     response = client.delete(f"/api/posts/{post.pk}/")
 
     assert response.status_code == 204
     assert len(user_page.posts.all()) == 0
+    assert OutboxEvent.objects.get().body == dict(
+        page_id=user_page.pk, action="post_deleted"
+    )
 
 
 @pytest.mark.django_db
@@ -117,6 +150,355 @@ def test_get_liked_posts(client, user, post, post_on_admin_page):
     response = client.get("/api/posts/liked/")
 
     assert response.status_code == 200
-    assert len(response.data) == 2
-    assert response.data[0]["id"] == post.pk
-    assert response.data[1]["id"] == post_on_admin_page.pk
+    assert len(response.data["results"]) == 2
+    assert response.data["results"][0]["id"] == post_on_admin_page.pk
+    assert response.data["results"][1]["id"] == post.pk
+
+
+@pytest.mark.django_db
+def test_posts_cursor_pagination(client, user, user_page, post):
+    """Test posts are paginated newest first by opaque cursor"""
+    newer = Post.objects.create(subject="Newer", page=user_page, content="Content")
+    newest = Post.objects.create(subject="Newest", page=user_page, content="Content")
+    client.login(username="user", password="userpass")
+    response = client.get("/api/posts/?page_size=2")
+
+    assert [item["id"] for item in response.data["results"]] == [newest.pk, newer.pk]
+    assert "cursor=" in response.data["next"]
+
+    response = client.get(response.data["next"])
+
+    assert [item["id"] for item in response.data["results"]] == [post.pk]
+    assert response.data["next"] is None
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "values",
+    [
+        [5, 3],
+        ["2022-11-20T10:00:00+00:00", "2022-11-20T10:00:00+00:00"],
+        ["2022-11-20T10:00:00+00:00", 2**63],
+        ["2022-11-20T10:00:00+00:00", True],
+        ["2022-11-20T10:00:00", 3],
+        ["2022-13-45T10:00:00+00:00", 3],
+        ["2022-11-20T10:00:00+00:00"],
+    ],
+)
+def test_posts_invalid_cursor(client, user, post, values):
+    """Test malformed cursor and values not matching the fields are rejected"""
+    client.login(username="user", password="userpass")
+    response = client.get("/api/posts/?cursor=broken")
+
+    assert response.status_code == 404
+
+    cursor = base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+    response = client.get(f"/api/posts/?cursor={cursor}")
+
+    assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_like_count(client, user, user_page, post, user_additional):
+    """Test repeated likes are counted once and counters are flushed in bulk"""
+    client.login(username="user2", password="userpass")
+    client.get(f"/api/posts/{post.pk}/like/")
+    client.get(f"/api/posts/{post.pk}/like/")
+    client.login(username="user", password="userpass")
+    client.get(f"/api/posts/{post.pk}/like/")
+    counter_buffer.flush()
+    post.refresh_from_db()
+
+    assert post.like_count == 2
+
+    client.get(f"/api/posts/{post.pk}/like/?if_like=unlike")
+    client.get(f"/api/posts/{post.pk}/like/?if_like=unlike")
+    counter_buffer.flush()
+    post.refresh_from_db()
+
+    assert post.like_count == 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_counters_of_idle_process_are_flushed(post):
+    """Test buffered deltas are written without further likes coming in"""
+    buffer = CounterBuffer(flush_interval=0.05, max_size=100)
+    buffer.add(Post, post.pk, "like_count", 2)
+    try:
+        for _ in range(100):
+            post.refresh_from_db()
+            if post.like_count:
+                break
+            time.sleep(0.05)
+    finally:
+        buffer.background_flush = False
+
+    assert post.like_count == 2
+
+
+@pytest.mark.django_db
+def test_reconcile_counters(user, user_page, post, post_on_private_page):
+    """Test reconciliation command fixes drifted counters"""
+    post.likes.add(user)
+    Post.objects.create(subject="Reply", page=user_page, content="Reply", reply_to=post)
+    Post.objects.filter(pk=post_on_private_page.pk).update(like_count=5)
+    user_page.followers.add(user)
+
+    call_command("reconcile_counters", stdout=StringIO())
+    post.refresh_from_db()
+    post_on_private_page.refresh_from_db()
+    user_page.refresh_from_db()
+
+    assert post.like_count == 1
+    assert post.reply_count == 1
+    assert post_on_private_page.like_count == 0
+    assert user_page.follower_count == 1
+
+
+@pytest.mark.django_db
+def test_post_sparse_fields_and_expand(client, user, user_page, post, admin):
+    """Test likes are compact by default and can be expanded or left out"""
+    post.likes.add(admin)
+    client.login(username="user", password="userpass")
+    response = client.get(f"/api/posts/{post.pk}/")
+
+    assert response.data["likes"] == [admin.pk]
+
+    response = client.get(f"/api/posts/{post.pk}/?expand=likes")
+
+    assert response.data["likes"][0]["username"] == admin.username
+    assert "email" not in response.data["likes"][0]
+
+    response = client.get("/api/posts/?fields=id,like_count")
+
+    assert response.data["results"] == [{"id": post.pk, "like_count": 0}]
+
+
+@pytest.mark.django_db
+@pytest.mark.skipif(not PLAN_TEST_POSTS, reason="PLAN_TEST_POSTS isn't set")
+def test_visible_posts_query_plan(
+    user_additional, user_page, private_user_page, admin_page
+):
+    """
+    Test visibility of posts is decided by a single predicate
+    and the newest posts are read by index on a large dataset.
+    """
+    private_user_page.followers.add(user_additional)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            INSERT INTO core_post (
+                subject, content, page_id, like_count,
+                reply_count, created_at, updated_at
+            )
+            SELECT 'Post', 'Content', (ARRAY[%s, %s, %s])[n %% 3 + 1], 0, 0,
+                now() - make_interval(secs => n), now()
+            FROM generate_series(1, %s) AS n
+            """,
+            [user_page.pk, private_user_page.pk, admin_page.pk, PLAN_TEST_POSTS],
+        )
+        cursor.execute("ANALYZE core_post")
+    posts = Post.objects.visible_to(user_additional).order_by("-created_at", "-id")
+
+    plan = posts[:50].explain()
+
+    assert "post_created_idx" in plan
+    assert "Sort" not in plan
+    assert posts.filter(page=private_user_page).exists()
+
+
+@pytest.mark.django_db
+def test_get_thread(client, user, user_additional, user_page, private_user_page, post):
+    """Test reply tree is flattened depth first and limited by depth and breadth"""
+    first = Post.objects.create(subject="1", page=user_page, content="1", reply_to=post)
+    nested = Post.objects.create(
+        subject="1.1", page=user_page, content="1.1", reply_to=first
+    )
+    second = Post.objects.create(
+        subject="2", page=user_page, content="2", reply_to=post
+    )
+    hidden = Post.objects.create(
+        subject="3", page=private_user_page, content="3", reply_to=post
+    )
+    Post.objects.create(subject="3.1", page=user_page, content="3.1", reply_to=hidden)
+    client.login(username="user2", password="userpass")
+    response = client.get(f"/api/posts/{post.pk}/thread/")
+
+    assert response.status_code == 200
+    assert [(item["id"], item["depth"]) for item in response.data] == [
+        (post.pk, 0),
+        (first.pk, 1),
+        (nested.pk, 2),
+        (second.pk, 1),
+    ]
+
+    response = client.get(f"/api/posts/{post.pk}/thread/?depth=1&breadth=1")
+
+    assert [item["id"] for item in response.data] == [post.pk, first.pk]
+
+
+@pytest.mark.django_db
+@patch("innotter.settings.EMAIL_CHUNK_SIZE", 2)
+@patch("innotter.settings.EMAIL_BATCH_SIZE", 2)
+@patch("core.email_services.send_notification_email_chunk.delay")
+def test_send_new_post_notification_email(
+    send_chunk, caplog, user_page, post, admin, moderator
+):
+    """Test notification is sent to followers in chunks over one connection each"""
+    followers = [admin, moderator] + [
+        User.objects.create(username=f"follower{i}", email=f"follower{i}@user.com")
+        for i in range(3)
+    ]
+    user_page.followers.set(followers)
+    send_chunk.side_effect = send_notification_email_chunk
+
+    with patch(
+        "core.email_services.get_connection", wraps=get_connection
+    ) as open_connection, CaptureQueriesContext(connection) as context:
+        send_new_post_notification_email(post.pk)
+
+    assert send_chunk.call_count == 3
+    assert open_connection.call_count == 3
+    assert sorted(message.to[0] for message in mail.outbox) == sorted(
+        follower.email for follower in followers
+    )
+    # Followers ids, then post with page owner, digest queue insert
+    # and emails for every chunk
+    assert len(context.captured_queries) == 2 + 3 * 3
+    # Throughput of every chunk is logged with the configured logger level
+    chunk_logs = [
+        record for record in caplog.records if "emails sent" in record.message
+    ]
+    assert len(chunk_logs) == 3
+
+
+@pytest.mark.django_db
+@patch("core.email_services.send_digest_chunk.delay")
+def test_send_notification_digests(
+    send_digest, user_page, private_user_page, post, admin, moderator
+):
+    """Test digest readers get one email with all new posts instead of one per post"""
+    User.objects.filter(pk=admin.pk).update(notification_mode="hourly")
+    user_page.followers.set([admin, moderator])
+    private_user_page.followers.set([admin])
+    other_post = Post.objects.create(
+        page=private_user_page, subject="Other", content="Content"
+    )
+    for new_post in (post, other_post):
+        send_notification_email_chunk(new_post.pk, admin.pk, moderator.pk)
+
+    assert [message.to for message in mail.outbox] == [[moderator.email]]
+    assert PendingNotification.objects.filter(user=admin).count() == 2
+
+    mail.outbox = []
+    send_digest.side_effect = send_digest_chunk
+    send_notification_digests("daily")
+    assert mail.outbox == []
+
+    send_notification_digests("hourly")
+
+    send_digest.assert_called_with([admin.pk])
+    (digest,) = mail.outbox
+    assert digest.to == [admin.email]
+    assert digest.subject == "2 new posts on pages you follow"
+    assert digest.body.splitlines() == [
+        f"Other on {private_user_page}",
+        f"{post.subject} on {user_page}",
+    ]
+    assert not PendingNotification.objects.exists()
+
+
+@pytest.mark.django_db
+def test_unsent_digests_stay_pending(
+    django_assert_num_queries, user_page, post, admin, moderator
+):
+    """
+    Test pending notifications are kept only for users whose digest
+    wasn't sent, others get theirs once
+    """
+    User.objects.filter(pk__in=[admin.pk, moderator.pk]).update(
+        notification_mode="hourly"
+    )
+    user_page.followers.set([admin, moderator])
+    send_notification_email_chunk(post.pk, admin.pk, moderator.pk)
+    send_messages = EmailBackend.send_messages
+
+    def fail_for_admin(backend, messages):
+        if messages[0].to == [admin.email]:
+            raise ConnectionError
+        return send_messages(backend, messages)
+
+    with patch.object(
+        EmailBackend, "send_messages", autospec=True, side_effect=fail_for_admin
+    ):
+        # Pending rows, posts, emails and delete of the sent ones,
+        # no transaction is opened around sending
+        with django_assert_num_queries(4):
+            send_digest_chunk([admin.pk, moderator.pk])
+
+    assert [message.to for message in mail.outbox] == [[moderator.email]]
+    assert list(PendingNotification.objects.values_list("user", flat=True)) == [
+        admin.pk
+    ]
+
+    send_digest_chunk([admin.pk, moderator.pk])
+
+    assert [message.to for message in mail.outbox[1:]] == [[admin.email]]
+    assert not PendingNotification.objects.exists()
+
+
+@pytest.mark.django_db
+@patch("users.views.send_digest_chunk.delay")
+def test_switch_to_immediate_flushes_pending_notifications(
+    send_digest, django_capture_on_commit_callbacks, user_page, post, admin
+):
+    """Test user who stops reading digests gets the queued posts at once"""
+    User.objects.filter(pk=admin.pk).update(notification_mode="daily")
+    user_page.followers.set([admin])
+    send_notification_email_chunk(post.pk, admin.pk, admin.pk)
+    assert PendingNotification.objects.filter(user=admin).exists()
+    send_digest.side_effect = send_digest_chunk
+    client = APIClient()
+    client.force_authenticate(admin)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        response = client.patch(
+            f"/api/users/{admin.pk}/", {"notification_mode": "immediate"}
+        )
+
+    assert response.status_code == 200
+    send_digest.assert_called_once_with([admin.pk])
+    (digest,) = mail.outbox
+    assert digest.to == [admin.email]
+    assert not PendingNotification.objects.exists()
+
+
+@pytest.mark.django_db
+def test_post_permissions_query_count(
+    django_assert_num_queries, user, user_page, post, admin_page
+):
+    """
+    Test ownership and block checks are answered from the permission context:
+    a fixed number of queries per request, owner of the page isn't loaded.
+    """
+    other = Post.objects.create(subject="Other", page=admin_page, content="Other")
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}")
+    client.get(f"/api/posts/{post.pk}/")
+
+    # Post with its likes, page of the payload, update and likes again
+    with django_assert_num_queries(5):
+        response = client.patch(
+            f"/api/posts/{post.pk}/", dict(page=user_page.pk, content="New")
+        )
+    assert response.status_code == 200
+
+    # Post with its page and its likes, block state is read from the page
+    with django_assert_num_queries(2):
+        response = client.get(f"/api/posts/{other.pk}/")
+    assert response.status_code == 200
+
+    response = client.patch(
+        f"/api/posts/{other.pk}/", dict(page=admin_page.pk, content="New")
+    )
+    assert response.status_code == 403
@@ -0,0 +1,197 @@
+import json
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from unittest.mock import patch
+
+import pytest
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from core.feed_services import fan_out_post_chunk
+from core.models import Page, Post
+from core.serializers import PageSerializer, PostSerializer
+from innotter.renderers import FastJSONRenderer
+from innotter.serializers import ValuesSerializer
+from users.models import User
+
+
+def serialize(serializer_class, queryset):
+    return serializer_class(list(queryset), many=True).data
+
+
+@pytest.mark.django_db
+def test_post_list_loads_likes_in_one_query(count_queries, user, user_page, admin):
+    """Test likes of all the listed posts are loaded with a single query"""
+    posts = Post.objects.bulk_create(
+        Post(subject=f"{i}", page=user_page, content=f"{i}") for i in range(10)
+    )
+    for post in posts:
+        post.likes.add(user, admin)
+    queryset = Post.objects.order_by("id")
+
+    assert count_queries(serialize, PostSerializer, queryset[:1]) == 2
+    assert count_queries(serialize, PostSerializer, queryset) == 2
+    data = serialize(PostSerializer, queryset)
+    assert [sorted(item["likes"]) for item in data] == [[user.pk, admin.pk]] * 10
+
+
+@pytest.mark.django_db
+def test_page_list_loads_relations_in_one_query_each(count_queries, user, tag):
+    """Test tags, followers and requests of listed pages don't cost per page"""
+    followers = User.objects.bulk_create(
+        User(username=f"follower{i}", email=f"follower{i}@user.com") for i in range(3)
+    )
+    for i in range(5):
+        page = Page.objects.create(name=f"{i}", description=f"{i}", owner=user)
+        page.tags.add(tag)
+        page.followers.add(*followers)
+    queryset = Page.objects.order_by("id")
+
+    # Pages, tags, followers and follow requests
+    assert count_queries(serialize, PageSerializer, queryset[:1]) == 4
+    assert count_queries(serialize, PageSerializer, queryset) == 4
+    data = serialize(PageSerializer, queryset)
+    assert all(item["tags"] == [{"id": tag.pk, "name": tag.name}] for item in data)
+    assert all(len(item["followers"]) == 3 for item in data)
+
+
+def sort_relations(data: dict) -> dict:
+    """Sorts related items, their order isn't defined by model serializers"""
+    for item in data["results"]:
+        for name in ("tags", "followers", "follow_requests", "likes"):
+            if name in item:
+                item[name].sort(key=str)
+    return data
+
+
+def read_both_paths(client, url: str, fast_path: bool = True):
+    """Responses of the model serializer and of the values serializer"""
+    with patch("innotter.settings.FAST_READ_PATH", False):
+        slow = client.get(url)
+    render = ValuesSerializer.to_representation
+    with patch("innotter.settings.FAST_READ_PATH", True), patch.object(
+        ValuesSerializer, "to_representation", autospec=True, side_effect=render
+    ) as values_render:
+        fast = client.get(url)
+    assert slow.status_code == fast.status_code == 200
+    assert values_render.called == fast_path
+    # orjson renders responses of fast path view sets only under the flag
+    assert type(slow.accepted_renderer) is JSONRenderer
+    assert type(fast.accepted_renderer) is FastJSONRenderer
+    return sort_relations(slow.json()), sort_relations(fast.json())
+
+
+@pytest.fixture
+def read_path_data(user, admin, user_additional, tag, tag_additional):
+    """Pages with tags, followers, image and blocks, posts with likes and replies"""
+    pages = [
+        Page.objects.create(
+            name=f"page{i}",
+            description="\u2028 text",
+            owner=user,
+            image=f"media/{i}.jpg",
+        )
+        for i in range(3)
+    ]
+    pages[0].tags.add(tag, tag_additional)
+    pages[1].tags.add(tag)
+    pages[0].followers.add(user_additional, admin)
+    pages[1].follow_requests.add(admin)
+    Page.objects.filter(pk=pages[2].pk).update(
+        image=None, unblock_date=timezone.now() + timedelta(days=1)
+    )
+    posts = [
+        Post.objects.create(subject=f"{i}", page=pages[i % 2], content=f"{i}")
+        for i in range(6)
+    ]
+    Post.objects.filter(pk=posts[1].pk).update(reply_to=posts[0], like_count=2)
+    posts[1].likes.add(user, admin)
+    return pages, posts
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "url",
+    [
+        "/api/posts/",
+        "/api/posts/?page_size=2",
+        "/api/tags/",
+        "/api/pages/",
+        "/api/pages/?page_size=1",
+    ],
+)
+def test_fast_read_path_output_matches_serializers(client, admin, read_path_data, url):
+    """Test values serializers render lists exactly as model serializers do"""
+    client.login(username="admin", password="adminpass")
+
+    slow, fast = read_both_paths(client, url)
+
+    assert fast == slow
+    assert slow["results"]
+    if slow["next"]:
+        slow_next, fast_next = read_both_paths(client, slow["next"])
+        assert fast_next == slow_next
+
+
+@pytest.mark.django_db
+def test_custom_shape_is_served_by_model_serializer(client, admin, read_path_data):
+    """Test sparse fieldsets and expanded relations skip the fast path"""
+    client.login(username="admin", password="adminpass")
+
+    slow, fast = read_both_paths(
+        client, "/api/pages/?fields=id,followers&expand=followers", fast_path=False
+    )
+
+    assert fast == slow
+
+
+@pytest.mark.django_db
+@patch("innotter.settings.FAST_READ_PATH", True)
+def test_other_views_keep_json_renderer(client, admin):
+    """Test orjson renderer isn't used outside of the fast path view sets"""
+    response = client.get("/api/users/")
+
+    assert response.status_code == 200
+    assert type(response.accepted_renderer) is JSONRenderer
+
+
+@pytest.mark.django_db
+@patch("innotter.settings.NEWSFEED_CELEBRITY_THRESHOLD", 0)
+def test_fast_read_path_newsfeed(client, user_additional, read_path_data):
+    """Test merged newsfeed is rendered the same way by both paths"""
+    pages, posts = read_path_data
+    Page.objects.filter(pk=pages[1].pk).update(is_celebrity=True)
+    pages[1].followers.add(user_additional)
+    for post in posts:
+        if post.page_id == pages[0].pk:
+            fan_out_post_chunk(post.pk, [user_additional.pk])
+    client.login(username="user2", password="userpass")
+
+    slow, fast = read_both_paths(client, "/api/newsfeed/?page_size=4")
+
+    assert fast == slow
+    assert [item["id"] for item in slow["results"]] == [
+        post.pk for post in reversed(posts[2:])
+    ]
+    slow_next, fast_next = read_both_paths(client, slow["next"])
+    assert fast_next == slow_next
+
+
+def test_fast_json_renderer_output_matches_json_renderer():
+    """Test orjson backed renderer keeps the output of JSONRenderer"""
+    data = {
+        "created_at": timezone.now(),
+        "uuid": uuid.uuid4(),
+        "amount": Decimal("1.5"),
+        "text": "line\u2028separator \u00e9",
+        "items": (1, 2),
+        1: None,
+    }
+
+    fast = FastJSONRenderer().render(data)
+
+    assert fast == JSONRenderer().render(data)
+    assert json.loads(fast)["text"] == data["text"]
+    indented = FastJSONRenderer().render(data, "application/json; indent=2")
+    assert indented == JSONRenderer().render(data, "application/json; indent=2")
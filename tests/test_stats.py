@@ -0,0 +1,235 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+
+import pika
+import pytest
+import requests
+from django.core.management import call_command
+from django.db import DataError
+
+from core import codec
+from core.models import PageStatsRollup
+from core.stats_client import CircuitBreaker, StatsClient, StatsUnavailable
+from core.stats_services import consume_messages
+
+RECEIVED_AT = datetime(2024, 5, 1, 13, 45, tzinfo=timezone.utc)
+
+
+def json_message(method: str, body: dict, received_at: datetime = RECEIVED_AT):
+    return json.dumps(body).encode(), method, received_at
+
+
+@pytest.mark.django_db
+def test_consume_messages_upserts_rollups():
+    """Test events of both encodings are summed into hourly and daily rollups"""
+    binary = codec.encode_batch(
+        [
+            ("GET", dict(page_id=1, action="like", count=10)),
+            ("PUT", dict(page_id=1, action="follow", count=2)),
+        ]
+    )
+    consume_messages(
+        [
+            json_message("GET", dict(page_id=1, action="like")),
+            (binary, codec.STATS_CONTENT_TYPE, RECEIVED_AT),
+            (b"not json", "GET", RECEIVED_AT),
+            json_message("POST", dict(page_id=1, action="page_created")),
+        ]
+    )
+    consumed = consume_messages(
+        [
+            json_message(
+                "POST",
+                dict(page_id=1, action="post_created"),
+                RECEIVED_AT + timedelta(hours=1),
+            )
+        ]
+    )
+
+    assert consumed == 1
+    hours = PageStatsRollup.objects.filter(granularity="hour").order_by("bucket")
+    assert [(row.bucket.hour, row.likes, row.follows, row.posts) for row in hours] == [
+        (13, 11, 2, 0),
+        (14, 0, 0, 1),
+    ]
+    day = PageStatsRollup.objects.get(granularity="day")
+    assert day.bucket == datetime(2024, 5, 1, tzinfo=timezone.utc)
+    assert (day.likes, day.follows, day.posts) == (11, 2, 1)
+
+
+@pytest.mark.django_db
+@patch("core.management.commands.consume_stats.pika.BlockingConnection")
+def test_consume_stats_command(blocking_connection):
+    """Test consumer acknowledges the batch after rollups are written"""
+    channel = blocking_connection.return_value.channel.return_value
+    properties = pika.BasicProperties("GET", timestamp=int(RECEIVED_AT.timestamp()))
+    channel.consume.return_value = [
+        (MagicMock(delivery_tag=tag), properties, json.dumps(body).encode())
+        for tag, body in enumerate(
+            [dict(page_id=1, action="like"), dict(page_id=1, action="unlike")], 1
+        )
+    ] + [(None, None, None)]
+
+    call_command("consume_stats", url="amqp://localhost", stdout=MagicMock())
+
+    channel.basic_ack.assert_called_once_with(delivery_tag=2, multiple=True)
+    hour = PageStatsRollup.objects.get(granularity="hour")
+    assert hour.bucket == datetime(2024, 5, 1, 13, tzinfo=timezone.utc)
+    assert (hour.likes, hour.unlikes) == (1, 1)
+
+
+@pytest.mark.django_db
+@patch("core.management.commands.consume_stats.consume_messages")
+@patch("core.management.commands.consume_stats.pika.BlockingConnection")
+def test_consume_stats_command_dead_letters_bad_messages(
+    blocking_connection, consume_messages
+):
+    """Test batch which can't be written is split and bad messages are rejected"""
+    channel = blocking_connection.return_value.channel.return_value
+    properties = pika.BasicProperties("GET", timestamp=int(RECEIVED_AT.timestamp()))
+    channel.consume.return_value = [
+        (MagicMock(delivery_tag=tag), properties, b"{}") for tag in (1, 2)
+    ] + [(None, None, None)]
+    consume_messages.side_effect = [DataError(), 1, DataError()]
+
+    call_command("consume_stats", url="amqp://localhost", stdout=MagicMock())
+
+    channel.basic_ack.assert_called_once_with(delivery_tag=1)
+    channel.basic_reject.assert_called_once_with(delivery_tag=2, requeue=False)
+
+
+@pytest.mark.django_db
+def test_get_my_pages_stats(client, user, user_page, private_user_page):
+    """Test stats of user pages are read from the local rollups"""
+    now = datetime.now(timezone.utc)
+    consume_messages(
+        [
+            json_message("GET", dict(page_id=user_page.pk, action="like"), now),
+            json_message("GET", dict(page_id=user_page.pk, action="like"), now),
+            json_message("GET", dict(page_id=0, action="like"), now),
+        ]
+    )
+    client.login(username="user", password="userpass")
+    response = client.get("/api/get_my_pages/stats/?granularity=hour&buckets=2")
+
+    assert response.status_code == 200
+    pages = response.data["pages"]
+    assert set(pages) == {user_page.pk, private_user_page.pk}
+    assert pages[user_page.pk]["totals"]["likes"] == 2
+    assert len(pages[user_page.pk]["buckets"]) == 1
+    assert pages[private_user_page.pk]["buckets"] == []
+
+    response = client.get("/api/get_my_pages/stats/?granularity=week")
+    assert response.status_code == 400
+
+
+def get_stats_client(**kwargs):
+    options = dict(
+        url="http://stats:8080/stats/",
+        timeout=(0.5, 2),
+        pool_size=2,
+        cache_ttl=60,
+        cache_size=10,
+        breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60),
+    )
+    options.update(kwargs)
+    client = StatsClient(**options)
+    client._session, client._pid = MagicMock(), os.getpid()
+    return client
+
+
+def test_stats_client_caches_by_page_set():
+    """Test response is cached for the set of page ids regardless of order"""
+    client = get_stats_client()
+    client.session.get.return_value.json.return_value = {"likes": 1}
+
+    assert client.get_pages_stats([1, 2]) == {"likes": 1}
+    assert client.get_pages_stats([2, 1]) == {"likes": 1}
+
+    client.session.get.assert_called_once()
+    assert client.session.get.call_args.kwargs["timeout"] == (0.5, 2)
+
+
+def test_stats_client_single_flight():
+    """Test concurrent callers of the same page set share one request"""
+    client = get_stats_client()
+    release = threading.Event()
+    response = MagicMock()
+    response.json.return_value = {"likes": 1}
+    client.session.get.side_effect = lambda *args, **kwargs: release.wait() and response
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(client.get_pages_stats([1])))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    while not client._calls:
+        time.sleep(0.001)
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert results == [{"likes": 1}] * 5
+    client.session.get.assert_called_once()
+
+
+def test_stats_client_single_flight_error():
+    """Test callers waiting for the failed request raise its error"""
+    client = get_stats_client()
+    release = threading.Event()
+
+    def get(*args, **kwargs):
+        release.wait()
+        raise RuntimeError("Broken stats response")
+
+    client.session.get.side_effect = get
+    outcomes = []
+
+    def call():
+        try:
+            outcomes.append(client.get_pages_stats([1]))
+        except Exception as error:
+            outcomes.append(error)
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    while not client._calls:
+        time.sleep(0.001)
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert [type(outcome) for outcome in outcomes] == [RuntimeError] * 3
+    client.session.get.assert_called_once()
+
+
+def test_stats_client_circuit_breaker():
+    """Test calls are rejected without a request once the circuit is open"""
+    client = get_stats_client(cache_ttl=0)
+    client.session.get.side_effect = requests.Timeout()
+
+    for _ in range(3):
+        with pytest.raises(StatsUnavailable):
+            client.get_pages_stats([1])
+
+    assert client.session.get.call_count == 2
+
+
+@pytest.mark.django_db
+@patch("innotter.settings.STATS_BACKEND", "microservice")
+@patch("core.views.stats_client.get_pages_stats", side_effect=StatsUnavailable())
+def test_get_my_pages_stats_unavailable(get_pages_stats, client, user, user_page):
+    """Test unavailable stats service is reported instead of blocking the worker"""
+    client.login(username="user", password="userpass")
+    response = client.get("/api/get_my_pages/stats/")
+
+    assert response.status_code == 503
+    get_pages_stats.assert_called_once_with([user_page.pk])
@@ -19,9 +19,9 @@ def test_get_tags(client, user, tag, tag_additional):
     response = client.get("/api/tags/")
 
     assert response.status_code == 200
-    assert len(response.data) == 2
-    assert response.data[0]["id"] == tag.pk
-    assert response.data[1]["id"] == tag_additional.pk
+    assert len(response.data["results"]) == 2
+    assert response.data["results"][0]["id"] == tag.pk
+    assert response.data["results"][1]["id"] == tag_additional.pk
 
 
 @pytest.mark.django_db
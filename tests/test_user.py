@@ -1,4 +1,8 @@
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
 
 
 @pytest.mark.django_db
@@ -39,7 +43,7 @@ def test_get_list_of_users(client, user, admin):
     """Testing getting list of all users"""
     request = client.get("/api/users/")
 
-    assert len(request.data) == 2
+    assert len(request.data["results"]) == 2
 
 
 @pytest.mark.django_db
@@ -68,3 +72,35 @@ def test_block_user_without_permission(client, user_additional, admin):
     response = client.put(f"/api/users/{admin.pk}/block-unblock/")
 
     assert response.status_code == 403
+
+
+def users_queries(queries) -> list:
+    return [query["sql"] for query in queries if 'FROM "users_user"' in query["sql"]]
+
+
+@pytest.mark.django_db
+def test_jwt_principal_is_cached(user, user_page, private_user_page):
+    """Test authenticated requests don't read the user row once it's cached"""
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}")
+    client.get("/api/get_my_pages/stats/")
+
+    with CaptureQueriesContext(connection) as context:
+        response = client.get("/api/get_my_pages/stats/")
+
+    assert response.status_code == 200
+    assert set(response.data["pages"]) == {user_page.pk, private_user_page.pk}
+    assert users_queries(context.captured_queries) == []
+
+
+@pytest.mark.django_db
+def test_jwt_principal_is_dropped_on_block(client, user, admin):
+    """Test token of blocked user is rejected right away"""
+    api_client = APIClient()
+    api_client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}")
+    assert api_client.get("/api/get_my_pages/").status_code == 200
+
+    client.login(username="admin", password="adminpass")
+    client.put(f"/api/users/{user.pk}/block-unblock/")
+
+    assert api_client.get("/api/get_my_pages/").status_code == 401
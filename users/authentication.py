@@ -0,0 +1,127 @@
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Q
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from innotter import settings
+from innotter.metrics import metrics
+from users.models import User
+
+
+class Principal(NamedTuple):
+    """Immutable snapshot of the user fields authorization depends on"""
+
+    id: int
+    username: str
+    role: str
+    is_blocked: bool
+    page_ids: Tuple[int, ...]
+
+    FIELDS = ("id", "username", "role", "is_blocked")
+
+    def to_user(self) -> User:
+        """
+        User instance built from the principal without a query. Role and
+        block state based properties work as usual, the rest of the fields
+        are deferred and loaded from the database on first access.
+        """
+        user = User.from_db(DEFAULT_DB_ALIAS, self.FIELDS, self[: len(self.FIELDS)])
+        user.owned_page_ids = self.page_ids
+        return user
+
+
+class PrincipalCache:
+    """
+    Principals of authenticated users kept in the Django cache by user id.
+    Entry is dropped when block state, role or pages of the user change.
+    """
+
+    def __init__(self, alias: str, ttl: float):
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @staticmethod
+    def key(user_id: int) -> str:
+        return f"principal:{user_id}"
+
+    def get(self, user_id: int) -> Optional[Principal]:
+        principal = self.cache.get(self.key(user_id))
+        if principal is not None:
+            metrics.increment("principal.hits")
+            return Principal(*principal)
+        metrics.increment("principal.misses")
+        principal = self.load(user_id)
+        if principal is not None:
+            self.cache.set(self.key(user_id), tuple(principal), self.ttl)
+        return principal
+
+    @staticmethod
+    def load(user_id: int) -> Optional[Principal]:
+        """Reads user fields and ids of owned pages with a single query"""
+        row = (
+            User.objects.filter(pk=user_id)
+            .values(*Principal.FIELDS)
+            .annotate(
+                page_ids=ArrayAgg(
+                    "pages__id",
+                    filter=Q(pages__isnull=False),
+                    ordering="pages__id",
+                    default=[],
+                )
+            )
+            .first()
+        )
+        if row is None:
+            return None
+        row["page_ids"] = tuple(row["page_ids"])
+        return Principal(**row)
+
+    def invalidate(self, user_ids: Iterable[int]) -> None:
+        """Drops principals right away and once the transaction is committed"""
+        keys = [self.key(user_id) for user_id in user_ids]
+        self.cache.delete_many(keys)
+        transaction.on_commit(lambda: self.cache.delete_many(keys))
+
+
+principal_cache = PrincipalCache(
+    settings.PRINCIPAL_CACHE_ALIAS, ttl=settings.PRINCIPAL_CACHE_TTL
+)
+
+
+def get_owned_page_ids(user: User) -> Tuple[int, ...]:
+    """Ids of user's pages, taken from the principal when it's available"""
+    page_ids = getattr(user, "owned_page_ids", None)
+    if page_ids is None:
+        page_ids = tuple(user.pages.order_by("id").values_list("id", flat=True))
+    return page_ids
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWT authentication which doesn't load the user row on every request.
+    User is built from the cached principal, so requests which only check
+    role, block state or page ownership don't query the users table.
+    """
+
+    def get_user(self, validated_token) -> User:
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+
+        principal = principal_cache.get(user_id)
+        if principal is None:
+            raise AuthenticationFailed(_("User not found"), code="user_not_found")
+        if principal.is_blocked:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        return principal.to_user()
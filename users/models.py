@@ -16,6 +16,11 @@ class User(AbstractUser):
         BLOCK = "block"
         UNBLOCK = "unblock"
 
+    class NotificationMode(models.TextChoices):
+        IMMEDIATE = "immediate"
+        HOURLY = "hourly"
+        DAILY = "daily"
+
     username = models.CharField(max_length=128, unique=True)
     email = models.EmailField(unique=True)
     image_s3_path = models.ImageField(
@@ -27,6 +32,12 @@ class User(AbstractUser):
     role = models.CharField(max_length=9, choices=Roles.choices, default=Roles.USER)
     title = models.CharField(max_length=80, null=True, blank=True)
     is_blocked = models.BooleanField(default=False)
+    notification_mode = models.CharField(
+        max_length=9,
+        choices=NotificationMode.choices,
+        default=NotificationMode.IMMEDIATE,
+    )
+    unread_notifications = models.PositiveIntegerField(default=0)
     password = models.CharField(max_length=128)
 
     USERNAME_FIELD = "username"
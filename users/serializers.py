@@ -2,10 +2,11 @@ from django.contrib.auth.password_validation import validate_password
 from rest_framework.validators import UniqueValidator
 from rest_framework import serializers
 
+from innotter.serializers import BatchListSerializer, DynamicFieldsMixin
 from users.models import User
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     """User model serializer."""
 
     email = serializers.EmailField(required=True)
@@ -19,6 +20,18 @@ class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         exclude = ("password", "groups", "user_permissions")
+        read_only_fields = ("unread_notifications",)
+        list_serializer_class = BatchListSerializer
+
+
+class UserShortSerializer(serializers.ModelSerializer):
+    """Lightweight user representation for nested lists of users"""
+
+    class Meta:
+        model = User
+        fields = ("id", "username", "title", "image_s3_path")
+        read_only_fields = fields
+        list_serializer_class = BatchListSerializer
 
 
 class RegisterUserSerializer(serializers.ModelSerializer):
@@ -47,7 +60,7 @@ class RegisterUserSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = User
-        exclude = ("last_login", "date_joined", "is_blocked")
+        exclude = ("last_login", "date_joined", "is_blocked", "unread_notifications")
 
     def validate(self, attrs):
         """Password validation."""
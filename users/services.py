@@ -1,5 +1,8 @@
 from rest_framework.response import Response
 
+from core.live import user_blocked
+from core.page_sets import page_sets
+from users.authentication import principal_cache
 from users.models import User
 
 
@@ -8,8 +11,15 @@ def change_block_state(user: User, if_block: User.BlockState) -> Response:
     if if_block == User.BlockState.BLOCK:
         user.is_blocked = True
         user.save()
+        user.pages.update(owner_blocked=True)
+        principal_cache.invalidate([user.pk])
+        page_sets.invalidate_all()
+        user_blocked(user.pk, user.pages.values_list("id", flat=True))
         return Response({"response": "User successfully blocked"})
     else:
         user.is_blocked = False
         user.save()
+        user.pages.update(owner_blocked=False)
+        principal_cache.invalidate([user.pk])
+        page_sets.invalidate_all()
         return Response({"response": "User unblocked"})
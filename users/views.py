@@ -1,3 +1,4 @@
+from django.db import transaction
 from rest_framework.viewsets import GenericViewSet
 from rest_framework.permissions import (
     AllowAny,
@@ -14,12 +15,16 @@ from rest_framework.mixins import (
     DestroyModelMixin,
 )
 
+from core.email_services import send_digest_chunk
+from core.live import user_blocked
+from core.page_sets import page_sets
 from innotter.permissions import (
     IsAdminOrModerOrReadOnly,
     IsNotAuthenticated,
     IsAdminOrModer,
 )
 from users.serializers import UserSerializer, RegisterUserSerializer
+from users.authentication import principal_cache
 from users.services import change_block_state
 from users.models import User
 
@@ -39,7 +44,7 @@ class UserListViewSet(ListModelMixin, GenericViewSet):
         queryset = User.objects.all()
         username = self.request.query_params.get("username")
         if username:
-            queryset = queryset.get(username=username)
+            queryset = queryset.filter(username=username)
         return queryset
 
 
@@ -60,6 +65,32 @@ class RetrieveUpdateDestroyUserViewSet(
     serializer_class = UserSerializer
     permission_classes = (IsAuthenticatedOrReadOnly & IsAdminOrModerOrReadOnly,)
 
+    def perform_update(self, serializer):
+        """
+        Keeps block state of user's pages in sync with the user
+        and drops cached principal, role or block state may have changed.
+        User who switches to immediate notifications gets the posts
+        queued for their digest right away.
+        """
+        was_blocked = serializer.instance.is_blocked
+        old_mode = serializer.instance.notification_mode
+        user = serializer.save()
+        if (
+            user.notification_mode != old_mode
+            and user.notification_mode == User.NotificationMode.IMMEDIATE
+        ):
+            transaction.on_commit(lambda: send_digest_chunk.delay([user.pk]))
+        user.pages.update(owner_blocked=user.is_blocked)
+        principal_cache.invalidate([user.pk])
+        if user.is_blocked != was_blocked:
+            page_sets.invalidate_all()
+        if user.is_blocked and not was_blocked:
+            user_blocked(user.pk, user.pages.values_list("id", flat=True))
+
+    def perform_destroy(self, instance):
+        principal_cache.invalidate([instance.pk])
+        super().perform_destroy(instance)
+
     def delete(self, request, *args, **kwargs):
         """Override delete to log the successful removal of a user."""
         super(RetrieveUpdateDestroyUserViewSet, self).delete(